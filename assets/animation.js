@@ -0,0 +1,90 @@
+// Clientside playback of the time-lapse maps. Frames arrive from the server in
+// batches ("animation-frames"), are appended to the frames held in the browser
+// ("animation-buffer"), and every interval tick shows the next one. The
+// playback position tells the server when to send the next batch.
+
+function animationFigure(buffer, frame, geojson) {
+    var trace = {
+        type: "choropleth",
+        locations: buffer.locations,
+        z: buffer.z[frame],
+        zmin: buffer.zmin,
+        zmax: buffer.zmax,
+        colorscale: "Viridis",
+        colorbar: {
+            yanchor: "middle",
+            thicknessmode: "fraction",
+            thickness: 0.03,
+            title: {text: buffer.category, side: "right"}
+        }
+    };
+    if (buffer.level === "counties") {
+        trace.geojson = geojson;
+        trace.locationmode = "geojson-id";
+        trace.hovertext = buffer.text;
+    } else {
+        trace.locationmode = "USA-states";
+        trace.text = buffer.text;
+    }
+    return {
+        data: [trace],
+        layout: {
+            geo: {center: {lat: 37.0902, lon: -95.7129}, scope: "usa"},
+            paper_bgcolor: "#D6DBDF",
+            title: {text: buffer.category + " on " + buffer.dates[frame]},
+            margin: {r: 5, t: 30, l: 5, b: 5}
+        }
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    animation: {
+        merge_frames: function(frames, buffer) {
+            var no_update = window.dash_clientside.no_update;
+            if (!frames) {
+                return no_update;
+            }
+            // The first batch of an animation starts a new buffer
+            if (frames.start === 0) {
+                return frames;
+            }
+            // Batches extend the buffer in order, anything else is stale
+            if (!buffer || buffer.key !== frames.key || frames.start !== buffer.dates.length) {
+                return no_update;
+            }
+            return Object.assign({}, buffer, {
+                dates: buffer.dates.concat(frames.dates),
+                z: buffer.z.concat(frames.z),
+                next: frames.next
+            });
+        },
+
+        play: function(n_intervals, buffer, position, geojson) {
+            var no_update = window.dash_clientside.no_update;
+            if (!buffer || (buffer.level === "counties" && !geojson)) {
+                return [no_update, no_update];
+            }
+            var frame = 0;
+            if (position && position.key === buffer.key) {
+                frame = position.frame;
+                if (n_intervals !== position.tick) {
+                    // Advance, waiting at the end of the frames loaded so far
+                    // and starting over after the last one
+                    if (frame + 1 < buffer.dates.length) {
+                        frame += 1;
+                    } else if (buffer.next === null) {
+                        frame = 0;
+                    }
+                }
+            }
+            return [animationFigure(buffer, frame, geojson),
+                    {key: buffer.key, frame: frame, tick: n_intervals,
+                     loaded: buffer.dates.length, next: buffer.next}];
+        },
+
+        toggle: function(n_clicks) {
+            var playing = n_clicks % 2 === 1;
+            return [!playing, !playing, playing ? "Pause" : "Play"];
+        }
+    }
+});
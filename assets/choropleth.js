@@ -0,0 +1,136 @@
+// Clientside rendering of the county and state choropleths. The county
+// geojson is fetched once per page load from a static file the browser
+// caches, into the "county-geojson" store; the server only sends per-location values when the date or category changes,
+// and leaves out the locations and hover text when the figure already holds
+// them under the same key (plotting.choropleth_patch).
+
+// Values with the locations and hover text filled in from the figure, or
+// null when the figure does not hold the locations the values were sent for
+function mergeHeld(values, figure, held, textAttr) {
+    if (values.locations) {
+        return values;
+    }
+    var trace = figure && figure.data && figure.data[0];
+    if (!trace || !trace.locations || held !== values.key) {
+        return null;
+    }
+    return Object.assign({}, values, {locations: trace.locations, text: trace[textAttr]});
+}
+
+// The county geojson being fetched, by url
+var geometry = {url: null, data: null};
+
+function fetchGeometry(url) {
+    geometry = {url: url, data: null};
+    fetch(url)
+        .then(function(response) {
+            if (!response.ok) {
+                throw new Error(response.statusText);
+            }
+            return response.json();
+        })
+        .then(function(data) {
+            if (geometry.url === url) {
+                geometry.data = data;
+            }
+        })
+        .catch(function() {
+            // Fetched again on the next tick
+            if (geometry.url === url) {
+                geometry.url = null;
+            }
+        });
+}
+
+function colorbar(category) {
+    return {
+        yanchor: "middle",
+        thicknessmode: "fraction",
+        thickness: 0.03,
+        title: {text: category, side: "right"}
+    };
+}
+
+window.dash_clientside = Object.assign({}, window.dash_clientside, {
+    geometry: {
+        // Polled until the geojson has arrived, then hands it to the store
+        // and stops the interval
+        load: function(n_intervals, url) {
+            var no_update = window.dash_clientside.no_update;
+            if (!url) {
+                return [no_update, true];
+            }
+            if (geometry.url === url && geometry.data) {
+                return [geometry.data, true];
+            }
+            if (geometry.url !== url) {
+                fetchGeometry(url);
+            }
+            return [no_update, false];
+        }
+    },
+    county: {
+        render_choropleth: function(values, geojson, figure, held) {
+            var no_update = window.dash_clientside.no_update;
+            if (!values || !geojson) {
+                return [no_update, no_update];
+            }
+            values = mergeHeld(values, figure, held, "hovertext");
+            if (!values) {
+                // Out of step, the next update is sent in full
+                return [no_update, null];
+            }
+            return [{
+                data: [{
+                    type: "choropleth",
+                    geojson: geojson,
+                    locations: values.locations,
+                    locationmode: "geojson-id",
+                    z: values.z,
+                    zmin: values.zmin,
+                    zmax: values.zmax,
+                    hovertext: values.text,
+                    colorscale: "Viridis",
+                    colorbar: colorbar(values.category)
+                }],
+                layout: {
+                    geo: {center: {lat: 37.0902, lon: -95.7129}, scope: "usa"},
+                    paper_bgcolor: "#D6DBDF",
+                    title: {text: values.title},
+                    margin: {r: 5, t: 30, l: 5, b: 5}
+                }
+            }, values.key];
+        }
+    },
+    state: {
+        render_choropleth: function(values, figure, held) {
+            var no_update = window.dash_clientside.no_update;
+            if (!values) {
+                return [no_update, no_update];
+            }
+            values = mergeHeld(values, figure, held, "text");
+            if (!values) {
+                return [no_update, null];
+            }
+            return [{
+                data: [{
+                    type: "choropleth",
+                    locations: values.locations,
+                    locationmode: "USA-states",
+                    z: values.z,
+                    text: values.text,
+                    colorscale: "Viridis",
+                    colorbar: colorbar(values.category)
+                }],
+                layout: {
+                    geo: {center: {lat: 37.0902, lon: -95.7129}, scope: "usa"},
+                    autosize: true,
+                    margin: {r: 5, t: 40, l: 5, b: 5},
+                    title: {text: values.title},
+                    paper_bgcolor: "#D6DBDF",
+                    plot_bgcolor: "#DCDCDC"
+                }
+            }, values.key];
+        }
+    }
+});
@@ -0,0 +1,157 @@
+'''Check the pipeline's kernels against straightforward references.
+
+Run from the repository root:
+
+    python -m benchmarks.check
+
+Each check builds a small synthetic frame, runs the vectorized code and the
+row by row reference it replaced, and fails on the first difference. Exits
+non-zero if any check fails.'''
+import contextlib
+import io
+import sys
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import synthetic
+from benchmarks.run import load_cloud_function
+from modules import county_store
+from modules import data_processing
+from modules import kernels
+from modules import rollup
+from modules import snapshot
+
+
+def _reference_diffs_and_averages(df, keys, column, window, date = 'date'):
+    # Diff from the previous row and trailing window day average of every
+    # group, one row at a time
+    diff = pd.Series(np.nan, index=df.index)
+    average = pd.Series(np.nan, index=df.index)
+    for _, group in df.sort_values(date).groupby(keys, sort=False):
+        values = group[column].to_numpy(dtype=np.float64)
+        days = group[date].values.astype('datetime64[D]')
+        diffs = np.concatenate([[np.nan], values[1:] - values[:-1]])
+        diff[group.index] = diffs
+        for i, day in enumerate(days):
+            if days[0] > day - (window - 1):
+                continue
+            inside = (days > day - window) & (days <= day)
+            if not np.isnan(diffs[inside]).any():
+                average[group.index[i]] = diffs[inside].sum() / window
+    return diff, average
+
+
+def check_kernel_gaps():
+    '''add_diffs_and_averages on series with a missing day and a missing
+    value, the averages count days rather than rows.'''
+    dates = pd.date_range('2020-03-01', periods=40)
+    df = pd.DataFrame({'fips': np.repeat([1001, 1003, 1005], len(dates)),
+                       'date': np.tile(dates, 3),
+                       'cases': np.concatenate([np.arange(40) ** 2,
+                                                np.arange(40) * 3,
+                                                np.arange(40) + 5]).astype(np.float64)})
+    # 1001 skips a day, 1003 has a missing count, 1005 starts late
+    df = df.drop(df.index[(df['fips'] == 1001) & (df['date'] == dates[20])])
+    df.loc[(df['fips'] == 1003) & (df['date'] == dates[25]), 'cases'] = np.nan
+    df = df.drop(df.index[(df['fips'] == 1005) & (df['date'] < dates[10])])
+    # Rows in any order
+    df = df.sample(frac=1, random_state=0)
+
+    result = kernels.add_diffs_and_averages(df.copy(),
+        keys = ['fips'],
+        diffs = {'case_diff': 'cases'},
+        averages = {'cases_7MA': ('case_diff', 7)})
+    diff, average = _reference_diffs_and_averages(df, ['fips'], 'cases', 7)
+    np.testing.assert_allclose(result['case_diff'], diff)
+    np.testing.assert_allclose(result['cases_7MA'], average)
+
+
+def check_incremental_append(n_counties = 40, n_days = 90, new_days = 3):
+    '''The cloud function's incremental county update, chaining new_days onto
+    the published tail with a county missing a day and a county resuming
+    after more than a month, matches a full rebuild.'''
+    cloud_function = load_cloud_function()
+    counties = synthetic.generate_counties(n_counties)
+    nyt = pd.read_csv(io.BytesIO(synthetic.generate_nyt_counties(counties, n_days)),
+                      dtype={'fips': str})
+    dates = sorted(nyt['date'].unique())
+    reporting = nyt['fips'].dropna().unique()
+    # A county missing a day inside the tail the update chains onto
+    gap = nyt.index[(nyt['fips'] == reporting[0]) & (nyt['date'] == dates[-6])]
+    # A county whose last published row is older than the tail's window
+    resumed = nyt.index[(nyt['fips'] == reporting[1]) & (nyt['date'] >= dates[-45])
+                        & (nyt['date'] < dates[-new_days])]
+    nyt = nyt.drop(gap.union(resumed))
+
+    def raw(df):
+        return df.to_csv(index=False).encode('utf8')
+    census = synthetic.generate_census(counties)
+    previous_sources = {'nyt_counties': raw(nyt[nyt['date'] < dates[-new_days]]),
+                        'census_counties': census}
+    full_sources = {'nyt_counties': raw(nyt),
+                    'census_counties': census,
+                    # NYT's recent window reaches back about a month
+                    'nyt_counties_recent': raw(nyt[nyt['date'] >= dates[-30]])}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        previous_df = cloud_function.generate_covid_county_data(raw_sources = previous_sources)
+        # The tail as published, through a parquet snapshot
+        buffer = io.BytesIO()
+        snapshot.write_snapshot(cloud_function.county_tail(previous_df), buffer,
+                                snapshot.COUNTY_DTYPES)
+        tail_df = snapshot.read_snapshot(buffer)
+        new_df = cloud_function.update_covid_county_data(tail_df, full_sources)
+        full_df = cloud_function.generate_covid_county_data(raw_sources = full_sources)
+    assert new_df is not None, "update_covid_county_data fell back to a rebuild"
+    assert len(tail_df) < len(previous_df), "the tail holds the whole history"
+
+    order = ['fips', 'county', 'state', 'date']
+    updated_df = pd.concat([previous_df, new_df.astype({'county': object, 'state': object})],
+                           ignore_index=True)
+    updated_df = updated_df[full_df.columns].sort_values(order).reset_index(drop=True)
+    full_df = full_df.sort_values(order).reset_index(drop=True)
+    pd.testing.assert_frame_equal(updated_df, full_df, check_dtype=False)
+
+
+def check_rollup_totals(n_counties = 60, n_days = 45):
+    '''State and national rollups of the county cube equal the sums of every
+    raw NYT row, the rows without a county fips included.'''
+    raw_sources, _ = synthetic.generate_sources(n_counties, n_days)
+    nyt = pd.read_csv(io.BytesIO(raw_sources['nyt_counties']))
+    # A geographic exception like New York City, reported without a fips
+    exception = nyt[nyt['county'] == 'Unknown'].copy()
+    exception['county'] = 'Exception City'
+    raw_sources['nyt_counties'] = pd.concat([nyt, exception]).to_csv(index=False).encode('utf8')
+    nyt = pd.concat([nyt, exception])
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = data_processing.get_covid_county_data(cache_mode = 0, raw_sources = raw_sources)
+        county_rollup = rollup.build_rollup(county_store.build_county_cube(df))
+    for level, expected in (('state', nyt.groupby(['state', 'date'])[['cases', 'deaths']].sum()),
+                            ('nation', nyt.groupby([np.repeat(rollup.NATION, len(nyt)), 'date'])
+                                          [['cases', 'deaths']].sum())):
+        for metric in ('cases', 'deaths'):
+            rolled = [county_rollup.value(level, entity, metric, date)
+                      for entity, date in expected.index]
+            np.testing.assert_array_equal(rolled, expected[metric].to_numpy(dtype=np.float64),
+                                          err_msg=f'{level} {metric}')
+
+
+CHECKS = [check_kernel_gaps, check_incremental_append, check_rollup_totals]
+
+
+def main():
+    failed = 0
+    for check in CHECKS:
+        try:
+            check()
+            print(f"{check.__name__:<40} ok")
+        except AssertionError as error:
+            failed += 1
+            print(f"{check.__name__:<40} FAILED\n{error}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+'''Benchmark the data pipeline and plotting functions on synthetic data.
+
+Run from the repository root:
+
+    python -m benchmarks.run --counties 3200 --days 730
+    python -m benchmarks.run --compare benchmarks/results/<commit>-3200x730.json
+
+Each stage is timed over --repeat runs and run once more under tracemalloc
+for its peak memory. Results are written to benchmarks/results/ named by the
+current commit and scale, and --compare prints the change against an earlier
+results file.'''
+import argparse
+import contextlib
+import datetime
+import importlib.util
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import plotly
+
+from benchmarks import synthetic
+from modules import animation
+from modules import county_store
+from modules import data_processing
+from modules import hotspots
+from modules import kernels
+from modules import plotting
+from modules import rollup
+from modules import snapshot
+from modules import spatial
+
+RESULTS_DIR = 'benchmarks/results'
+
+
+def load_cloud_function():
+    '''Import cloud-function/CF-main.py, its file name is not importable.'''
+    spec = importlib.util.spec_from_file_location('cf_main', 'cloud-function/CF-main.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(func, repeat = 3, setup = None, verbose = False):
+    '''Return (result, stats) of func timed over repeat runs.'''
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    times = []
+    with output:
+        for _ in range(repeat):
+            if setup:
+                setup()
+            t0 = time.perf_counter()
+            result = func()
+            times.append(time.perf_counter() - t0)
+
+        # Peak memory from a separate run, tracemalloc slows everything down
+        if setup:
+            setup()
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, {'seconds_min': min(times),
+                    'seconds_median': float(np.median(times)),
+                    'peak_mb': peak / 2**20}
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return commit + ('-dirty' if dirty else '')
+
+
+def run(n_counties, n_days, repeat = 3, seed = 0, verbose = False):
+    '''Run every stage and return the results dict.'''
+    results = {}
+
+    def stage(name, func, setup = None):
+        result, stats = measure(func, repeat, setup, verbose)
+        results[name] = stats
+        print(f"{name:<40} {stats['seconds_min']:9.3f} s {stats['peak_mb']:10.1f} MB")
+        return result
+
+    print(f"Generating {n_counties} counties x {n_days} days")
+    t0 = time.perf_counter()
+    raw_sources, geojson = synthetic.generate_sources(n_counties, n_days, seed)
+    print(f"Generated {sum(len(raw) for raw in raw_sources.values()) / 2**20:.1f} MB of "
+          f"sources in {time.perf_counter() - t0:.1f} seconds")
+
+    # Pipeline
+    stage('census', lambda: data_processing.get_census_county_data(raw_sources['census_counties']))
+    covid_counties_df = stage('county_transform', lambda: data_processing.get_covid_county_data(
+        cache_mode = 0, raw_sources = raw_sources))
+    covid_states_df = stage('state_transform', lambda: data_processing.get_covid_state_data(
+        cache_mode = 0, raw_sources = raw_sources))
+
+    cloud_function = load_cloud_function()
+    with tempfile.TemporaryDirectory() as directory:
+        bucket = cloud_function.LocalBucket(directory)
+        stage('write_df_to_GCS', lambda: cloud_function.write_df_to_GCS(
+            covid_counties_df, 'covid_counties.csv.gz', bucket = bucket))
+        # An incremental update appends one day's rows
+        last_day = covid_counties_df[covid_counties_df['date'] == covid_counties_df['date'].max()]
+        stage('append_df_to_GCS', lambda: cloud_function.append_df_to_GCS(
+            last_day, 'covid_counties.csv.gz', bucket = bucket))
+
+    # Data as the web app holds it
+    def build_cube():
+        df = snapshot.coerce_snapshot_dtypes(covid_counties_df[snapshot.COUNTY_COLUMNS],
+                                             snapshot.COUNTY_DTYPES)
+        return county_store.build_county_cube(
+            snapshot.compact_frame(df, snapshot.COUNTY_COMPACT_DTYPES, 'county'))
+    cube = stage('county_cube', build_cube)
+    stage('color_quantiles', lambda: kernels.location_quantiles(cube.values, county_store.COLOR_QUANTILES))
+    states_df = snapshot.compact_frame(
+        snapshot.coerce_snapshot_dtypes(covid_states_df[snapshot.STATE_COLUMNS],
+                                        snapshot.STATE_DTYPES),
+        snapshot.STATE_COMPACT_DTYPES, 'state')
+
+    # County, state and national rollups, built once and then read per entity
+    county_rollup = stage('rollup', lambda: rollup.build_rollup(cube))
+    stage('rollup_series', lambda: [county_rollup.series(level, entity, 'cases_14MA')
+                                    for level, entity in (('county', int(cube.fips[0])),
+                                                          ('state', 'NY'),
+                                                          ('nation', rollup.NATION))])
+    stage('rollup_check', lambda: rollup.compare_covid_tracking(county_rollup, states_df))
+
+    # Plotting, with the figure cache emptied before every run
+    date = str(cube.end_date)
+    fips = int(cube.fips[0])
+    uncached = plotting.clear_figure_cache
+    outputs = {}
+    outputs['plot_national'] = stage('plot_national', lambda: plotting.plot_national(
+        states_df, 'death'))
+    national_matrix = stage('national_matrix', lambda: data_processing.generate_national_matrix(
+        states_df))
+    outputs['plot_national_bars'] = stage('plot_national_bars', lambda: plotting.plot_national_bars(
+        national_matrix, 'death'), uncached)
+    outputs['scatter_deaths_county'] = stage('scatter_deaths_county', lambda: plotting.scatter_deaths_county(
+        cube, 'deaths', date, fips))
+    outputs['county_choropleth_values'] = stage('county_choropleth_values', lambda: plotting.county_choropleth_values(
+        cube, 'deaths', date), uncached)
+    # What a date slider move sends once the client holds the locations
+    outputs['county_choropleth_patch'] = plotting.choropleth_patch(
+        outputs['county_choropleth_values'], outputs['county_choropleth_values']['key'])
+    outputs['plot_choropleth_county'] = stage('plot_choropleth_county', lambda: plotting.plot_choropleth_county(
+        cube, geojson, 'deaths', date), uncached)
+    outputs['plot_choropleth_state'] = stage('plot_choropleth_state', lambda: plotting.plot_choropleth_state(
+        states_df, pd.Timestamp(date), 'death'), uncached)
+    outputs['state_choropleth_values'] = stage('state_choropleth_values', lambda: plotting.state_choropleth_values(
+        states_df, pd.Timestamp(date), 'death'), uncached)
+    outputs['plot_scatter_state'] = stage('plot_scatter_state', lambda: plotting.plot_scatter_state(
+        states_df, 'NY', ('deathIncrease', 'death'), county_rollup), uncached)
+    string_dates = states_df.assign(date = states_df['date'].dt.strftime('%Y-%m-%d'))
+    stage('generate_animation_dates', lambda: plotting.generate_animation_dates(string_dates))
+    outputs['plot_animation'] = stage('plot_animation', lambda: plotting.plot_animation(
+        string_dates, 'death'))
+
+    # Hotspots, ranked for every date once and then read per date
+    hotspot_table = stage('hotspot_table', lambda: hotspots.build_hotspot_table(cube))
+    stage('update_hotspot_table', lambda: hotspots.update_hotspot_table(hotspot_table, cube))
+    stage('top_hotspots', lambda: hotspots.top_hotspots(hotspot_table, cube, date))
+
+    # Spatial statistics over the county adjacency
+    adjacency = stage('county_adjacency', lambda: spatial.build_county_adjacency(geojson))
+    matrix = adjacency.aligned(cube.fips)
+    incidence = cube.values[cube.metric_index['cases_14MA']] / cube.population[:, None]
+    stage('getis_ord_g_date', lambda: spatial.getis_ord_g(matrix, incidence[:, -1]))
+    stage('local_morans_i_date', lambda: spatial.local_morans_i(matrix, incidence[:, -1]))
+    stage('getis_ord_g_all_dates', lambda: spatial.getis_ord_g(matrix, incidence))
+    stage('top_hotspots_clusters', lambda: hotspots.top_hotspots(hotspot_table, cube, date,
+                                                                 adjacency = adjacency))
+
+    # Time-lapse frames, built once per dataset then sent a batch at a time
+    state_frames = stage('state_frames', lambda: animation.state_frames(states_df))
+    outputs['frame_batch_states'] = stage('frame_batch_states', lambda: animation.frame_batch(
+        state_frames, 'states', 'death', 7, 0))
+    outputs['frame_batch_counties'] = stage('frame_batch_counties', lambda: animation.frame_batch(
+        animation.county_frames(cube), 'counties', 'cases_14MA', 1, 0))
+    stage('frame_color_range_counties', lambda: animation.county_frames(cube).color_range('cases_14MA'))
+
+    # Encoding each output as a Dash response
+    for name, output in outputs.items():
+        response = {'response': {'graph': {'figure': output}}, 'multi': True}
+        stage(f'encode_{name}', lambda: json.dumps(response, cls = plotly.utils.PlotlyJSONEncoder))
+
+    return {'commit': git_commit(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'counties': n_counties,
+            'days': n_days,
+            'repeat': repeat,
+            'stages': results}
+
+
+def compare(results, baseline):
+    '''Print each stage's change against a baseline results dict.'''
+    print(f"\nCompared to {baseline['commit']} ({baseline['counties']} x {baseline['days']})")
+    for name, stats in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            print(f"{name:<40} new")
+            continue
+        time_ratio = stats['seconds_min'] / max(before['seconds_min'], 1e-9)
+        memory_ratio = stats['peak_mb'] / max(before['peak_mb'], 1e-9)
+        print(f"{name:<40} time x{time_ratio:6.2f}   memory x{memory_ratio:6.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument('--counties', type = int, default = 3200)
+    parser.add_argument('--days', type = int, default = 730)
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--output', help = 'results file, defaults to benchmarks/results/<commit>-<scale>.json')
+    parser.add_argument('--compare', help = 'earlier results file to compare against')
+    parser.add_argument('--verbose', action = 'store_true', help = "show the pipeline's own output")
+    args = parser.parse_args()
+
+    results = run(args.counties, args.days, args.repeat, args.seed, args.verbose)
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, f"{results['commit']}-{args.counties}x{args.days}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok = True)
+    with open(output, 'w') as fout:
+        json.dump(results, fout, indent = 2)
+    print(f"Results written to {output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as fin:
+            compare(results, json.load(fin))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+import numpy as np
+import pandas as pd
+
+import json
+
+
+################################################################################
+# Synthetic Sources
+# Stand-ins for the upstream downloads, generated as the same raw bytes the
+# fetch module hands to the parsing functions, so the benchmarks run the real
+# pipeline without GitHub, covidtracking.com, census.gov or GCS.
+
+START_DATE = '2020-01-21'
+
+# Census columns repeated for each year of estimates, the real file is about
+# 160 columns wide and most of them are read and dropped
+CENSUS_YEARLY_COLUMNS = ['POPESTIMATE', 'NPOPCHG_', 'BIRTHS', 'DEATHS', 'NATURALINC',
+                         'INTERNATIONALMIG', 'DOMESTICMIG', 'NETMIG', 'RESIDUAL',
+                         'GQESTIMATES', 'RBIRTH', 'RDEATH', 'RNATURALINC',
+                         'RINTERNATIONALMIG', 'RDOMESTICMIG', 'RNETMIG']
+
+# Covid Tracking fields with a cumulative count and a daily increase
+STATE_METRICS = {'positive': 'positiveIncrease',
+                 'death': 'deathIncrease',
+                 'hospitalizedCumulative': 'hospitalizedIncrease',
+                 'totalTestResults': 'totalTestResultsIncrease',
+                 'negative': 'negativeIncrease'}
+
+
+def load_states(path = 'data/tbl_states.csv'):
+    '''Real state abbreviations, names and fips codes.'''
+    return pd.read_csv(path, dtype={'fips': str})
+
+
+def generate_counties(n_counties = 3200, seed = 0):
+    '''Return a frame of synthetic counties spread over the real states.'''
+    rng = np.random.default_rng(seed)
+    states = load_states()
+    state_idx = np.sort(rng.integers(0, len(states), n_counties))
+    # Odd county codes numbered within each state, like the real ones
+    county_code = 2 * (np.arange(n_counties)
+                       - np.searchsorted(state_idx, state_idx)) + 1
+    return pd.DataFrame({
+        'STATE': states['fips'].astype(int).to_numpy()[state_idx],
+        'COUNTY': county_code,
+        'STNAME': states['state_name'].to_numpy()[state_idx],
+        'CTYNAME': [f'County {i}' for i in range(n_counties)],
+        # Log-normal populations, a few large metros and many small counties
+        'POPESTIMATE2019': rng.lognormal(10.3, 1.4, n_counties).astype(np.int64) + 100
+    })
+
+
+def generate_census(counties, seed = 0):
+    '''Return csv bytes shaped like census.gov's co-est2019-alldata.csv.'''
+    rng = np.random.default_rng(seed)
+    df = counties.copy()
+    df.insert(0, 'SUMLEV', 50)
+    df.insert(1, 'REGION', (df['STATE'] % 4) + 1)
+    df.insert(2, 'DIVISION', (df['STATE'] % 9) + 1)
+    population = df.pop('POPESTIMATE2019')
+    df['CENSUS2010POP'] = (population * rng.uniform(0.9, 1.05, len(df))).astype(np.int64)
+    df['ESTIMATESBASE2010'] = df['CENSUS2010POP']
+    yearly = {}
+    for column in CENSUS_YEARLY_COLUMNS:
+        for year in range(2010, 2020):
+            if column == 'POPESTIMATE':
+                values = (population * (1 - 0.005 * (2019 - year))).astype(np.int64)
+            elif column.startswith('R'):
+                values = rng.normal(0, 5, len(df)).round(6)
+            else:
+                values = rng.integers(-500, 500, len(df))
+            yearly[f'{column}{year}'] = values
+    df = pd.concat([df, pd.DataFrame(yearly, index=df.index)], axis=1)
+    return df.to_csv(index=False).encode('ISO-8859-1')
+
+
+def generate_nyt_counties(counties, n_days = 730, seed = 0):
+    '''Return csv bytes shaped like NYT's us-counties.csv.
+
+    Counties start reporting on staggered dates and then report every day
+    with cumulative counts. Each state also has an "Unknown" county without
+    a fips code.'''
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(START_DATE, periods=n_days)
+    n_counties = len(counties)
+
+    # First reported day of each county, most within the first few months
+    first_day = np.minimum(rng.exponential(60, n_counties).astype(int), n_days - 1)
+    # Cumulative counts from daily Poisson increases scaled by population
+    rate = counties['POPESTIMATE2019'].to_numpy() / 2e4
+    new_cases = rng.poisson(rate[None, :] * rng.uniform(0.2, 2, (n_days, 1)))
+    new_deaths = rng.binomial(new_cases, 0.015)
+    cases = np.cumsum(new_cases, axis=0)
+    deaths = np.cumsum(new_deaths, axis=0)
+
+    day, county = np.nonzero(np.arange(n_days)[:, None] >= first_day[None, :])
+    df = pd.DataFrame({
+        'date': dates[day].strftime('%Y-%m-%d'),
+        'county': counties['CTYNAME'].to_numpy()[county],
+        'state': counties['STNAME'].to_numpy()[county],
+        'fips': (counties['STATE'].to_numpy() * 1000 + counties['COUNTY'].to_numpy())[county],
+        'cases': cases[day, county],
+        'deaths': deaths[day, county]})
+    df['fips'] = df['fips'].map('{:05d}'.format)
+
+    # Unknown counties, a small share of each state's counts
+    states = counties['STNAME'].unique()
+    unknown = pd.DataFrame({
+        'date': np.repeat(dates.strftime('%Y-%m-%d'), len(states)),
+        'county': 'Unknown',
+        'state': np.tile(states, n_days),
+        'fips': '',
+        'cases': np.cumsum(rng.poisson(3, (n_days, len(states))), axis=0).ravel(),
+        'deaths': np.cumsum(rng.poisson(0.05, (n_days, len(states))), axis=0).ravel()})
+    df = pd.concat([df, unknown], ignore_index=True).sort_values(
+        by=['date', 'state', 'county'], kind='mergesort')
+    return df.to_csv(index=False).encode('utf8')
+
+
+def generate_covid_tracking(n_days = 730, seed = 0):
+    '''Return JSON bytes shaped like the Covid Tracking states/daily API,
+    newest day first.'''
+    rng = np.random.default_rng(seed)
+    states = load_states()['state'].to_numpy()
+    dates = pd.date_range(START_DATE, periods=n_days)[::-1]
+
+    df = pd.DataFrame({'date': np.repeat(dates.strftime('%Y%m%d').astype(int), len(states)),
+                       'state': np.tile(states, n_days)})
+    for cumulative, increase in STATE_METRICS.items():
+        # Increases generated oldest first so the cumulative sums run forward
+        daily = rng.poisson(rng.uniform(10, 2000, len(states)), (n_days, len(states)))
+        df[increase] = daily[::-1].ravel()
+        df[cumulative] = np.cumsum(daily, axis=0)[::-1].ravel()
+    df['hospitalizedCurrently'] = rng.integers(0, 5000, len(df))
+    df['fips'] = np.tile(load_states()['fips'].to_numpy(), n_days)
+    df['dataQualityGrade'] = 'A'
+    return json.dumps(df.to_dict(orient='records')).encode('utf8')
+
+
+def generate_county_geojson(counties):
+    '''Return a geojson of one small rectangle per county on a grid, each
+    bordering its neighbours, with string fips ids like plotly's counties
+    geojson.'''
+    features = []
+    for i, (state, county) in enumerate(zip(counties['STATE'], counties['COUNTY'])):
+        x, y = -125 + (i % 60), 25 + (i // 60) * 0.5
+        ring = [[x, y], [x + 1, y], [x + 1, y + 0.5], [x, y + 0.5], [x, y]]
+        features.append({'type': 'Feature',
+                         'id': f'{state * 1000 + county:05d}',
+                         'properties': {},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def generate_sources(n_counties = 3200, n_days = 730, seed = 0):
+    '''Return ({source name: bytes}, county geojson) at the given scale,
+    see modules.fetch.SOURCES.'''
+    counties = generate_counties(n_counties, seed)
+    nyt_counties = generate_nyt_counties(counties, n_days, seed)
+    raw_sources = {'nyt_counties': nyt_counties,
+                   'census_counties': generate_census(counties, seed),
+                   'covid_tracking_states': generate_covid_tracking(n_days, seed)}
+    return raw_sources, generate_county_geojson(counties)
@@ -7,6 +7,7 @@ import time
 # Custom files and modules
 from config import config
 from modules import data_processing
+from modules import fetch
 
 
 if 'GOOGLE_APPLICATION_CREDENTIALS' not in os.environ:
@@ -38,8 +39,12 @@ def main():
     BLOB_NAME = 'covid_states.csv.gz'
     FILEPATH = f"data/{BLOB_NAME}"
     
+    # Download every upstream source concurrently
+    RAW_SOURCES = fetch.fetch_sources(['covid_tracking_states', 'nyt_counties', 'census_counties'])
+    
     # Read in new county data from Covid Tracking Project
-    COVID_STATES_DF = data_processing.get_covid_state_data(cache_mode = 0)
+    COVID_STATES_DF = data_processing.get_covid_state_data(cache_mode = 0,
+                                                           raw_sources = RAW_SOURCES)
 
     print(f"Writing state DF to {BLOB_NAME}")
     # Write DF to csv.gz
@@ -57,7 +62,8 @@ def main():
     FILEPATH = f"data/{BLOB_NAME}"
 
     # Getting Data
-    COVID_COUNTIES_DF = data_processing.get_covid_county_data(cache_mode=0)
+    COVID_COUNTIES_DF = data_processing.get_covid_county_data(cache_mode=0,
+                                                              raw_sources=RAW_SOURCES)
     
     print(f"Writing county DF to {BLOB_NAME}")
     # Writing DF to csv.gz
@@ -1,15 +1,28 @@
 import base64
+import json
 import os
 import sys
 import time
 
 import pandas as pd
-import requests
 import gzip
-from io import BytesIO, TextIOWrapper
+import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
 
 from google.cloud import storage
 
+# Shared with the web app, deployed alongside this file
+from modules import snapshot
+from modules import fips
+from modules import fetch
+from modules import kernels
+from modules.source_cache import SourceCache
+
+# Upstream response bodies and validators, kept between runs in the bucket
+SOURCE_CACHE_URI = 'gs://us_covid_hotspot-bucket/source_cache'
+
 def hello_pubsub(event, context):
     """Triggered from a message on a Cloud Pub/Sub topic.
     Args:
@@ -22,18 +35,21 @@ def hello_pubsub(event, context):
 
 
 # Get state covid data from Covid Tracking Project's API
-def generate_covid_state_data():
-    ''' This function is specific to gathering data from github with no caching. And loading that data to GCS.'''
+def generate_covid_state_data(raw = None):
+    ''' This function is specific to gathering data from github with no caching. And loading that data to GCS.
+    
+    raw: bytes of the Covid Tracking API response, downloaded if None'''
     print("Pulling state data from Covid Tracking API")
         
     # Coronavirus data by state from covidtracking API
-    states_url = "https://covidtracking.com/api/states/daily"
+    if raw is None:
+        raw = fetch.fetch_sources(['covid_tracking_states'])['covid_tracking_states']
         
-    with requests.get(states_url) as response:
-        covid_states_df = pd.DataFrame.from_records(
-            response.json(),
-            index = range(len(response.json()))
-        )
+    records = json.loads(raw)
+    covid_states_df = pd.DataFrame.from_records(
+        records,
+        index = range(len(records))
+    )
 
     # Set date as datetime format
     covid_states_df['date'] = pd.to_datetime(covid_states_df['date'], format="%Y%m%d")
@@ -61,52 +77,28 @@ def generate_covid_state_data():
     covid_states_df['death_pm'] = covid_states_df['death']/covid_states_df['Pop']*1000000
         
     # Daily Increase Moving Averages
-    covid_states_df["deaths_14MA"] = covid_states_df.groupby(
-            by=['state'], 
-            as_index=False
-    )['deathIncrease'].rolling(14).mean().reset_index(level=0, drop=True)
-    
-    covid_states_df["cases_14MA"] = covid_states_df.groupby(
-            by=['state'], 
-            as_index=False
-    )['positiveIncrease'].rolling(14).mean().reset_index(level=0, drop=True)
+    covid_states_df = kernels.add_diffs_and_averages(covid_states_df,
+            keys = ['state'],
+            averages = {'deaths_14MA': ('deathIncrease', 14),
+                        'cases_14MA': ('positiveIncrease', 14)})
             
     return covid_states_df
 
 
 ## County Data, starting with Census Data
 
-# Function to generate fips from a state int and county int.
-def generate_fips(state_fips, county_fips):
-    state_str, county_str = str(state_fips), str(county_fips)
-    
-    # Check length of state code and append 0's if necessary.
-    if len(state_str) == 1:
-        state_str = "0"+state_str
-        
-    # Check length of county code and append 0's if necessary.
-    if len(county_str) == 1:
-        county_str = "00"+county_str
-    elif len(county_str) == 2:
-        county_str = "0"+county_str
-        
-    return state_str+county_str
-
-def get_census_county_data():
-    # URL coming from census.gov as ISO encoded csv
-    url = 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/totals/co-est2019-alldata.csv'
+def get_census_county_data(raw = None):
+    '''raw: bytes of the census.gov csv, downloaded if None'''
+    # Bytes coming from census.gov as ISO encoded csv
+    if raw is None:
+        raw = fetch.fetch_sources(['census_counties'])['census_counties']
     
     # Read in the data to dataframe
-    census_df = pd.read_csv(url, encoding = "ISO-8859-1")
+    census_df = pd.read_csv(BytesIO(raw), encoding = "ISO-8859-1")
     
 
-    # Use apply across rows to generate fips codes.
-    census_df['FIPS'] = census_df[['STATE','COUNTY']].apply(
-        lambda x:generate_fips(
-            x['STATE'],
-            x['COUNTY']
-        ), axis=1
-    )
+    # Integer fips codes from the state and county columns
+    census_df['FIPS'] = fips.encode_fips(census_df['STATE'], census_df['COUNTY'])
     # Define features
     features = ['FIPS',
                 'STATE',
@@ -118,26 +110,27 @@ def get_census_county_data():
 
 
 # Get covid data at a county level.
-def generate_covid_county_data():
+def generate_covid_county_data(raw_sources = None):
     '''Function to return covid county data from nytimes github\n
     https://raw.githubusercontent.com/nytimes/covid-19-data
     This function is exclusive to our cloud function deployment.
-    '''
     
+    raw_sources: already fetched {source name: bytes}, see modules.fetch
+    '''
     print("Pulling covid county data from github.")
-    # NYT covid-19 github url
-    url = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'
+    # NYT covid-19 github and census data, downloaded concurrently
+    raw_sources = fetch.ensure_sources(raw_sources, ['nyt_counties', 'census_counties'])
     
     # Read in data from github
-    df = pd.read_csv(url)
+    df = pd.read_csv(BytesIO(raw_sources['nyt_counties']))
     
-    # Reassign our fips to be a string of length 5
-    df['fips'] = df['fips'].astype(str).apply(lambda x: '0'+x[:4] if len(x) == 6 else x[:5])
+    # Integer fips codes, MISSING_FIPS for unknown counties
+    df['fips'] = fips.normalize_fips(df['fips'])
     # Set date format
     df['date'] = pd.to_datetime(df['date'], format = '%Y-%m-%d')
 
     # Get Census data and Merge dataframes on fips
-    df = df.merge(get_census_county_data(),
+    df = df.merge(get_census_county_data(raw_sources['census_counties']),
                     how='left',
                     left_on='fips',
                     right_on='FIPS')
@@ -147,49 +140,344 @@ def generate_covid_county_data():
     # Deaths Per Million
     df['deathsPerMillion']=df['deaths']/df['POPESTIMATE2019']*1000000
     
-     
-    df['case_diff'] = df.groupby(
-            by = ['fips','county','state'])['cases'].diff()
-    #df['case_pm_diff'] = df.sort_values(by=['fips','state','county','date'])['casesPerMillion'].diff()
+    # New cases and deaths by day and their 14 day moving averages,
+    # computed for every county in one pass
+    df = kernels.add_diffs_and_averages(df,
+        keys = ['fips','county','state'],
+        diffs = COUNTY_DIFFS,
+        averages = COUNTY_AVERAGES)
+
+    return df
+
+# Window of the 14 day moving averages
+COUNTY_TAIL_DAYS = 14
+# Diff and moving average columns of the county data, see modules.kernels
+COUNTY_DIFFS = {'case_diff': 'cases',
+                'death_diff': 'deaths'}
+COUNTY_AVERAGES = {'cases_14MA': ('case_diff', COUNTY_TAIL_DAYS),
+                   'deaths_14MA': ('death_diff', COUNTY_TAIL_DAYS)}
+# Days of published rows kept in the county tail, covering the averages'
+# window and NYT's recent window (about 30 days) the updates compare against
+TAIL_WINDOW_DAYS = 35
+COUNTY_KEYS = ['fips','county','state']
+
+def county_tail(df):
+    '''Return the rows of the county data the next update chains onto: every
+    row within TAIL_WINDOW_DAYS of the last date, and each county's last row
+    before them however old, so a county that stopped reporting still diffs
+    from its last published count. Its size grows with the counties, not the
+    history.'''
+    tail_start = df['date'].max() - pd.Timedelta(days=TAIL_WINDOW_DAYS)
+    in_window = (df['date'] > tail_start).to_numpy()
+    older = df[~in_window].sort_values('date', kind='stable')
+    last_older = older.index[~older.duplicated(COUNTY_KEYS, keep='last')]
+    return df[in_window | df.index.isin(last_older)].reset_index(drop=True)
+
+def read_recent_covid_county_data(raw = None):
+    '''Read NYT's rolling window of the most recent days of county data.
     
-    # New Deaths by day
-    df['death_diff'] = df.groupby(
-            by = ['fips','county','state'])['deaths'].diff()
+    raw: bytes of us-counties-recent.csv, downloaded if None'''
+    print("Pulling recent covid county data from github.")
+    if raw is None:
+        raw = fetch.fetch_sources(['nyt_counties_recent'])['nyt_counties_recent']
     
-     
-    df["cases_14MA"] = df.groupby(
-        by=['fips','county','state'], 
-        as_index=False)['case_diff'].rolling(14).mean().reset_index(level=[0,1,2], drop=True)
-    df["deaths_14MA"] = df.groupby(
-        by=['fips','county','state'], 
-        as_index=False)['death_diff'].rolling(14).mean().reset_index(level=[0,1,2], drop=True)
-
+    df = pd.read_csv(BytesIO(raw))
+    df['fips'] = fips.normalize_fips(df['fips'])
+    df['date'] = pd.to_datetime(df['date'], format = '%Y-%m-%d')
     return df
 
-def write_df_to_GCS(df, blob_name):
+def update_covid_county_data(tail_df, raw_sources = None):
+    '''Return the rows of the newly published dates, transformed as
+    generate_covid_county_data would, with the columns of tail_df.
+    
+    tail_df is the county_tail of the published snapshot. Only it, NYT's
+    recent window and the new rows are held, so run time and memory scale
+    with the daily delta. Returns an empty frame when there are no new dates,
+    and None when the recent upstream rows disagree with the published tail,
+    in which case the caller should rebuild from the full history. Revisions
+    older than the tail are not seen here, see FULL_REBUILD_DAYS.'''
+    keys = COUNTY_KEYS
+    raw_sources = raw_sources or {}
+    recent_df = read_recent_covid_county_data(raw_sources.get('nyt_counties_recent'))
+    last_date = tail_df['date'].max()
+    
+    # The recent window has to reach back into the snapshot to be chained on
+    if recent_df['date'].min() > last_date + pd.Timedelta(days=1):
+        print("Recent county data does not overlap the snapshot.")
+        return None
+    
+    # Any change to already published rows means upstream was revised. The
+    # tail holds every published row of its window.
+    compare_start = max(recent_df['date'].min(),
+                        last_date - pd.Timedelta(days=TAIL_WINDOW_DAYS - 1))
+    overlap = recent_df[(recent_df['date'] >= compare_start) & (recent_df['date'] <= last_date)]
+    published = tail_df[tail_df['date'] >= compare_start].astype({'county': object, 'state': object})
+    compared = overlap.merge(published[keys + ['date','cases','deaths']],
+                             how='inner',
+                             on=keys + ['date'],
+                             suffixes=('','_published'))
+    if (len(compared) != len(overlap) or len(compared) != len(published)
+        or (compared['cases'] != compared['cases_published']).any()
+        or (compared['deaths'].fillna(-1) != compared['deaths_published'].fillna(-1)).any()):
+        return None
+    
+    new_df = recent_df[recent_df['date'] > last_date]
+    if new_df.empty:
+        print("No new county dates to process.")
+        return tail_df.iloc[:0]
+    print(f"Processing {new_df['date'].nunique()} new dates, {len(new_df)} rows.")
+    
+    # Census columns come from the tail, download only for new counties
+    census_features = ['FIPS','STATE','COUNTY','POPESTIMATE2019','CENSUS2010POP']
+    census_df = tail_df[census_features].dropna().drop_duplicates('FIPS')
+    if not new_df['fips'][new_df['fips'] != fips.MISSING_FIPS].isin(census_df['FIPS']).all():
+        census_df = get_census_county_data(raw_sources.get('census_counties'))
+    new_df = new_df.merge(census_df,
+                    how='left',
+                    left_on='fips',
+                    right_on='FIPS')
+    new_df['casesPerMillion']=new_df['cases']/new_df['POPESTIMATE2019']*1000000
+    new_df['deathsPerMillion']=new_df['deaths']/new_df['POPESTIMATE2019']*1000000
+    
+    # Chain the new rows onto the tail, which reaches back to each county's
+    # last published row. The tail keeps its published diffs, the first of
+    # a county's tail rows has no previous row to diff from here.
+    combined = pd.concat([tail_df.astype({'county': object, 'state': object}), new_df],
+                         ignore_index=True)
+    is_new = (combined['date'] > last_date).to_numpy()
+    computed = kernels.add_diffs_and_averages(combined[keys + ['date','cases','deaths']].copy(),
+        keys = keys,
+        diffs = COUNTY_DIFFS)
+    for column in COUNTY_DIFFS:
+        combined.loc[is_new, column] = computed.loc[is_new, column]
+    computed = kernels.add_diffs_and_averages(combined[keys + ['date'] + list(COUNTY_DIFFS)].copy(),
+        keys = keys,
+        averages = COUNTY_AVERAGES)
+    for column in COUNTY_AVERAGES:
+        combined.loc[is_new, column] = computed.loc[is_new, column]
+    
+    return combined.loc[is_new, list(tail_df.columns)].reset_index(drop=True)
+
+# Days between full rebuilds of the county data from NYT's whole history,
+# which pick up revisions older than the tail update_covid_county_data
+# compares against
+FULL_REBUILD_DAYS = 7
+# Blob holding the date of the last full rebuild
+FULL_REBUILD_BLOB = 'covid_counties.rebuilt'
+
+def read_last_full_rebuild():
+    '''Return the time of the last full county rebuild, None if unknown.'''
+    client = storage.Client()
+    blob = client.get_bucket('us_covid_hotspot-bucket').blob(FULL_REBUILD_BLOB)
+    try:
+        return pd.Timestamp(blob.download_as_text())
+    except Exception as error:
+        print(f"Could not read {FULL_REBUILD_BLOB}: {error}")
+        return None
+
+def write_last_full_rebuild():
+    '''Record now as the time of the last full county rebuild.'''
+    client = storage.Client()
+    blob = client.get_bucket('us_covid_hotspot-bucket').blob(FULL_REBUILD_BLOB)
+    blob.upload_from_string(pd.Timestamp.now(tz='UTC').isoformat(), content_type='text/plain')
+
+def read_county_manifest():
+    '''Return the manifest of the published county snapshot, None if there
+    is none, see modules.snapshot.'''
+    client = storage.Client()
+    blob = client.get_bucket('us_covid_hotspot-bucket').blob(snapshot.COUNTY_MANIFEST)
+    try:
+        return snapshot.parse_manifest(blob.download_as_text())
+    except Exception as error:
+        print(f"Could not read {snapshot.COUNTY_MANIFEST}: {error}")
+        return None
+
+def read_previous_snapshot(blob_name):
+    '''Read the last published snapshot from GCS, None if there is none.'''
     bucket_name = 'us_covid_hotspot-bucket'
     blob_uri = f"gs://{bucket_name}/{blob_name}"
+    try:
+        return snapshot.read_snapshot(blob_uri)
+    except Exception as error:
+        print(f"Could not read {blob_uri}: {error}")
+        return None
+
+def publish_county_snapshot(df, tail_df, manifest = None):
+    '''Publish df as a part of the county snapshot, after the parts of
+    manifest, or as the whole snapshot when manifest is None, with tail_df as
+    the tail the next update chains onto.
+    
+    The part and tail are written first and the manifest listing them last.
+    Parts listed by neither the new nor the previous manifest are removed,
+    web workers still reading the previous snapshot keep their parts.'''
+    first, last = df['date'].min(), df['date'].max()
+    part = f"{snapshot.COUNTY_PARTS_PREFIX}{first:%Y%m%d}-{last:%Y%m%d}.parquet"
+    tail = f"{snapshot.COUNTY_PARTS_PREFIX}tail-{last:%Y%m%d}.parquet"
+    write_snapshot_to_GCS(df, part, snapshot.COUNTY_DTYPES)
+    write_snapshot_to_GCS(tail_df, tail, snapshot.COUNTY_DTYPES)
+    
+    parts = [part] if manifest is None else manifest['parts'] + [part]
+    client = storage.Client()
+    bucket = client.get_bucket('us_covid_hotspot-bucket')
+    bucket.blob(snapshot.COUNTY_MANIFEST).upload_from_string(
+        snapshot.format_manifest(parts, tail), content_type='application/json')
+    print(f"Published {part}, the county snapshot has {len(parts)} parts")
+    
+    keep = set(parts + [tail])
+    if manifest is not None:
+        keep.update(manifest['parts'] + [manifest['tail']])
+    for blob in bucket.list_blobs(prefix=snapshot.COUNTY_PARTS_PREFIX):
+        if blob.name not in keep:
+            blob.delete()
+
+# Rows of csv per gzip member, bounds the memory held per chunk
+CSV_CHUNK_ROWS = 200000
+# Most source objects GCS accepts in one compose request
+COMPOSE_LIMIT = 32
+
+def iter_csv_chunks(df, chunk_rows = CSV_CHUNK_ROWS, header = True):
+    '''Serialize df to utf8 csv bytes chunk_rows rows at a time, the first
+    chunk starting with the header row if header.'''
+    # An empty frame still gets its header row
+    for start in range(0, max(len(df), 1), chunk_rows):
+        yield df.iloc[start:start + chunk_rows].to_csv(index=False,
+                                                       header=(header and start == 0)).encode('utf8')
+
+def _upload_gzip_part(bucket, part_name, chunk):
+    # zlib releases the GIL, so parts compress in parallel across threads.
+    # Each part is a complete gzip member, and concatenated members are a
+    # valid gzip file.
+    part = bucket.blob(part_name)
+    part.upload_from_string(gzip.compress(chunk), content_type='application/gzip', timeout=240)
+    return part
+
+def _compose_parts(bucket, blob_name, parts):
+    # Compose in rounds of COMPOSE_LIMIT until one object is left
+    level = 0
+    while len(parts) > COMPOSE_LIMIT:
+        composed = []
+        for i in range(0, len(parts), COMPOSE_LIMIT):
+            blob = bucket.blob(f"{blob_name}.parts/compose-{level}-{i // COMPOSE_LIMIT:05d}")
+            blob.compose(parts[i:i + COMPOSE_LIMIT])
+            composed.append(blob)
+        for part in parts:
+            part.delete()
+        parts = composed
+        level += 1
+    blob = bucket.blob(blob_name)
+    blob.content_type = 'text/csv'
+    blob.compose(parts)
+    for part in parts:
+        part.delete()
+
+def _upload_csv_parts(df, blob_name, bucket, chunk_rows, workers, header = True):
+    # Serialize and compress on a thread pool, uploading each chunk as a part
+    workers = workers or os.cpu_count() or 1
+    print(f"Streaming {blob_name} as gzip parts")
+    t0 = time.time()
+    parts, in_flight = [], deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for i, chunk in enumerate(iter_csv_chunks(df, chunk_rows, header)):
+            # Wait for the oldest part before serializing more than two per worker
+            if len(in_flight) >= 2 * workers:
+                parts.append(in_flight.popleft().result())
+            in_flight.append(pool.submit(_upload_gzip_part, bucket,
+                                         f"{blob_name}.parts/{i:05d}", chunk))
+        parts.extend(future.result() for future in in_flight)
+    print(f"Uploading {len(parts)} parts took {time.time()-t0} seconds")
+    return parts
+
+def write_df_to_GCS(df, blob_name, bucket = None, chunk_rows = CSV_CHUNK_ROWS, workers = None):
+    '''Stream df to a gzip csv blob without holding the whole file in memory.
+    
+    The csv is serialized chunk_rows rows at a time, each chunk is compressed
+    as an independent gzip member on a thread pool and uploaded as its own
+    part, then the parts are composed into blob_name in GCS. Peak memory is
+    bounded by the chunks in flight. bucket defaults to the project bucket, a
+    LocalBucket can stand in for it.'''
+    if bucket is None:
+        client = storage.Client()
+        bucket = client.get_bucket('us_covid_hotspot-bucket')
+    parts = _upload_csv_parts(df, blob_name, bucket, chunk_rows, workers)
+    
+    t0 = time.time()
+    _compose_parts(bucket, blob_name, parts)
+    print(f"Composing took {time.time()-t0} seconds")
+
+def append_df_to_GCS(df, blob_name, bucket = None, chunk_rows = CSV_CHUNK_ROWS, workers = None):
+    '''Append the rows of df to a gzip csv blob written by write_df_to_GCS.
+    
+    Only df is serialized and uploaded, as gzip members without a header,
+    and GCS composes them onto the end of the existing blob, so the cost
+    does not grow with the blob. df must have the blob's columns in order.'''
+    if bucket is None:
+        client = storage.Client()
+        bucket = client.get_bucket('us_covid_hotspot-bucket')
+    parts = _upload_csv_parts(df, blob_name, bucket, chunk_rows, workers, header = False)
+    
+    t0 = time.time()
+    # The existing blob is a source of the compose, never deleted as a part
+    delta_name = f"{blob_name}.parts/append"
+    _compose_parts(bucket, delta_name, parts)
+    delta = bucket.blob(delta_name)
+    blob = bucket.blob(blob_name)
+    blob.content_type = 'text/csv'
+    blob.compose([blob, delta])
+    delta.delete()
+    print(f"Appending took {time.time()-t0} seconds")
+
+
+# Local filesystem stand-in for a GCS bucket, for running write_df_to_GCS
+# without credentials. Implements only the blob calls used above.
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.content_type = None
+        self.path = os.path.join(bucket.directory, name)
+    
+    def upload_from_string(self, data, content_type=None, timeout=None):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'wb') as fout:
+            fout.write(data)
+    
+    def compose(self, sources):
+        # Written aside first, the blob itself can be one of the sources
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path + '.compose', 'wb') as fout:
+            for source in sources:
+                with open(source.path, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout)
+        os.replace(self.path + '.compose', self.path)
+    
+    def delete(self):
+        os.remove(self.path)
+
+class LocalBucket:
+    def __init__(self, directory):
+        self.directory = directory
     
-    # Instantiate BytesIO Buffer
-    gz_buffer = BytesIO()
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+def write_snapshot_to_GCS(df, blob_name, dtypes):
+    '''Write df to GCS as a typed parquet snapshot for the web app.'''
+    bucket_name = 'us_covid_hotspot-bucket'
     
-    # Instantiate a GzipFile Object using the BytesIO object, 
-      # write to it using a text wrapper.
-    print(f"Writing {blob_name} to gzip")
+    # Parquet is written whole into a buffer, it is a fraction of the csv size
+    print(f"Writing {blob_name} to parquet")
     t0 = time.time()
-    with gzip.GzipFile(mode='w', fileobj=gz_buffer) as gz_file:
-        df.to_csv(TextIOWrapper(gz_file,'utf8'),
-                 index=False)
-    print(f"Zipping took {time.time()-t0} seconds")
-    gz_buffer.seek(0)
-    print(f"Opening GCS")
+    buffer = BytesIO()
+    snapshot.write_snapshot(df, buffer, dtypes)
+    print(f"Parquet took {time.time()-t0} seconds")
+    buffer.seek(0)
+    
     client = storage.Client()
     bucket = client.get_bucket(bucket_name)
     blob = storage.blob.Blob(blob_name, bucket)
     t0 = time.time()
-    blob.upload_from_file(file_obj=gz_buffer, content_type='text/csv', timeout=240)
+    blob.upload_from_file(file_obj=buffer, content_type='application/octet-stream', timeout=240)
     print(time.time()-t0)
-    #return [blob_item.name for blob_item in bucket.list_blobs()]
 
 
 
@@ -233,20 +521,65 @@ def main():
     BUCKET_NAME = 'us_covid_hotspot-bucket'
     BLOB_NAME = 'covid_states.csv.gz'
     
-    # Read and transform in state data from Covid Tracking Project
-    DF = generate_covid_state_data()
+    # Download the state data and the recent county data concurrently. The
+    # requests are conditional, an unchanged source answers 304 and its body
+    # is read back from the source cache. Census data rarely changes.
+    SOURCE_CACHE = SourceCache(SOURCE_CACHE_URI)
+    RAW_SOURCES, CHANGED = fetch.fetch_changed_sources(
+        ['covid_tracking_states', 'nyt_counties_recent', 'census_counties'], SOURCE_CACHE)
     
-    # Write to Bucket - state
-    print(f"Writing {BLOB_NAME} to GCS {BUCKET_NAME}")
-    write_df_to_GCS(COVID_STATES_DF, BLOB_NAME)
+    if 'covid_tracking_states' in CHANGED:
+        # Read and transform in state data from Covid Tracking Project
+        DF = generate_covid_state_data(RAW_SOURCES['covid_tracking_states'])
+        
+        # Write to Bucket - state
+        print(f"Writing {BLOB_NAME} to GCS {BUCKET_NAME}")
+        write_df_to_GCS(DF, BLOB_NAME)
+        write_snapshot_to_GCS(DF, 'covid_states.parquet', snapshot.STATE_DTYPES)
+    else:
+        print("State data is unchanged upstream.")
     
     
     # County Data - Setting Variables
     BLOB_NAME = 'covid_counties.csv.gz'
 
-    # Read and transform county data from New York Times
-    DF = generate_covid_county_data()
+    # Every FULL_REBUILD_DAYS the county data is rebuilt from the whole
+    # history, whether or not the recent window changed
+    LAST_REBUILD = read_last_full_rebuild()
+    FULL_REBUILD = (LAST_REBUILD is None
+                    or pd.Timestamp.now(tz='UTC') - LAST_REBUILD >= pd.Timedelta(days=FULL_REBUILD_DAYS))
+
+    if 'nyt_counties_recent' in CHANGED or FULL_REBUILD:
+        # Between full rebuilds only the dates newer than the published
+        # snapshot are transformed, chained onto its tail, and written as a new
+        # part and appended to the csv
+        MANIFEST = None if FULL_REBUILD else read_county_manifest()
+        NEW_DF = None
+        if MANIFEST is not None:
+            TAIL_DF = read_previous_snapshot(MANIFEST['tail'])
+            if TAIL_DF is not None:
+                NEW_DF = update_covid_county_data(TAIL_DF, RAW_SOURCES)
+                if NEW_DF is None:
+                    print("Upstream history was revised, rebuilding county data.")
+        
+        if NEW_DF is None:
+            print("Rebuilding county data from the full history.")
+            DF = generate_covid_county_data(RAW_SOURCES)
+            print(f"Writing {BLOB_NAME} to GCS {BUCKET_NAME}")
+            write_df_to_GCS(DF, BLOB_NAME)
+            publish_county_snapshot(DF, county_tail(DF))
+            write_last_full_rebuild()
+        elif NEW_DF.empty:
+            print("County data is already up to date.")
+        else:
+            publish_county_snapshot(NEW_DF,
+                                    county_tail(pd.concat([TAIL_DF, NEW_DF], ignore_index=True)),
+                                    MANIFEST)
+            # After the manifest, a failed run never appends the same dates twice
+            print(f"Appending {len(NEW_DF)} rows to {BLOB_NAME} in GCS {BUCKET_NAME}")
+            append_df_to_GCS(NEW_DF, BLOB_NAME)
+    else:
+        print("County data is unchanged upstream.")
     
-    # Write file to GCS
-    print(f"Writing {BLOB_NAME} to GCS {BUCKET_NAME}")
-    write_df_to_GCS(COVID_COUNTIES_DF, BLOB_NAME)
\ No newline at end of file
+    # Only remember the new validators once everything derived from them is written
+    SOURCE_CACHE.save()
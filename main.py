@@ -1,45 +1,58 @@
 
 # Import libraries
-import pandas as pd
-import numpy as np
-import requests
-
-import geopandas as gpd
 #import matplotlib.pyplot as plt
-import plotly.express as px
-import plotly.graph_objects as go
 #import geoplot as gplt
-from plotly.subplots import make_subplots
-
-from urllib.request import urlopen
-import json
 
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ClientsideFunction
 from dash.exceptions import PreventUpdate
 import time
-import datetime
+import os
 
 # Custom module
 from modules import data_processing
 from modules import plotting
+from modules import animation
+from modules import hotspots
+from modules import spatial
+from modules import dataset
+from modules import metrics
+from modules import fips as fips_codec
+
+# Send the county geojson to the browser once and only stream per-county
+# values on updates, instead of a full figure with the geometry each time.
+STREAM_COUNTY_GEOMETRY = os.environ.get("STREAM_COUNTY_GEOMETRY", "1") == "1"
+
+# Categories of the time-lapse maps, the county map needs the geojson store
+ANIMATION_CATEGORIES = {
+    "states": [{"label":"death","value":"death"},
+               {"label":"deathIncrease","value":"deathIncrease"},
+               {"label":"positive","value":"positive"},
+               {"label":"positiveIncrease","value":"positiveIncrease"},
+               {"label":"hospitalizedCurrently","value":"hospitalizedCurrently"}],
+    "counties": [{"label":"Cases per million", "value":"casesPerMillion"},
+                 {"label":"Deaths per million", "value":"deathsPerMillion"},
+                 {"label":"14-day MA of daily cases", "value":"cases_14MA"},
+                 {"label":"14-day MA of daily deaths", "value":"deaths_14MA"}]
+}
+ANIMATION_LEVELS = ["states", "counties"] if STREAM_COUNTY_GEOMETRY else ["states"]
 
-# Get county geojson for county polygones
-COUNTY_GEOJSON = data_processing.load_county_geojson() # cache_mode
-# Get county coronavirus data
-t0=time.time()
-COVID_COUNTIES_DF = data_processing.get_covid_county_data(cache_mode = 3) #cache_mode
-print(f"Time for county:{time.time() - t0}")
-      
-      
-# Get state coronavirus data
-t0=time.time()
-COVID_STATES_DF = data_processing.get_covid_state_data(cache_mode = 3)
-print(f"Time for county:{time.time() - t0}")
-date_dict = data_processing.generate_slider_dates(COVID_COUNTIES_DF)
-max_date_str = time.strftime("%Y-%m-%d",time.localtime(max(date_dict)))
+# Get county geojson for county polygones. When streaming, the browser
+# fetches it as a static file it caches (COUNTY_GEOJSON_ROUTE) and the
+# workers never parse it or encode it into the layout.
+COUNTY_GEOJSON_ROUTE = "/county-geojson.json"
+COUNTY_GEOJSON_PATH = data_processing.county_geojson_path()
+COUNTY_GEOJSON_GZIP = data_processing.county_geojson_gzip_path()
+COUNTY_GEOJSON = None if STREAM_COUNTY_GEOMETRY else data_processing.load_county_geojson()
+# Which counties border each other, cached under data/ after the first run
+COUNTY_ADJACENCY = spatial.load_county_adjacency(COUNTY_GEOJSON_PATH)
+# Load the current snapshot and keep polling the bucket for new ones, every
+# callback reads the dataset through dataset.current()
+dataset.refresh()
+dataset.start_refresher()
 
 style_dict = {
     "section-div":{
@@ -76,7 +89,7 @@ style_dict = {
 ################################################################################
 
 # Create Dash object
-app = dash.Dash(
+app = dash.Dash(__name__,
         external_stylesheets = ["https://codepen.io/chriddyp/pen/bWLwgP.css"],
         meta_tags=[
             {"name": "viewport",
@@ -88,220 +101,320 @@ colors = {
     "background": "#c8a2c8",# "#6495ED",  #FF69B4 == pink , #c8a2c8 = lilac
     "text": "#000000"#"#7FDBFF"
 }
-app.layout = html.Div(
-    style={"backgroundColor": colors["background"]},
-    children=[
-        # Title
-        html.Div(id="header",
-            children=[
-                html.H1(children="US Covid-19 Dash",
-                    style={
-                        "textAlign": "center",
-                        "color": colors["text"]
-                    }
-                ), # Title H1
-                # Text div
-                html.Div(children="A dashboard to track the spread of coronavirus in the United States.",
-                         style={
+# Layout is built per page load so new data shows up without a restart
+def serve_layout():
+    ds = dataset.current()
+    date_dict = data_processing.generate_slider_dates(ds.county_cube.end_date)
+    max_date_str = time.strftime("%Y-%m-%d",time.localtime(max(date_dict)))
+    
+    return html.Div(
+        style={"backgroundColor": colors["background"]},
+        children=[
+            # Title
+            html.Div(id="header",
+                children=[
+                    html.H1(children="US Covid-19 Dash",
+                        style={
                             "textAlign": "center",
                             "color": colors["text"]
-                         }
-                ), #Text div
+                        }
+                    ), # Title H1
+                    # Text div
+                    html.Div(children="A dashboard to track the spread of coronavirus in the United States.",
+                             style={
+                                "textAlign": "center",
+                                "color": colors["text"]
+                             }
+                    ), #Text div
         
-        ]), # close header div
-        html.Br(),
-        html.H4("National Section"),
-        html.Div(id="national-section", 
-                style=style_dict["section-div"],
-                 children=[
-            html.Div(id="national-stats", className="row", children=[
-                # Alignment is handled on this Div below.
-                html.Div(className="four columns",
-                        style=style_dict['national-stats-container-div'],
-                        children=[
-                    html.Div(id="div-national-deaths", 
-                        style=style_dict["national-stats-item-div"],
+            ]), # close header div
+            html.Br(),
+            html.H4("National Section"),
+            html.Div(id="national-section", 
+                    style=style_dict["section-div"],
+                     children=[
+                html.Div(id="national-stats", className="row", children=[
+                    # Alignment is handled on this Div below.
+                    html.Div(className="four columns",
+                            style=style_dict['national-stats-container-div'],
+                            children=[
+                        html.Div(id="div-national-deaths", 
+                            style=style_dict["national-stats-item-div"],
+                            children=[
+                                html.H4(id="H4-national-deaths",
+                                    children=data_processing.lookup_national_stat(
+                                        ds.national_df,
+                                        max_date_str,
+                                        "death")
+                                ), 
+                                html.H5("Total Deaths")
+                            ]
+                        ),
+                        dcc.Graph(id="graph-national-deaths", 
+                              #className="four columns", 
+                              style=style_dict['graphs'],
+                              figure=plotting.plot_national_bars(ds.national_matrix,"death"))
+                    ]),
+                    html.Div(className="four columns",
+                             style=style_dict['national-stats-container-div'],
+                             children=[
+                        html.Div(id="div-national-cases",
+                            style=style_dict["national-stats-item-div"],
+                            children=[
+                                html.H4(id="H4-national-cases",
+                                    children=data_processing.lookup_national_stat(
+                                        ds.national_df,
+                                        max_date_str,
+                                        "positive")
+                                ), 
+                                html.H5("Total Positive Cases")
+                            ]
+                        ),
+                        dcc.Graph(id="graph-national-positive", 
+                              #className="four columns", 
+                              style=style_dict['graphs'],
+                              figure=plotting.plot_national_bars(ds.national_matrix,"positive"))
+                    ]),
+                    html.Div(className="four columns",
+                             style=style_dict['national-stats-container-div'],
+                             children=[
+                        html.Div(id="div-national-hospitalizedCurrently",
+                            style=style_dict["national-stats-item-div"],
+                            children=[
+                                html.H4(id="H4-national-hospitalized",
+                                    children=data_processing.lookup_national_stat(
+                                        ds.national_df,
+                                        max_date_str,
+                                        "hospitalizedCurrently")
+                                ),
+                                html.H5("Current Hospitalization")
+                            ]
+                        ),
+                        dcc.Graph(id="graph-national-hospitalizedCurrently", 
+                              #className="four columns", 
+                              style=style_dict['graphs'],
+                              figure=plotting.plot_national_bars(ds.national_matrix,"hospitalizedCurrently"))
+                    ])
+                ]) # close national stats div
+                ,dcc.RadioItems(id="national-mode",
+                    options=[{"label":"Largest states","value":"states"},
+                             {"label":"National total","value":"national"}],
+                    value="states",
+                    labelStyle={"display":"inline-block","margin":"0px 10px"})
+                ,html.Div(id="national-graphs", className="row",children=[])
+            
+            ]), # close national section div
+            
+            html.Br(),
+            html.Div(id="debug-div"),
+            html.Div(id="div-slider",style={"height":"100px","border":"1px black solid"},
+                children=[
+                    dcc.Slider(
+                        id="date-slider",
+                        min=min(date_dict),
+                        max=max(date_dict),
+                        value=max(date_dict),
+                        marks=date_dict,
+                        step=None
+                    ) # slider dcc])
+                ]
+            ), # slider div
+            html.H4("State Section"),
+            html.Div(id="state-section",
+                     className="row",
+                     style=style_dict["section-div"],
+                children=[
+                    html.Div(id="state-choropleth-div",
+                             className="six columns", 
                         children=[
-                            html.H4(id="H4-national-deaths",
-                                children=data_processing.generate_state_aggregate_stat(
-                                    COVID_STATES_DF,
-                                    max_date_str,
-                                    "death")
-                            ), 
-                            html.H5("Total Deaths")
+                            # Rendered clientside from the values store
+                            dcc.Graph(
+                                id="state-choropleth",
+                                style=style_dict['graphs'],
+                                figure={}
+                            ),
+                            dcc.Store(id="state-choropleth-values"),
+                            dcc.Store(id="state-choropleth-held")
                         ]
                     ),
-                    dcc.Graph(id="graph-national-deaths", 
-                          #className="four columns", 
-                          style=style_dict['graphs'],
-                          figure=plotting.plot_national(COVID_STATES_DF,"death"))
-                ]),
-                html.Div(className="four columns",
-                         style=style_dict['national-stats-container-div'],
-                         children=[
-                    html.Div(id="div-national-cases",
-                        style=style_dict["national-stats-item-div"],
+                    html.Div(id="state-scatter-div",className="six columns",
                         children=[
-                            html.H4(id="H4-national-cases",
-                                children=data_processing.generate_state_aggregate_stat(
-                                    COVID_STATES_DF,
-                                    max_date_str,
-                                    "positive")
-                            ), 
-                            html.H5("Total Positive Cases")
+                            dcc.Dropdown(id="state-dropdown",
+                                value="death",
+                                options=[
+                                    {"label":"death","value":"death"},
+                                    {"label":"deathIncrease","value":"deathIncrease"},
+                                    {"label":"positive","value":"positive"},
+                                    {"label":"positiveIncrease","value":"positiveIncrease"},
+                                    {"label":"hospitalizedCurrently","value":"hospitalizedCurrently"},
+                                    {"label":"hospitalizedCumulative","value":"hospitalizedCumulative"},
+                                    {"label":"hospitalizedIncrease", "value":"hospitalizedIncrease"}
+                                ]),
+                            dcc.Graph(id="state-scatter",
+                                      style=style_dict['graphs'],
+                                figure=plotting.plot_scatter_state(
+                                    ds.covid_states_df,
+                                    "NY",
+                                    ["deathIncrease","death"],
+                                    ds.rollup
+                                )
+                            )
                         ]
-                    ),
-                    dcc.Graph(id="graph-national-positive", 
-                          #className="four columns", 
-                          style=style_dict['graphs'],
-                          figure=plotting.plot_national(COVID_STATES_DF,"positive"))
-                ]),
-                html.Div(className="four columns",
-                         style=style_dict['national-stats-container-div'],
-                         children=[
-                    html.Div(id="div-national-hospitalizedCurrently",
-                        style=style_dict["national-stats-item-div"],
+                    )
+                ]
+            ),
+            html.Br(),
+            # open div for county graphs
+            html.H4("County Section"),
+            html.Div(id="county-section", 
+                     className="row",
+                     style=style_dict["section-div"],
+                children=[
+                    html.Div(className="six columns",
+                        children=[ # county choropleth div
+                            dcc.Graph( # county choropleth graph
+                                id="county-choropleth",
+                                style=style_dict['graphs'],
+                                # Rendered clientside from the stores when streaming
+                                figure={} if STREAM_COUNTY_GEOMETRY else plotting.plot_choropleth_county(
+                                    ds.county_cube,
+                                    COUNTY_GEOJSON,
+                                    "deaths",
+                                    date = max_date_str
+                                )
+                            ),
+                            dcc.RadioItems(id="county-color-scale",
+                                options=[{"label":"Scale per date","value":"date"},
+                                         {"label":"Same scale for all dates","value":"stable"}],
+                                value="date",
+                                labelStyle={"display":"inline-block","margin":"0px 10px"})
+                        ] + ([
+                            # Filled from COUNTY_GEOJSON_ROUTE in the browser,
+                            # the file's mtime in the url busts the browser cache
+                            dcc.Store(id="county-geojson-url",
+                                      data=app.get_relative_path(COUNTY_GEOJSON_ROUTE)
+                                           + f"?v={int(os.path.getmtime(COUNTY_GEOJSON_PATH))}"),
+                            dcc.Interval(id="county-geojson-interval", interval=250),
+                            dcc.Store(id="county-geojson"),
+                            dcc.Store(id="county-choropleth-values"),
+                            dcc.Store(id="county-choropleth-held")
+                        ] if STREAM_COUNTY_GEOMETRY else [])
+                    ), # choropleth div
+                    # County Scatter
+                    html.Div(className="six columns",
                         children=[
-                            html.H4(id="H4-national-hospitalized",
-                                children=data_processing.generate_state_aggregate_stat(
-                                    COVID_STATES_DF,
+                            dcc.Dropdown(
+                                id="county-dropdown",
+                                value="cases_14MA",
+                                options=[
+                                    {"label":"Total deaths", "value":"deaths"},
+                                    {"label":"Total cases", "value":"cases"},
+                                    {"label":"Cases per million", "value":"casesPerMillion"},
+                                    {"label":"Deaths per million", "value":"deathsPerMillion"},
+                                    {"label":"Daily cases", "value":"case_diff"},
+                                    {"label":"Daily deaths", "value":"death_diff"},
+                                    #{"label":"log_cases", "value":"log_cases"},
+                                    #{"label":"log_deaths", "value":"log_deaths"},
+                                    #{"label":"log_casesPerMillion", "value":"log_casesPerMillion"},
+                                    #{"label":"log_deathsPerMillion", "value":"log_deathsPerMillion"},
+                                    {"label":"14-day MA of daily cases", "value":"cases_14MA"},
+                                    {"label":"14-day MA of daily deaths", "value":"deaths_14MA"}
+                                ]
+                            ), # close dcc dropdown
+                            dcc.Graph(
+                                id="county-scatter",
+                                style=style_dict['graphs'],
+                                figure = plotting.scatter_deaths_county(
+                                    ds.county_cube,
+                                    "deaths",
                                     max_date_str,
-                                    "hospitalizedCurrently")
-                            ),
-                            html.H5("Current Hospitalization")
+                                    1001
+                                )
+                            ) # close dcc graph
+                        ]
+                    ), # close div tag
+                ]
+            ),
+            html.Br(),
+            # Counties where cases are high and rising, for the slider's date
+            html.H4("Top Hotspots"),
+            html.Div(id="hotspot-section",
+                     style=style_dict["section-div"],
+                children=[
+                    html.Div(id="hotspot-table")
+                ]
+            ),
+            html.Br(),
+            # Time-lapse maps, played in the browser from batches of frames
+            html.H4("Time-lapse Section"),
+            html.Div(id="animation-section",
+                     style=style_dict["section-div"],
+                children=[
+                    html.Div(className="row",
+                        children=[
+                            dcc.RadioItems(id="animation-level",
+                                className="three columns",
+                                options=[{"label":level.capitalize(),"value":level}
+                                         for level in ANIMATION_LEVELS],
+                                value="states",
+                                labelStyle={"display":"inline-block","margin":"0px 10px"}),
+                            dcc.Dropdown(id="animation-category",
+                                className="three columns",
+                                options=ANIMATION_CATEGORIES["states"],
+                                value="death"),
+                            dcc.RadioItems(id="animation-stride",
+                                className="three columns",
+                                options=[{"label":stride.capitalize(),"value":stride}
+                                         for stride in animation.FRAME_STRIDES],
+                                value="weekly",
+                                labelStyle={"display":"inline-block","margin":"0px 10px"}),
+                            html.Button("Play", id="animation-play", n_clicks=0)
                         ]
                     ),
-                    dcc.Graph(id="graph-national-hospitalizedCurrently", 
-                          #className="four columns", 
-                          style=style_dict['graphs'],
-                          figure=plotting.plot_national(COVID_STATES_DF,"hospitalizedCurrently"))
-                ])
-            ]) # close national stats div
-            ,html.Div(id="national-graphs", className="row",children=[])
-            
-        ]), # close national section div
-            
-        html.Br(),
-        html.Div(id="debug-div"),
-        html.Div(id="div-slider",style={"height":"100px","border":"1px black solid"},
-            children=[
-                dcc.Slider(
-                    id="date-slider",
-                    min=min(date_dict),
-                    max=max(date_dict),
-                    value=max(date_dict),
-                    marks=date_dict,
-                    step=None
-                ) # slider dcc])
-            ]
-        ), # slider div
-        html.H4("State Section"),
-        html.Div(id="state-section",
-                 className="row",
-                 style=style_dict["section-div"],
-            children=[
-                html.Div(id="state-choropleth-div",
-                         className="six columns", 
-                    children=[
-                        dcc.Graph(
-                            id="state-choropleth",
-                            style=style_dict['graphs'],
-                            figure=plotting.plot_choropleth_state(
-                                COVID_STATES_DF,
-                                max_date_str,
-                                "death"
-                            )
-                        )
-                    ]
-                ),
-                html.Div(id="state-scatter-div",className="six columns",
-                    children=[
-                        dcc.Dropdown(id="state-dropdown",
-                            value="death",
-                            options=[
-                                {"label":"death","value":"death"},
-                                {"label":"deathIncrease","value":"deathIncrease"},
-                                {"label":"positive","value":"positive"},
-                                {"label":"positiveIncrease","value":"positiveIncrease"},
-                                {"label":"hospitalizedCurrently","value":"hospitalizedCurrently"},
-                                {"label":"hospitalizedCumulative","value":"hospitalizedCumulative"},
-                                {"label":"hospitalizedIncrease", "value":"hospitalizedIncrease"}
-                            ]),
-                        dcc.Graph(id="state-scatter",
-                                  style=style_dict['graphs'],
-                            figure=plotting.plot_scatter_state(
-                                COVID_STATES_DF,
-                                "NY",
-                                ["deathIncrease","death"]
-                            )
-                        )
-                    ]
-                )
-            ]
-        ),
-        html.Br(),
-        # open div for county graphs
-        html.H4("County Section"),
-        html.Div(id="county-section", 
-                 className="row",
-                 style=style_dict["section-div"],
-            children=[
-                html.Div(className="six columns",
-                    children=[ # county choropleth div
-                        dcc.Graph( # county choropleth graph
-                            id="county-choropleth",
-                            style=style_dict['graphs'],
-                            figure=plotting.plot_choropleth_county(
-                                COVID_COUNTIES_DF,
-                                COUNTY_GEOJSON,
-                                "deaths",
-                                date = max_date_str
-                            )
-                        )
-                    ] 
-                ), # choropleth div
-                # County Scatter
-                html.Div(className="six columns",
-                    children=[
-                        dcc.Dropdown(
-                            id="county-dropdown",
-                            value="cases_14MA",
-                            options=[
-                                {"label":"Total deaths", "value":"deaths"},
-                                {"label":"Total cases", "value":"cases"},
-                                {"label":"Cases per million", "value":"casesPerMillion"},
-                                {"label":"Deaths per million", "value":"deathsPerMillion"},
-                                {"label":"Daily cases", "value":"case_diff"},
-                                {"label":"Daily deaths", "value":"death_diff"},
-                                #{"label":"log_cases", "value":"log_cases"},
-                                #{"label":"log_deaths", "value":"log_deaths"},
-                                #{"label":"log_casesPerMillion", "value":"log_casesPerMillion"},
-                                #{"label":"log_deathsPerMillion", "value":"log_deathsPerMillion"},
-                                {"label":"14-day MA of daily cases", "value":"cases_14MA"},
-                                {"label":"14-day MA of daily deaths", "value":"deaths_14MA"}
-                            ]
-                        ), # close dcc dropdown
-                        dcc.Graph(
-                            id="county-scatter",
-                            style=style_dict['graphs'],
-                            figure = plotting.scatter_deaths_county(
-                                COVID_COUNTIES_DF,
-                                "deaths",
-                                max_date_str,
-                                "01001"
-                            )
-                        ) # close dcc graph
-                    ]
-                ), # close div tag
-            ]
-        )
-#        ,dcc.Location(id="url", refresh=False),
-#        html.Link("Navigate to "/"", href="/"),
-#        html.Link("Navigate to "/page-2"", href="/page-2"),
-#        html.Div(id="page-content",children="Hello World")
-    ])
+                    dcc.Graph(id="animation-choropleth",
+                              style=style_dict['graphs'],
+                              figure={}),
+                    dcc.Interval(id="animation-interval",
+                                 interval=animation.FRAME_INTERVAL_MS,
+                                 disabled=True),
+                    dcc.Interval(id="animation-fetch-interval",
+                                 interval=animation.FETCH_INTERVAL_MS,
+                                 disabled=True),
+                    # The batch sent, every frame received so far and the
+                    # frame being shown
+                    dcc.Store(id="animation-frames"),
+                    dcc.Store(id="animation-buffer"),
+                    dcc.Store(id="animation-position")
+                ]
+            )
+    #        ,dcc.Location(id="url", refresh=False),
+    #        html.Link("Navigate to "/"", href="/"),
+    #        html.Link("Navigate to "/page-2"", href="/page-2"),
+    #        html.Div(id="page-content",children="Hello World")
+        ])
+
+app.layout = serve_layout
 app.title = "US Coronavirus Dashboard"
 server = app.server
+
+# The county geometry, gzipped once on disk since Flask-Compress leaves files
+# alone, and revalidated by the browser with its ETag
+@server.route(COUNTY_GEOJSON_ROUTE)
+def serve_county_geojson():
+    if "gzip" in flask.request.accept_encodings:
+        response = flask.send_file(os.path.abspath(COUNTY_GEOJSON_GZIP),
+                                   mimetype="application/json",
+                                   conditional=True)
+        response.headers["Content-Encoding"] = "gzip"
+    else:
+        response = flask.send_file(os.path.abspath(COUNTY_GEOJSON_PATH),
+                                   mimetype="application/json",
+                                   conditional=True)
+    response.vary.add("Accept-Encoding")
+    return response
+# Callback latency and payload metrics, served at /metrics to requests with
+# the METRICS_TOKEN bearer token
+metrics.instrument_app(app)
 ################################################################################
 
 
@@ -318,56 +431,90 @@ def update_output_div(date):
 
 # National Statistics
 @app.callback(
-    Output("H4-national-deaths","children"),
+    [Output("H4-national-deaths","children"),
+     Output("H4-national-cases","children"),
+     Output("H4-national-hospitalized","children")],
     [Input(component_id="date-slider", component_property="value")]
 )
 def update_national_stats(date):
-
-    date = time.strftime("%Y-%m-%d",time.localtime(date))
-    death=data_processing.generate_state_aggregate_stat(
-        COVID_STATES_DF,date,"death")
-    return death
-
-# National Statistics
-@app.callback(
-    Output("H4-national-cases","children"),
-    [Input(component_id="date-slider", component_property="value")]
-)
-def update_national_stats(date):
-
+    ds = dataset.current()
     date = time.strftime("%Y-%m-%d",time.localtime(date))
+    # All three headline numbers from the precomputed national rollup
+    return [data_processing.lookup_national_stat(ds.national_df, date, category)
+            for category in ("death", "positive", "hospitalizedCurrently")]
     
-    positive=data_processing.generate_state_aggregate_stat(
-        COVID_STATES_DF,date,"positive")
     
-    return positive
-
-# National Statistics
+# National Charts
 @app.callback(
-    Output("H4-national-hospitalized","children"),
-    [Input(component_id="date-slider", component_property="value")]
+    [Output("graph-national-deaths","figure"),
+     Output("graph-national-positive","figure"),
+     Output("graph-national-hospitalizedCurrently","figure")],
+    [Input("national-mode","value")],
+    # The layout already holds the default charts
+    prevent_initial_call=True
 )
-def update_national_stats(date):
-
-    date = time.strftime("%Y-%m-%d",time.localtime(date))
-    hospitalizedCurrently=data_processing.generate_state_aggregate_stat(
-        COVID_STATES_DF,date,"hospitalizedCurrently")
-    return hospitalizedCurrently
+def update_national_charts(mode):
+    ds = dataset.current()
+    # Built once per dataset version and mode, then served from the figure cache
+    return [plotting.plot_national_bars(ds.national_matrix, category, mode)
+            for category in ("death", "positive", "hospitalizedCurrently")]
     
     
 # County Choropleth
-@app.callback(
-    Output("county-choropleth","figure"),
-    [Input("county-dropdown","value"),
-     Input("date-slider","value")]
-)
+if STREAM_COUNTY_GEOMETRY:
+    # Only the per-county values go over the wire, and only the changed ones
+    # when the browser already holds the locations ("county-choropleth-held")
+    @app.callback(
+        Output("county-choropleth-values","data"),
+        [Input("county-dropdown","value"),
+         Input("date-slider","value"),
+         Input("county-color-scale","value")],
+        [State("county-choropleth-held","data")]
+    )
+    def update_county_choropleth(category, date, color_scale, held_key):
+        ds = dataset.current()
+        date = time.strftime("%Y-%m-%d",time.localtime(date))
+        values = plotting.county_choropleth_values(ds.county_cube,
+                                                   category,
+                                                   date,
+                                                   color_scale == "stable")
+        return plotting.choropleth_patch(values, held_key)
 
-def update_county_choropleth(category, date):
-    date = time.strftime("%Y-%m-%d",time.localtime(date))
-    return plotting.plot_choropleth_county(COVID_COUNTIES_DF,
-                                             COUNTY_GEOJSON,
-                                             category,
-                                             date)
+    # The geometry is fetched once per page load (assets/choropleth.js)
+    app.clientside_callback(
+        ClientsideFunction(namespace="geometry", function_name="load"),
+        [Output("county-geojson","data"),
+         Output("county-geojson-interval","disabled")],
+        [Input("county-geojson-interval","n_intervals"),
+         Input("county-geojson-url","data")]
+    )
+
+    # Combined with the geojson already in the browser (assets/choropleth.js),
+    # drawn again when the geometry arrives after the values
+    app.clientside_callback(
+        ClientsideFunction(namespace="county", function_name="render_choropleth"),
+        [Output("county-choropleth","figure"),
+         Output("county-choropleth-held","data")],
+        [Input("county-choropleth-values","data"),
+         Input("county-geojson","data")],
+        [State("county-choropleth","figure"),
+         State("county-choropleth-held","data")]
+    )
+else:
+    @app.callback(
+        Output("county-choropleth","figure"),
+        [Input("county-dropdown","value"),
+         Input("date-slider","value"),
+         Input("county-color-scale","value")]
+    )
+    def update_county_choropleth(category, date, color_scale):
+        ds = dataset.current()
+        date = time.strftime("%Y-%m-%d",time.localtime(date))
+        return plotting.plot_choropleth_county(ds.county_cube,
+                                                 COUNTY_GEOJSON,
+                                                 category,
+                                                 date,
+                                                 color_scale == "stable")
 
 # County Scatter
 @app.callback(
@@ -377,28 +524,42 @@ def update_county_choropleth(category, date):
     State("date-slider","value")]
 )
 def update_county_scatter(fips_input,category,slider_date):
+    ds = dataset.current()
     # Convert from epoch time to time struct to string
     slider_date = time.strftime("%Y-%m-%d",time.localtime(slider_date))
     try:
-        fips = fips_input["points"][0]["location"]
+        fips = fips_codec.parse_fips(fips_input["points"][0]["location"])
     except:
-        fips = "01001"
+        fips = 1001
         # plot county scatter
-    scatter = plotting.scatter_deaths_county(COVID_COUNTIES_DF,category,slider_date,fips)
+    scatter = plotting.scatter_deaths_county(ds.county_cube,category,slider_date,fips)
     return scatter
 
 
 # State Choropleth
+# Values only, the figure is built in the browser like the county choropleth
 @app.callback(
-    Output("state-choropleth","figure"),
+    Output("state-choropleth-values","data"),
     [Input("date-slider","value"),
-    Input(component_id="state-dropdown",component_property="value")]
+    Input(component_id="state-dropdown",component_property="value")],
+    [State("state-choropleth-held","data")]
 )
-def update_state_choropleth(date,category):
+def update_state_choropleth(date,category,held_key):
+    ds = dataset.current()
     date = time.strftime("%Y-%m-%d",time.localtime(date))
-    return plotting.plot_choropleth_state(COVID_STATES_DF,
-                                             date,
-                                             category)
+    values = plotting.state_choropleth_values(ds.covid_states_df,
+                                              date,
+                                              category)
+    return plotting.choropleth_patch(values, held_key)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="state", function_name="render_choropleth"),
+    [Output("state-choropleth","figure"),
+     Output("state-choropleth-held","data")],
+    [Input("state-choropleth-values","data")],
+    [State("state-choropleth","figure"),
+     State("state-choropleth-held","data")]
+)
 # State Scatter
 @app.callback(
     Output(component_id="state-scatter", component_property="figure"),
@@ -406,6 +567,7 @@ def update_state_choropleth(date,category):
     [State(component_id="state-dropdown",component_property="value")]
 )
 def update_state_scatter(state_input,category):
+    ds = dataset.current()
     # Check categories to plot daily and cumulative values for each category type
     if category in ("death","deathIncrease"):
         category_tuple = ("deathIncrease","death")
@@ -423,10 +585,108 @@ def update_state_scatter(state_input,category):
         state = "CA"
     
     # Plot State Scatter
-    scatter = plotting.plot_scatter_state(COVID_STATES_DF, state, category_tuple)
+    scatter = plotting.plot_scatter_state(ds.covid_states_df, state, category_tuple, ds.rollup)
     return scatter
 
 
+# Top Hotspots
+def _format(value, pattern):
+    return pattern.format(value) if value == value else "-"
+
+@app.callback(
+    Output("hotspot-table","children"),
+    [Input("date-slider","value")]
+)
+def update_hotspot_table(date):
+    ds = dataset.current()
+    date = time.strftime("%Y-%m-%d",time.localtime(date))
+    # The date's precomputed ranking, no scan over the counties
+    df = hotspots.top_hotspots(ds.hotspots, ds.county_cube, date,
+                               adjacency=COUNTY_ADJACENCY)
+    if df.empty:
+        return html.P(f"No county had rising cases on {date}")
+    header = html.Tr([html.Th(column) for column in
+                      ("Rank", "County", "State", "Daily cases per 100k",
+                       "Change over a week", "Days to double",
+                       "Cluster score (Gi*)")])
+    rows = [html.Tr([html.Td(rank),
+                     html.Td(row.county),
+                     html.Td(row.state),
+                     html.Td(_format(row.incidence, "{:.1f}")),
+                     html.Td(_format(row.week_change, "{:+.0%}")),
+                     html.Td(_format(row.doubling_days, "{:.0f}")),
+                     html.Td(_format(row.cluster_gi, "{:.1f}"))])
+            for rank, row in enumerate(df.itertuples(), start=1)]
+    return html.Table([header] + rows, style={"margin":"auto"})
+
+
+# Time-lapse Maps
+@app.callback(
+    [Output("animation-category","options"),
+     Output("animation-category","value")],
+    [Input("animation-level","value")],
+    [State("animation-category","value")],
+    prevent_initial_call=True
+)
+def update_animation_categories(level, category):
+    options = ANIMATION_CATEGORIES[level]
+    if category not in [option["value"] for option in options]:
+        category = options[0]["value"]
+    return options, category
+
+# The first batch of frames when the animation changes, then the next one
+# whenever the browser is close to the end of what it holds
+@app.callback(
+    Output("animation-frames","data"),
+    [Input("animation-level","value"),
+     Input("animation-category","value"),
+     Input("animation-stride","value"),
+     Input("animation-fetch-interval","n_intervals")],
+    [State("animation-position","data")]
+)
+def update_animation_frames(level, category, stride, n_fetches, position):
+    ds = dataset.current()
+    table = ds.county_frames if level == "counties" else ds.state_frames
+    if category not in table.metric_index:
+        raise PreventUpdate
+    stride = animation.FRAME_STRIDES[stride]
+    key = animation.frames_key(table, level, category, stride)
+    start = 0
+    # Positions from another animation or dataset version start over
+    fetching = dash.callback_context.triggered[0]["prop_id"] == "animation-fetch-interval.n_intervals"
+    if fetching and position and position.get("key") == key:
+        start = animation.next_batch_start(position, key)
+        if start is None:
+            raise PreventUpdate
+    return animation.frame_batch(table, level, category, stride, start)
+
+# Playback runs in the browser (assets/animation.js)
+app.clientside_callback(
+    ClientsideFunction(namespace="animation", function_name="merge_frames"),
+    Output("animation-buffer","data"),
+    [Input("animation-frames","data")],
+    [State("animation-buffer","data")]
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="animation", function_name="play"),
+    [Output("animation-choropleth","figure"),
+     Output("animation-position","data")],
+    [Input("animation-interval","n_intervals"),
+     Input("animation-buffer","data")],
+    [State("animation-position","data")]
+    + ([State("county-geojson","data")] if STREAM_COUNTY_GEOMETRY else [])
+)
+
+app.clientside_callback(
+    ClientsideFunction(namespace="animation", function_name="toggle"),
+    [Output("animation-interval","disabled"),
+     Output("animation-fetch-interval","disabled"),
+     Output("animation-play","children")],
+    [Input("animation-play","n_clicks")]
+)
+
+
 if __name__ == "__main__":
     app.run_server(debug=True, use_reloader = True)
 
@@ -0,0 +1,136 @@
+import numpy as np
+import pandas as pd
+
+from modules import county_store
+from modules import fips as fips_codec
+from modules import kernels
+
+
+################################################################################
+# Animation Frames
+# The time-lapse maps are played in the browser from compact per-frame value
+# arrays. Each level (counties or states) is held as a location x day array
+# per metric, the frames of the animation, and frames are sent in batches of
+# FRAME_BATCH as playback reaches the end of what the browser has, instead of
+# one figure holding every frame. Locations and hover text go with the first
+# batch only.
+
+# Frames sent per batch
+FRAME_BATCH = 16
+
+# Days between frames for each stride option
+FRAME_STRIDES = {'daily': 1, 'weekly': 7}
+
+# Values are rounded before sending, the colour scale does not need more
+FRAME_DECIMALS = 1
+
+# Milliseconds each frame is shown during playback
+FRAME_INTERVAL_MS = 400
+
+# Milliseconds between checks for the next batch during playback, twice per
+# batch played
+FETCH_INTERVAL_MS = FRAME_BATCH * FRAME_INTERVAL_MS // 2
+
+
+class FrameTable:
+    '''Values of one map level as (metric, location, day) arrays, NaN where a
+    location did not report, and their per-date colour quantiles as in the
+    county cube.'''
+
+    def __init__(self, locations, text, dates, metrics, values, version = None, quantiles = None):
+        self.locations = locations
+        self.text = text
+        self.dates = dates
+        self.metrics = list(metrics)
+        self.values = values
+        self.version = version
+        if quantiles is None:
+            quantiles = kernels.location_quantiles(values, county_store.COLOR_QUANTILES)
+        self.quantiles = quantiles
+
+        self.metric_index = {metric: i for i, metric in enumerate(self.metrics)}
+
+    def frame_offsets(self, stride = 1):
+        '''Day offsets of the frames, stepping back from the latest day so it
+        is always the last frame.'''
+        return np.arange(len(self.dates) - 1, -1, -stride)[::-1]
+
+    def color_range(self, metric):
+        '''(zmin, zmax) for every frame, so colours mean the same throughout.'''
+        zmin, zmax = county_store.stable_color_bounds(self.quantiles[self.metric_index[metric]])
+        if zmin != zmin:
+            return (0.0, 1.0)
+        return (float(round(zmin, -1)), float(round(zmax, -1)))
+
+
+def county_frames(cube):
+    '''FrameTable of the counties, sharing the county cube's arrays.'''
+    return FrameTable(fips_codec.format_fips(cube.fips),
+                      cube.county_names,
+                      cube.dates,
+                      cube.metrics,
+                      cube.values,
+                      getattr(cube, 'version', None),
+                      cube.quantiles)
+
+
+def state_frames(covid_states_df, metrics = None):
+    '''FrameTable of the states, scattered from the long state frame in one pass.'''
+    if metrics is None:
+        metrics = [column for column in covid_states_df.columns if column not in ('date', 'state')]
+    state_idx, states = pd.factorize(covid_states_df['state'], sort=True)
+    dates = covid_states_df['date'].values.astype('datetime64[D]')
+    start_date = dates.min()
+    day_idx = (dates - start_date).astype(np.int64)
+    n_days = int(day_idx.max()) + 1
+
+    values = np.full((len(metrics), len(states), n_days), np.nan, dtype=np.float32)
+    for i, metric in enumerate(metrics):
+        values[i, state_idx, day_idx] = covid_states_df[metric].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    states = np.asarray(states, dtype=str)
+    return FrameTable(states, states, start_date + np.arange(n_days), metrics, values,
+                      covid_states_df.attrs.get('version'))
+
+
+def frames_key(table, level, metric, stride):
+    '''Key naming one animation, a batch only extends frames of the same key.'''
+    return f'{table.version}:{level}:{metric}:{stride}'
+
+
+def next_batch_start(position, key):
+    '''Start of the batch to send a browser playing at position, None when it
+    has a batch or more still to play or holds every frame.'''
+    if not position or position.get('key') != key or position.get('next') is None:
+        return None
+    if position['loaded'] - position['frame'] > FRAME_BATCH:
+        return None
+    return position['next']
+
+
+def frame_batch(table, level, metric, stride = 1, start = 0, size = FRAME_BATCH):
+    '''Return frames [start, start + size) of an animation as a dict of
+    {key, level, start, next, total, dates, z, zmin, zmax, category}, with
+    locations and text on the first batch. next is None after the last batch.'''
+    offsets = table.frame_offsets(stride)
+    start = min(max(int(start), 0), len(offsets))
+    batch = offsets[start:start + size]
+    # (frame, location), one row per frame
+    z = np.round(table.values[table.metric_index[metric]][:, batch].T.astype(np.float64), FRAME_DECIMALS)
+    zmin, zmax = table.color_range(metric)
+    frames = {
+        'key': frames_key(table, level, metric, stride),
+        'level': level,
+        'start': start,
+        'next': start + len(batch) if start + len(batch) < len(offsets) else None,
+        'total': len(offsets),
+        'dates': np.datetime_as_string(table.dates[batch], unit='D'),
+        'z': z,
+        'zmin': zmin,
+        'zmax': zmax,
+        'category': metric
+    }
+    if start == 0:
+        frames['locations'] = table.locations
+        frames['text'] = table.text
+    return frames
@@ -0,0 +1,194 @@
+import numpy as np
+import pandas as pd
+
+from modules import fips as fips_codec
+from modules import kernels
+
+
+################################################################################
+# County Cube
+
+# Metrics held in the cube, in metric axis order.
+CUBE_METRICS = ['cases',
+                'deaths',
+                'casesPerMillion',
+                'deathsPerMillion',
+                'case_diff',
+                'death_diff',
+                'cases_14MA',
+                'deaths_14MA']
+
+# Quantiles of every date's values kept for the map colour scales, the deciles
+# plus the colour scale bounds
+COLOR_QUANTILES = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.975)
+COLOR_BOUNDS = (0.1, 0.975)
+
+
+class CountyCube:
+    '''Dense county x day x metric array built once from the county frame.
+
+    values has shape (metric, county, day) so a county series is a contiguous
+    row and a date slice is a single strided column. Counties are looked up by
+    integer fips code and addressed by ordinal (position in the sorted fips
+    array), days by offset from start_date. present marks which (county, day)
+    pairs had a row. quantiles holds the COLOR_QUANTILES of every (metric, day)
+    over the counties, computed from values when not given. population is the
+    2019 population estimate of each county, NaN when unknown.
+
+    Rows without a county fips (NYT's "Unknown" counties, New York City and
+    the other geographic exceptions) are not counties on the map, but they
+    count towards their state. unallocated_values holds their (metric, state,
+    day) sums per unallocated_states name, NaN on days a state had none.'''
+
+    def __init__(self, fips, county_names, state_names, start_date, metrics, values, present,
+                 quantiles=None, population=None, unallocated_states=None, unallocated_values=None):
+        self.fips = fips
+        self.county_names = county_names
+        self.state_names = state_names
+        self.start_date = np.datetime64(start_date, 'D')
+        self.metrics = list(metrics)
+        self.values = values
+        self.present = present
+        if quantiles is None:
+            quantiles = kernels.location_quantiles(values, COLOR_QUANTILES)
+        self.quantiles = quantiles
+        if population is None:
+            population = np.full(len(fips), np.nan, dtype=np.float32)
+        self.population = population
+        if unallocated_states is None:
+            unallocated_states = np.empty(0, dtype=str)
+            unallocated_values = np.full((len(metrics), 0, values.shape[2]), np.nan, dtype=np.float32)
+        self.unallocated_states = unallocated_states
+        self.unallocated_values = unallocated_values
+
+        self.metric_index = {metric: i for i, metric in enumerate(self.metrics)}
+        self.fips_index = {int(code): i for i, code in enumerate(fips)}
+        self.dates = self.start_date + np.arange(values.shape[2])
+
+    @property
+    def end_date(self):
+        return self.dates[-1]
+
+    def county_ordinal(self, fips):
+        '''Return the ordinal of a county, or None if it has no data.'''
+        return self.fips_index.get(fips)
+
+    def day_offset(self, date):
+        '''Return the day offset of a date, or None if it is out of range.'''
+        offset = int((np.datetime64(date, 'D') - self.start_date).astype(int))
+        if 0 <= offset < len(self.dates):
+            return offset
+        return None
+
+    def county_series(self, fips, metric):
+        '''Return (dates, values) of one metric for one county. O(days).'''
+        ordinal = self.county_ordinal(fips)
+        if ordinal is None:
+            return self.dates[:0], self.values[0, 0, :0]
+        return self.dates, self.values[self.metric_index[metric], ordinal]
+
+    def county_name(self, fips):
+        '''Return the (county, state) names of a county.'''
+        ordinal = self.county_ordinal(fips)
+        if ordinal is None:
+            return '', ''
+        return self.county_names[ordinal], self.state_names[ordinal]
+
+    def date_slice(self, date, metric):
+        '''Return (fips, county names, values) of one metric for every county
+        reporting on date. O(counties).'''
+        offset = self.day_offset(date)
+        if offset is None:
+            mask = np.zeros(len(self.fips), dtype=bool)
+            return self.fips[mask], self.county_names[mask], self.values[0, mask, 0]
+        mask = self.present[:, offset]
+        values = self.values[self.metric_index[metric], :, offset]
+        return self.fips[mask], self.county_names[mask], values[mask]
+
+    def date_quantiles(self, date, metric, levels=COLOR_QUANTILES):
+        '''Return the quantiles at levels of one metric over the counties
+        reporting on date, NaN when the date has no values. O(1).'''
+        columns = [COLOR_QUANTILES.index(level) for level in levels]
+        offset = self.day_offset(date)
+        if offset is None:
+            return np.full(len(columns), np.nan)
+        return self.quantiles[self.metric_index[metric], offset, columns].astype(float)
+
+    def color_bounds(self, date, metric, stable=False):
+        '''Return the (zmin, zmax) colour scale bounds of one metric on date,
+        or the same bounds for every date when stable: the lowest lower and
+        highest upper bound over all dates. O(1) per date, O(days) stable.'''
+        if not stable:
+            return tuple(float(bound) for bound in self.date_quantiles(date, metric, COLOR_BOUNDS))
+        return stable_color_bounds(self.quantiles[self.metric_index[metric]])
+
+
+def stable_color_bounds(quantiles):
+    '''Return (zmin, zmax) covering every date of a (day, COLOR_QUANTILES)
+    table: the lowest lower bound and the highest upper bound.'''
+    low, high = (quantiles[:, COLOR_QUANTILES.index(level)] for level in COLOR_BOUNDS)
+    if np.isnan(low).all() or np.isnan(high).all():
+        return (np.nan, np.nan)
+    return (float(np.nanmin(low)), float(np.nanmax(high)))
+
+
+def _unallocated(df, metrics, start_date, n_days):
+    # (state names, (metric, state, day) sums) of rows without a county fips,
+    # a state can have several of them per day
+    state_idx, states = pd.factorize(df['state'].astype(str), sort=True)
+    day_idx = (df['date'].values.astype('datetime64[D]') - start_date).astype(np.int64)
+    values = np.full((len(metrics), len(states), n_days), np.nan, dtype=np.float32)
+    for i, metric in enumerate(metrics):
+        column = df[metric].to_numpy(dtype=np.float64, na_value=np.nan)
+        reported = np.isfinite(column)
+        sums = np.zeros((len(states), n_days))
+        counts = np.zeros((len(states), n_days), dtype=np.int64)
+        np.add.at(sums, (state_idx[reported], day_idx[reported]), column[reported])
+        np.add.at(counts, (state_idx[reported], day_idx[reported]), 1)
+        values[i] = np.where(counts > 0, sums, np.nan)
+    return np.asarray(states, dtype=str), values
+
+
+def build_county_cube(df, metrics=CUBE_METRICS):
+    '''Build a CountyCube from the long county frame in one pass.'''
+    print("Building county cube")
+    # Days span every row, rows without a county fips included
+    all_dates = df['date'].values.astype('datetime64[D]')
+    start_date = all_dates.min()
+    n_days = int((all_dates.max() - start_date).astype(np.int64)) + 1
+
+    # Rows without a county fips (e.g. "Unknown") cannot be placed on a map,
+    # they are summed per state instead
+    missing = (df['fips'] == fips_codec.MISSING_FIPS).to_numpy()
+    unallocated_states, unallocated_values = _unallocated(
+        df[missing], metrics, start_date, n_days)
+    df = df[~missing]
+
+    # Ordinals for counties and offsets for days
+    county_idx, fips_codes = pd.factorize(df['fips'], sort=True)
+    dates = all_dates[~missing]
+    day_idx = (dates - start_date).astype(np.int64)
+    n_counties = len(fips_codes)
+
+    # Scatter every metric column into place
+    values = np.full((len(metrics), n_counties, n_days), np.nan, dtype=np.float32)
+    for i, metric in enumerate(metrics):
+        values[i, county_idx, day_idx] = df[metric].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    present = np.zeros((n_counties, n_days), dtype=bool)
+    present[county_idx, day_idx] = True
+
+    # Latest name for each county, rows are in date order so the last one wins
+    county_names = np.empty(n_counties, dtype=object)
+    state_names = np.empty(n_counties, dtype=object)
+    county_names[county_idx] = df['county'].astype(str).to_numpy()
+    state_names[county_idx] = df['state'].astype(str).to_numpy()
+
+    population = np.full(n_counties, np.nan, dtype=np.float32)
+    if 'POPESTIMATE2019' in df.columns:
+        population[county_idx] = df['POPESTIMATE2019'].to_numpy(dtype=np.float32, na_value=np.nan)
+
+    return CountyCube(np.asarray(fips_codes, dtype=fips_codec.FIPS_DTYPE), county_names, state_names,
+                      start_date, metrics, values, present, population=population,
+                      unallocated_states=unallocated_states,
+                      unallocated_values=unallocated_values)
@@ -1,78 +1,83 @@
 import pandas as pd
-import numpy as np
-import geopandas as gpd
 
-
-import requests
+import gzip
 import json
+import shutil
 from urllib.request import urlopen
 import time
 import datetime
+from io import BytesIO
 
+import os
 from os import path
 
 from google.cloud import storage
 
+from modules import snapshot
+from modules import fips
+from modules import fetch
+from modules import kernels
+from modules.source_cache import SourceCache
+
 
 ################################################################################
 # Geojson Data
 
 # Get map of US Counties. Here we need FIPS codes and polygons.
+COUNTY_GEOJSON_PATH = 'data/county_geojson.json'
 
-def load_county_geojson():
+def county_geojson_path():
+    '''Return the path of the county geojson file, downloading it first if
+    it is not on disk.'''
     # Check if geojson file exists
-    if path.exists('data/county_geojson.json'):
-        # Load from file
-        print("Pulling geojson from file.")
-        with open('data/county_geojson.json','r') as fout:
-            county_geojson = json.load(fout)
-    else:
+    if not path.exists(COUNTY_GEOJSON_PATH):
         # Download from plotly
         print("Pulling geojson from Plotly.")
         county_geojson_url = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
         
         with urlopen(county_geojson_url) as response:
-            county_geojson = json.load(response)
-        
-        #Write to file
-        with open('data/county_geojson.json','w') as fout:
-            json.dump(county_geojson, fout)
+            raw = response.read()
+        
+        # Write to file, renamed into place so workers starting together
+        # never read a half written file
+        with open(COUNTY_GEOJSON_PATH + '.tmp','wb') as fout:
+            fout.write(raw)
+        os.replace(COUNTY_GEOJSON_PATH + '.tmp', COUNTY_GEOJSON_PATH)
+    return COUNTY_GEOJSON_PATH
+
+def county_geojson_gzip_path():
+    '''Return the path of a gzipped copy of the county geojson file, written
+    once next to it, for serving the geometry to browsers.'''
+    source = county_geojson_path()
+    target = source + '.gz'
+    if not path.exists(target) or path.getmtime(target) < path.getmtime(source):
+        with open(source,'rb') as fin, gzip.open(target + '.tmp','wb') as fout:
+            shutil.copyfileobj(fin, fout)
+        os.replace(target + '.tmp', target)
+    return target
+
+def load_county_geojson():
+    # Load from file
+    print("Pulling geojson from file.")
+    with open(county_geojson_path(),'r') as fin:
+        county_geojson = json.load(fin)
     return county_geojson
 
 ################################################################################
 # Census Data
 
-# Function to generate fips from a state int and county int.
-def generate_fips(state_fips, county_fips):
-    state_str, county_str = str(state_fips), str(county_fips)
-    
-    # Check length of state code and append 0's if necessary.
-    if len(state_str) == 1:
-        state_str = "0"+state_str
-        
-    # Check length of county code and append 0's if necessary.
-    if len(county_str) == 1:
-        county_str = "00"+county_str
-    elif len(county_str) == 2:
-        county_str = "0"+county_str
-        
-    return state_str+county_str
-
-def get_census_county_data():
-    # URL coming from census.gov as ISO encoded csv
-    url = 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/totals/co-est2019-alldata.csv'
+def get_census_county_data(raw = None):
+    '''raw: bytes of the census.gov csv, downloaded if None'''
+    # Bytes coming from census.gov as ISO encoded csv
+    if raw is None:
+        raw = fetch.fetch_sources(['census_counties'])['census_counties']
     
     # Read in the data to dataframe
-    census_df = pd.read_csv(url, encoding = "ISO-8859-1")
+    census_df = pd.read_csv(BytesIO(raw), encoding = "ISO-8859-1")
     
 
-    # Use apply across rows to generate fips codes.
-    census_df['FIPS'] = census_df[['STATE','COUNTY']].apply(
-        lambda x:generate_fips(
-            x['STATE'],
-            x['COUNTY']
-        ), axis=1
-    )
+    # Integer fips codes from the state and county columns
+    census_df['FIPS'] = fips.encode_fips(census_df['STATE'], census_df['COUNTY'])
     # Define features
     features = ['FIPS',
                 'STATE',
@@ -86,60 +91,59 @@ def get_census_county_data():
 # County Covid Data
 
 # Get covid data at a county level.
-def get_covid_county_data(cache_mode = 1):
+def get_covid_county_data(cache_mode = 1, columns = None, raw_sources = None):
     '''Function to return covid county data from nytimes github\n
     https://raw.githubusercontent.com/nytimes/covid-19-data
     
-    cache_mode: {0: No caching, 1: Read only caching, 2: Read/write caching}'''
+    cache_mode: {0: No caching, 1: Read only caching, 2: Read/write caching,
+            3: Read from GCS bucket, only reads from GCS}
+    columns: list of columns to load from a snapshot, None loads them all
+    raw_sources: already fetched {source name: bytes}, see modules.fetch'''
     
     print("Retrieving Covid County data")
-    # Set NYT github covid-19 data url
+    source_names = ['nyt_counties', 'census_counties']
     
-    today = time.strftime('%Y%m%d')
-    filepath = f'data/covid_counties_{today}.csv.gz'
+    filepath = None
+    if cache_mode in (1,2):
+        if cache_mode == 1:
+            # Read only, sources the source cache holds are not downloaded
+            raw_sources = fetch.cached_sources(raw_sources, source_names, SourceCache())
+        else:
+            # Conditional downloads, unchanged sources come from the source cache
+            raw_sources = fetch.ensure_sources(raw_sources, source_names, SourceCache())
+        # Cached output is keyed by the content of its sources
+        filepath = f'data/covid_counties_{fetch.content_key(raw_sources, source_names)}.parquet'
     
     if cache_mode == 3:    
         
         bucket_name = 'us_covid_hotspot-bucket'
-        blob_name = "covid_counties.csv.gz"
-        blob_uri = f"gs://{bucket_name}/{blob_name}"
-        print(f"Pulling county data from GCS [{blob_uri}]")
-        
-        # Get the client object to make the request
         client = storage.Client()
-    
-        df = pd.read_csv(blob_uri, compression = 'gzip')
-        
-        # Set date format
-        df['date'] = pd.to_datetime(df['date'], format = '%Y-%m-%d')
+        manifest = snapshot.parse_manifest(
+            client.bucket(bucket_name).blob(snapshot.COUNTY_MANIFEST).download_as_text())
+        blob_uris = [f"gs://{bucket_name}/{blob_name}" for blob_name in manifest['parts']]
+        print(f"Pulling county data from GCS [{len(blob_uris)} parts of "
+              f"gs://{bucket_name}/{snapshot.COUNTY_PARTS_PREFIX}]")
         
-        # Reassign our fips to be a string of length 5
-        df['fips'] = df['fips'].astype(str).apply(lambda x: '0'+x[:4] if len(x) == 6 else x[:5])
+        # Typed snapshot parts, dates and fips are stored ready to use
+        df = snapshot.read_snapshot_parts(blob_uris, columns = columns)
         
-    elif (path.exists(filepath) and cache_mode in (1,2)):
+    elif filepath is not None and path.exists(filepath):
         
         print("Pulling county data from file.")
         
         # Read in data from file
-        df = pd.read_csv(filepath, compression = 'gzip')
-        
-        # Set date format
-        df['date'] = pd.to_datetime(df['date'], format = '%Y-%m-%d')
-        
-        # Reassign our fips to be a string of length 5
-        df['fips'] = df['fips'].astype(str).apply(lambda x: '0'+x[:4] if len(x) == 6 else x[:5])
-        
+        df = snapshot.read_snapshot(filepath, columns = columns)
         
     else:
         print("Pulling county data from github.")
-        # NYT covid-19 github url
-        url = 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'
+        # NYT covid-19 github and census data, downloaded concurrently
+        raw_sources = fetch.ensure_sources(raw_sources, source_names)
         
         # Read in data from github
-        df = pd.read_csv(url)
+        df = pd.read_csv(BytesIO(raw_sources['nyt_counties']))
         
-        # Reassign our fips to be a string of length 5
-        df['fips'] = df['fips'].astype(str).apply(lambda x: '0'+x[:4] if len(x) == 6 else x[:5])
+        # Integer fips codes, MISSING_FIPS for unknown counties
+        df['fips'] = fips.normalize_fips(df['fips'])
 
         # Set date format
         df['date'] = pd.to_datetime(df['date'], format = '%Y-%m-%d')
@@ -152,7 +156,7 @@ def get_covid_county_data(cache_mode = 1):
 
          
         # Get Census data and Merge dataframes on fips
-        df = df.merge(get_census_county_data(),
+        df = df.merge(get_census_county_data(raw_sources['census_counties']),
                         how='left',
                         left_on='fips',
                         right_on='FIPS')
@@ -165,30 +169,20 @@ def get_covid_county_data(cache_mode = 1):
         df['deathsPerMillion']=df['deaths']/df['POPESTIMATE2019']*1000000
         #df['log_deathsPerMillion']= np.log(df['deathsPerMillion']+1)
         
-        # New Cases by day
-        #df['case_diff'] = df.sort_values(by=['fips','state','county','date'])['cases'].diff()
-        
-         
-        df['case_diff'] = df.groupby(
-                by = ['fips','county','state'])['cases'].diff()
-
-        #df['case_pm_diff'] = df.sort_values(by=['fips','state','county','date'])['casesPerMillion'].diff()
-        
-        # New Deaths by day
-        df['death_diff'] = df.groupby(
-                by = ['fips','county','state'])['deaths'].diff()
-        
-         
-        df["cases_14MA"] = df.groupby(
-            by=['fips','county','state'], 
-            as_index=False)['case_diff'].rolling(14).mean().reset_index(level=0, drop=True)
-
-        df["deaths_14MA"] = df.groupby(
-            by=['fips','county','state'], 
-            as_index=False)['death_diff'].rolling(14).mean().reset_index(level=0, drop=True)
+        # New cases and deaths by day and their 14 day moving averages,
+        # computed for every county in one pass
+        df = kernels.add_diffs_and_averages(df,
+            keys = ['fips','county','state'],
+            diffs = {'case_diff': 'cases',
+                     'death_diff': 'deaths'},
+            averages = {'cases_14MA': ('case_diff', 14),
+                        'deaths_14MA': ('death_diff', 14)})
         if cache_mode == 2:
             # Write to file
-            df.to_csv(filepath, index=False, compression='gzip')
+            snapshot.write_snapshot(df, filepath, snapshot.COUNTY_DTYPES)
+        
+        if columns is not None:
+            df = df[columns]
     
     return df
 
@@ -196,46 +190,52 @@ def get_covid_county_data(cache_mode = 1):
 # State Covid Data
 
 # Get state covid data from Covid Tracking Project's API
-def get_covid_state_data(cache_mode = 1):
+def get_covid_state_data(cache_mode = 1, columns = None, raw_sources = None):
     ''' Returns a time series dataframe with updated coronavirus numbers from each state.
     
     cache_mode: {0: No cache, reads from source,
             1: Read Only Cache, checks local file system,
             2: Read/Write cache, checks filesystem and updates filesystem,
-            3: Read from GCS bucket, only reads from GCS}'''
-    today = time.strftime('%Y%m%d')
-    filepath = f'data/covid_states_{today}.csv.gz'
+            3: Read from GCS bucket, only reads from GCS}
+    columns: list of columns to load from a snapshot, None loads them all
+    raw_sources: already fetched {source name: bytes}, see modules.fetch'''
+    source_names = ['covid_tracking_states']
+    
+    filepath = None
+    if cache_mode in (1,2):
+        if cache_mode == 1:
+            # Read only, sources the source cache holds are not downloaded
+            raw_sources = fetch.cached_sources(raw_sources, source_names, SourceCache())
+        else:
+            # Conditional downloads, unchanged sources come from the source cache
+            raw_sources = fetch.ensure_sources(raw_sources, source_names, SourceCache())
+        # Cached output is keyed by the content of its sources
+        filepath = f'data/covid_states_{fetch.content_key(raw_sources, source_names)}.parquet'
     
     if cache_mode == 3:
         print("Pulling state data from Cloud Storage")
         bucket_name = 'us_covid_hotspot-bucket'
-        blob_name = "covid_states.csv.gz"
+        blob_name = "covid_states.parquet"
         blob_uri = f"gs://{bucket_name}/{blob_name}"
         print(blob_uri)
         
-        # Get the client object to make the request
-        client = storage.Client()
-    
-        covid_states_df = pd.read_csv(blob_uri, compression = 'gzip')
+        covid_states_df = snapshot.read_snapshot(blob_uri, columns = columns)
         
-    elif (path.exists(filepath) and cache_mode in (1,2)):
+    elif filepath is not None and path.exists(filepath):
         print("Pulling state data from file.")
-        covid_states_df = pd.read_csv(filepath, compression = 'gzip')
-        
-        # Data Cleaning
-        covid_states_df['date'] = pd.to_datetime(covid_states_df['date'], format="%Y-%m-%d")
+        covid_states_df = snapshot.read_snapshot(filepath, columns = columns)
         
     else:
         print("Pulling state data from Covid Tracking API")
         
         # Coronavirus data by state from covidtracking API
-        states_url = "https://covidtracking.com/api/states/daily"
+        raw_sources = fetch.ensure_sources(raw_sources, source_names)
         
-        with requests.get(states_url) as response:
-            covid_states_df = pd.DataFrame.from_records(
-                response.json(),
-                index = range(len(response.json()))
-            )
+        records = json.loads(raw_sources['covid_tracking_states'])
+        covid_states_df = pd.DataFrame.from_records(
+            records,
+            index = range(len(records))
+        )
 
         # Set date as datetime format
         covid_states_df['date'] = pd.to_datetime(covid_states_df['date'], format="%Y%m%d")
@@ -254,30 +254,38 @@ def get_covid_state_data(cache_mode = 1):
         covid_states_df['death_pm'] = covid_states_df['death']/covid_states_df['Pop']*1000000
         
         # Daily Increase Moving Averages
-        covid_states_df["deaths_14MA"] = covid_states_df.groupby(
-            by=['state'], 
-            as_index=False
-        )['deathIncrease'].rolling(14).mean().reset_index(level=0, drop=True)
-        
-        covid_states_df["cases_14MA"] = covid_states_df.groupby(
-            by=['state'], 
-            as_index=False
-        )['positiveIncrease'].rolling(14).mean().reset_index(level=0, drop=True)
-        
-        
+        covid_states_df = kernels.add_diffs_and_averages(covid_states_df,
+            keys = ['state'],
+            averages = {'deaths_14MA': ('deathIncrease', 14),
+                        'cases_14MA': ('positiveIncrease', 14)})
         
         if cache_mode == 2:
-            covid_states_df.to_csv(filepath, index=False, compression='gzip')
+            snapshot.write_snapshot(covid_states_df, filepath, snapshot.STATE_DTYPES)
+        
+        if columns is not None:
+            covid_states_df = covid_states_df[columns]
             
     return covid_states_df
 
-def generate_slider_dates(df):
+# Version of the published snapshots, changes whenever either is rewritten
+def get_snapshot_version():
+    '''Returns a version string built from the GCS generations of the county
+    snapshot's manifest and the state snapshot.'''
+    bucket_name = 'us_covid_hotspot-bucket'
+    
+    client = storage.Client()
+    bucket = client.bucket(bucket_name)
+    generations = [str(bucket.get_blob(blob_name).generation)
+                   for blob_name in (snapshot.COUNTY_MANIFEST, "covid_states.parquet")]
+    return "-".join(generations)
+
+def generate_slider_dates(max_date):
     # Hardcode a start date
     start_date = '2020-03-01'
     start_date_int = int(time.mktime(datetime.datetime.strptime(start_date, '%Y-%m-%d').timetuple()))
 
-    # Get max date from df
-    max_date_int = int(time.mktime(df['date'].max().timetuple()))
+    # Latest date in the data
+    max_date_int = int(time.mktime(pd.Timestamp(max_date).timetuple()))
 
     # Create a list of dates from max to min, going back 2 weeks each time
     date_list = range(max_date_int, start_date_int, -(14*24*60*60))
@@ -301,6 +309,46 @@ def generate_state_aggregate_stat(covid_states_df, date, category):
     stat = int(covid_states_df[date_mask][category].sum())
     return f"{stat:,d}"
 
+# Stat categories rolled up to national totals
+NATIONAL_CATEGORIES = ['death',
+                       'deathIncrease',
+                       'positive',
+                       'positiveIncrease',
+                       'hospitalizedCurrently',
+                       'hospitalizedCumulative',
+                       'hospitalizedIncrease']
+
+# Build the national rollup once at data load
+def generate_national_rollup(covid_states_df, categories = NATIONAL_CATEGORIES):
+    '''Returns a dataframe indexed by date with the national total of every
+    stat category, so headline stats are a lookup instead of a scan.'''
+    categories = [category for category in categories if category in covid_states_df.columns]
+    national_df = covid_states_df.groupby(by = 'date')[categories].sum()
+    national_df.index = pd.to_datetime(national_df.index)
+    return national_df
+
+# Build the date x state matrix behind the national charts once at data load
+def generate_national_matrix(covid_states_df, categories = NATIONAL_CATEGORIES):
+    '''Returns a dataframe indexed by date with a (category, state) column for
+    every stat category and state, missing reports filled with 0.'''
+    categories = [category for category in categories if category in covid_states_df.columns]
+    matrix = covid_states_df.pivot_table(index = 'date',
+                                         columns = 'state',
+                                         values = categories,
+                                         aggfunc = 'sum',
+                                         observed = True)
+    matrix.index = pd.to_datetime(matrix.index)
+    return matrix.sort_index().fillna(0)
+
+# Look up a formatted national stat for a date
+def lookup_national_stat(national_df, date, category):
+    try:
+        stat = int(national_df.at[pd.Timestamp(date), category])
+    except KeyError:
+        # No states reported on this date
+        stat = 0
+    return f"{stat:,d}"
+
 
 ################################################################################
 # Other
@@ -0,0 +1,145 @@
+import os
+import threading
+import time
+from collections import namedtuple
+
+from modules import animation
+from modules import county_store
+from modules import data_processing
+from modules import metrics
+from modules import plotting
+from modules import rollup
+from modules import shared_store
+from modules import snapshot
+
+
+################################################################################
+# Dataset
+# All callbacks read one immutable Dataset through current(). A background
+# thread polls the GCS snapshots, builds a complete new Dataset off the request
+# path and swaps the single reference, so a request that grabbed the old one
+# keeps a consistent view and no request waits on a reload.
+
+# Seconds between checks for a new snapshot in the bucket
+REFRESH_SECONDS = int(os.environ.get('DATA_REFRESH_SECONDS', 600))
+
+Dataset = namedtuple('Dataset', ['version',
+                                 'county_cube',
+                                 'covid_states_df',
+                                 'national_df',
+                                 'national_matrix',
+                                 'county_frames',
+                                 'state_frames',
+                                 'hotspots',
+                                 'rollup'])
+
+_current = None
+
+
+def _load_snapshots():
+    # Get county coronavirus data
+    with metrics.timed('read_county_snapshot'):
+        covid_counties_df = data_processing.get_covid_county_data(cache_mode = 3,
+            columns = snapshot.COUNTY_COLUMNS)
+    with metrics.timed('compact_county'):
+        covid_counties_df = snapshot.compact_frame(covid_counties_df,
+            snapshot.COUNTY_COMPACT_DTYPES, 'county')
+    # Dense county x day x metric store used by the county plots
+    with metrics.timed('build_county_cube'):
+        county_cube = county_store.build_county_cube(covid_counties_df)
+
+    # Get state coronavirus data
+    with metrics.timed('read_state_snapshot'):
+        covid_states_df = data_processing.get_covid_state_data(cache_mode = 3,
+            columns = snapshot.STATE_COLUMNS)
+    with metrics.timed('compact_state'):
+        covid_states_df = snapshot.compact_frame(covid_states_df,
+            snapshot.STATE_COMPACT_DTYPES, 'state')
+    return county_cube, covid_states_df
+
+
+def load(version):
+    '''Load a snapshot version and build everything derived from it.'''
+    # The first worker loads the data into memory-mapped files, the others map them
+    with metrics.timed('materialize', version = version):
+        county_cube, covid_states_df, county_rollup, hotspot_table = shared_store.materialize(
+            version, _load_snapshots)
+
+    # Tag the data so cached figures are keyed on the version they came from
+    county_cube.version = version
+    covid_states_df.attrs['version'] = version
+
+    with metrics.timed('national_rollup'):
+        national_df = data_processing.generate_national_rollup(covid_states_df)
+        national_matrix = data_processing.generate_national_matrix(covid_states_df)
+        national_matrix.attrs['version'] = version
+
+    # Per-frame arrays of the time-lapse maps
+    with metrics.timed('animation_frames'):
+        county_frames = animation.county_frames(county_cube)
+        state_frames = animation.state_frames(covid_states_df)
+
+    # The NYT state rollups against the Covid Tracking series they stand beside
+    with metrics.timed('rollup_check'):
+        check = rollup.compare_covid_tracking(county_rollup, covid_states_df)
+        for metric, rows in check.groupby('metric', sort = False):
+            difference = rows['relative_difference'].abs()
+            metrics.log('rollup_check',
+                        metric = metric,
+                        states = int(difference.notna().sum()),
+                        median_relative_difference = round(float(difference.median()), 4),
+                        max_relative_difference = round(float(difference.max()), 4))
+
+    return Dataset(version = version,
+                   county_cube = county_cube,
+                   covid_states_df = covid_states_df,
+                   national_df = national_df,
+                   national_matrix = national_matrix,
+                   county_frames = county_frames,
+                   state_frames = state_frames,
+                   hotspots = hotspot_table,
+                   rollup = county_rollup)
+
+
+def current():
+    '''Return the current Dataset. Hold on to it for the whole request.'''
+    return _current
+
+
+def swap(dataset):
+    '''Make dataset the current one for all new requests.'''
+    global _current
+    # A single reference assignment, atomic for readers
+    _current = dataset
+    plotting.set_dataset_version(dataset.version)
+    print(f"Serving dataset version {dataset.version}")
+
+
+def refresh():
+    '''Swap in the latest snapshot if the bucket has a new one.'''
+    with metrics.timed('check_version'):
+        version = data_processing.get_snapshot_version()
+    if _current is None or version != _current.version:
+        with metrics.timed('load', version = version):
+            dataset = load(version)
+        swap(dataset)
+
+
+def _refresh_loop(interval):
+    while True:
+        time.sleep(interval)
+        try:
+            refresh()
+        except Exception as error:
+            # Keep serving the current dataset and try again next time
+            print(f"Dataset refresh failed: {error}")
+
+
+def start_refresher(interval = REFRESH_SECONDS):
+    '''Start the background thread polling for new snapshots.'''
+    thread = threading.Thread(target = _refresh_loop,
+                              args = (interval,),
+                              name = 'dataset-refresher',
+                              daemon = True)
+    thread.start()
+    return thread
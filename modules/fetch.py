@@ -0,0 +1,130 @@
+import asyncio
+import hashlib
+import time
+
+import aiohttp
+
+
+################################################################################
+# Upstream Sources
+# All sources are downloaded concurrently as raw bytes and handed to the
+# parsing functions, so a refresh takes about as long as the slowest download
+# instead of the sum of all of them.
+
+SOURCES = {
+    'nyt_counties': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv',
+    'nyt_counties_recent': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties-recent.csv',
+    'census_counties': 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2019/counties/totals/co-est2019-alldata.csv',
+    'covid_tracking_states': 'https://covidtracking.com/api/states/daily'
+}
+
+# Seconds allowed per download attempt
+TIMEOUT_SECONDS = 120
+# Retries per source after the first attempt, waiting BACKOFF_SECONDS * 2**n,
+# only for timeouts, connection errors and 5xx responses
+RETRIES = 3
+BACKOFF_SECONDS = 2
+
+
+def _retryable(error):
+    # Timeouts, dropped connections and server errors may pass, a 4xx will not
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status >= 500
+    return isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError))
+
+
+async def _fetch(session, name, url, headers, timeout, retries, backoff):
+    for attempt in range(retries + 1):
+        t0 = time.time()
+        try:
+            async with session.get(url, headers=headers,
+                                   timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 304:
+                    print(f"{name} is unchanged ({time.time() - t0:.2f} seconds)")
+                    return name, None, None, None
+                response.raise_for_status()
+                body = await response.read()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+            print(f"Fetched {name}: {len(body) / 2**20:.1f} MB in {time.time() - t0:.2f} seconds")
+            return name, body, etag, last_modified
+        except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+            if attempt == retries or not _retryable(error):
+                raise
+            delay = backoff * 2**attempt
+            print(f"Fetching {name} failed ({error}), retrying in {delay} seconds")
+            await asyncio.sleep(delay)
+
+
+async def _fetch_all(sources, headers, timeout, retries, backoff):
+    async with aiohttp.ClientSession() as session:
+        return await asyncio.gather(*[
+            _fetch(session, name, url, headers.get(name, {}), timeout, retries, backoff)
+            for name, url in sources.items()])
+
+
+def fetch_changed_sources(names, cache = None, timeout = TIMEOUT_SECONDS,
+                          retries = RETRIES, backoff = BACKOFF_SECONDS):
+    '''Download the named SOURCES concurrently.
+
+    With a SourceCache the requests are conditional, and a source upstream
+    reports as unchanged (304) is read from the cache. Returns
+    ({name: bytes}, set of names whose content changed). New bodies are
+    added to the cache but its index is not saved, call cache.save() once
+    the changed sources have been processed so a failed run is retried.'''
+    sources = {name: SOURCES[name] for name in names}
+    if not sources:
+        return {}, set()
+    # Cache reads and writes stay outside the event loop
+    headers = {name: cache.validators(url) for name, url in sources.items()} if cache else {}
+
+    t0 = time.time()
+    results = asyncio.run(_fetch_all(sources, headers, timeout, retries, backoff))
+    print(f"Fetching {len(sources)} sources took {time.time() - t0:.2f} seconds")
+
+    # Read unchanged bodies before storing new ones, which may evict them
+    raw_sources = {name: cache.get(sources[name])
+                   for name, body, _, _ in results if body is None}
+    changed = set()
+    for name, body, etag, last_modified in results:
+        if body is None:
+            continue
+        raw_sources[name] = body
+        changed.add(name)
+        if cache:
+            cache.put(sources[name], body, etag, last_modified)
+    return raw_sources, changed
+
+
+def fetch_sources(names, cache = None, **kwargs):
+    '''Download the named SOURCES concurrently, returning {name: bytes}.'''
+    raw_sources = fetch_changed_sources(names, cache, **kwargs)[0]
+    if cache:
+        cache.save()
+    return raw_sources
+
+
+def ensure_sources(raw_sources, names, cache = None):
+    '''Return raw_sources with any of names it is missing fetched concurrently.'''
+    raw_sources = dict(raw_sources or {})
+    raw_sources.update(fetch_sources([name for name in names if name not in raw_sources], cache))
+    return raw_sources
+
+
+def cached_sources(raw_sources, names, cache):
+    '''Return raw_sources with any of names it is missing read from cache, or
+    downloaded when the cache has no copy. The cache is never written.'''
+    raw_sources = dict(raw_sources or {})
+    missing = [name for name in names if name not in raw_sources]
+    raw_sources.update({name: cache.get(SOURCES[name])
+                        for name in missing if cache.contains(SOURCES[name])})
+    raw_sources.update(fetch_sources([name for name in missing if name not in raw_sources]))
+    return raw_sources
+
+
+def content_key(raw_sources, names):
+    '''Short digest of the content of the named sources, for keying derived files.'''
+    digest = hashlib.sha256()
+    for name in names:
+        digest.update(hashlib.sha256(raw_sources[name]).digest())
+    return digest.hexdigest()[:16]
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+# FIPS Codec
+
+# FIPS codes are kept as integers (state * 1000 + county) through ingestion,
+# merges and indexing, and only formatted as 5 character strings to render.
+
+# Sentinel for rows without a county fips, e.g. NYT "Unknown" counties.
+MISSING_FIPS = -1
+
+FIPS_DTYPE = 'int32'
+
+
+def encode_fips(state_fips, county_fips):
+    '''Combine state and county codes into integer fips codes.'''
+    state = np.asarray(state_fips, dtype=FIPS_DTYPE)
+    county = np.asarray(county_fips, dtype=FIPS_DTYPE)
+    return state * 1000 + county
+
+
+def normalize_fips(values):
+    '''Convert a column of fips as read from a csv (floats, ints or strings)
+    to integer codes, with MISSING_FIPS where there is none.'''
+    codes = pd.to_numeric(pd.Series(values), errors='coerce')
+    return codes.fillna(MISSING_FIPS).astype(FIPS_DTYPE).to_numpy()
+
+
+def format_fips(codes):
+    '''Format integer fips codes as 5 character zero padded strings.'''
+    codes = np.asarray(codes)
+    strings = np.char.zfill(codes.astype(str), 5)
+    return np.where(codes == MISSING_FIPS, '', strings)
+
+
+def parse_fips(fips_str):
+    '''Parse a single fips string, e.g. a map location, to its integer code.'''
+    return int(fips_str)
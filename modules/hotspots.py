@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+
+import hashlib
+
+from modules import spatial
+
+
+################################################################################
+# Hotspots
+# Growth metrics for every county and date computed over the county cube in
+# vectorized passes over blocks of days, and the counties ranked per date.
+# Only the top HOTSPOT_TOP_N of each date are kept, so the hotspot panel reads
+# a handful of rows for the slider's date instead of scanning every county.
+# The table is built once per data version in shared_store.materialize.
+#
+# A county is a hotspot on a date when its 14 day average of new cases is
+# rising week over week and at least MIN_DAILY_CASES. Hotspots are ranked by
+# incidence, that average per 100,000 residents.
+
+# Metrics kept for the ranked counties, in metric axis order
+HOTSPOT_METRICS = ['incidence', 'week_change', 'doubling_days']
+
+# Counties kept per date
+HOTSPOT_TOP_N = 25
+
+# Days between the values compared for growth
+GROWTH_DAYS = 7
+
+# Smallest 14 day average of new cases counted as a hotspot, below it a
+# handful of cases make a small county look like a hotspot
+MIN_DAILY_CASES = 5
+
+# Days ranked per pass, bounds the county x day float32 temporaries to a few
+# MB instead of copies of the whole history
+HOTSPOT_BLOCK_DAYS = 64
+
+
+class HotspotTable:
+    '''Top counties of every date: top holds (day, rank) county ordinals of
+    the county cube, -1 past the last hotspot of a date, and values the
+    (metric, day, rank) HOTSPOT_METRICS of those counties. digests holds the
+    input_digests of every day the table was ranked from.'''
+
+    def __init__(self, fips, start_date, top, values, digests = None):
+        self.fips = fips
+        self.start_date = np.datetime64(start_date, 'D')
+        self.top = top
+        self.values = values
+        self.digests = digests
+
+        self.metric_index = {metric: i for i, metric in enumerate(HOTSPOT_METRICS)}
+
+    @property
+    def n_days(self):
+        return self.top.shape[0]
+
+    def day_offset(self, date):
+        offset = int((np.datetime64(date, 'D') - self.start_date).astype(int))
+        if 0 <= offset < self.n_days:
+            return offset
+        return None
+
+
+def input_digests(cube, start = 0, stop = None):
+    '''Return a uint64 digest of the hotspot inputs of each day [start, stop)
+    of the cube: every county's cases and 14 day average of new cases, and
+    the county populations.'''
+    stop = len(cube.dates) if stop is None else stop
+    seed = hashlib.blake2b(np.ascontiguousarray(cube.population, dtype=np.float32).tobytes(),
+                           digest_size=8).digest()
+    digests = np.empty(stop - start, dtype=np.uint64)
+    for block in range(start, stop, HOTSPOT_BLOCK_DAYS):
+        block_stop = min(block + HOTSPOT_BLOCK_DAYS, stop)
+        # One contiguous row per day
+        cases = np.ascontiguousarray(cube.values[cube.metric_index['cases'], :, block:block_stop].T)
+        average = np.ascontiguousarray(cube.values[cube.metric_index['cases_14MA'], :, block:block_stop].T)
+        for day in range(block_stop - block):
+            digest = hashlib.blake2b(seed, digest_size=8)
+            digest.update(cases[day])
+            digest.update(average[day])
+            digests[block - start + day] = int.from_bytes(digest.digest(), 'little')
+    return digests
+
+
+def hotspot_metrics(cube, start = 0, stop = None):
+    '''Return (metrics, score) for days [start, stop) of the cube, metrics a
+    (metric, county, day) array of HOTSPOT_METRICS and score a (county, day)
+    array, NaN for counties that are not hotspots.'''
+    stop = len(cube.dates) if stop is None else stop
+    # Growth looks GROWTH_DAYS back, before the first day there is nothing
+    lookback = min(start, GROWTH_DAYS)
+    average = np.asarray(cube.values[cube.metric_index['cases_14MA'], :, start - lookback:stop],
+                         dtype=np.float32)
+    cases = np.asarray(cube.values[cube.metric_index['cases'], :, start - lookback:stop],
+                       dtype=np.float32)
+    n_days = stop - start
+
+    def week_before(array):
+        # Value GROWTH_DAYS earlier for every day in [start, stop), NaN when
+        # that is before the first day
+        earlier = np.full((array.shape[0], n_days), np.nan, dtype=np.float32)
+        first = GROWTH_DAYS - lookback
+        if first < n_days:
+            earlier[:, first:] = array[:, :array.shape[1] - GROWTH_DAYS]
+        return earlier
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        population = np.asarray(cube.population, dtype=np.float32)[:, None]
+        current = average[:, lookback:]
+        incidence = current / population * 1e5
+        previous = week_before(average)
+        week_change = np.where(previous > 0, current / previous - 1, np.nan)
+        # Days for cumulative cases to double at this week's growth
+        growth = cases[:, lookback:] / week_before(cases)
+        doubling_days = np.where(growth > 1, np.float32(GROWTH_DAYS * np.log(2)) / np.log(growth),
+                                 np.nan)
+
+    hotspot = (week_change > 0) & (current >= MIN_DAILY_CASES)
+    score = np.where(hotspot, incidence, np.nan)
+    metrics = np.stack([incidence, week_change, doubling_days])
+    return metrics, score
+
+
+def rank_hotspots(metrics, score, n = HOTSPOT_TOP_N):
+    '''Return (top, values) of the n highest scores of every day, see
+    HotspotTable.'''
+    n_counties, n_days = score.shape
+    top = np.full((n_days, n), -1, dtype=np.int32)
+    values = np.full((len(HOTSPOT_METRICS), n_days, n), np.nan, dtype=np.float32)
+    k = min(n, n_counties)
+    if k == 0 or n_days == 0:
+        return top, values
+
+    # day x county, counties that are not hotspots sorted last
+    ranked = np.where(np.isnan(score), -np.inf, score).T
+    candidates = np.argpartition(-ranked, k - 1, axis=1)[:, :k]
+    days = np.arange(n_days)[:, None]
+    order = np.argsort(-ranked[days, candidates], axis=1, kind='stable')
+    candidates = candidates[days, order]
+    found = np.isfinite(ranked[days, candidates])
+
+    top[:, :k] = np.where(found, candidates, -1)
+    values[:, :, :k] = np.where(found, metrics[:, candidates, days], np.nan)
+    return top, values
+
+
+def _rank_days(cube, start, n):
+    # (top, values) of days [start, end of the cube), HOTSPOT_BLOCK_DAYS at a time
+    tops = [np.empty((0, n), dtype=np.int32)]
+    values = [np.empty((len(HOTSPOT_METRICS), 0, n), dtype=np.float32)]
+    for block in range(start, len(cube.dates), HOTSPOT_BLOCK_DAYS):
+        metrics, score = hotspot_metrics(cube, block, min(block + HOTSPOT_BLOCK_DAYS, len(cube.dates)))
+        top, value = rank_hotspots(metrics, score, n)
+        tops.append(top)
+        values.append(value)
+    return np.concatenate(tops), np.concatenate(values, axis=1)
+
+
+def build_hotspot_table(cube, n = HOTSPOT_TOP_N):
+    '''Rank the hotspots of every date of the cube.'''
+    top, values = _rank_days(cube, 0, n)
+    return HotspotTable(cube.fips, cube.start_date, top, values, input_digests(cube))
+
+
+def update_hotspot_table(previous, cube, n = HOTSPOT_TOP_N):
+    '''Return the hotspot table of cube, reusing the days of a previous table
+    before the first day whose inputs changed (input_digests), since a day's
+    ranking only depends on that day and the days before it. Upstream
+    revisions of older days are picked up that way. Rebuilt in full when the
+    counties or the first date changed.'''
+    if (previous is None
+            or previous.digests is None
+            or previous.top.shape[1] != n
+            or previous.start_date != cube.start_date
+            or not np.array_equal(previous.fips, cube.fips)):
+        return build_hotspot_table(cube, n)
+
+    digests = input_digests(cube)
+    reused = min(previous.n_days, len(digests))
+    changed = np.flatnonzero(previous.digests[:reused] != digests[:reused])
+    start = int(changed[0]) if len(changed) else reused
+    top, values = _rank_days(cube, start, n)
+    return HotspotTable(cube.fips,
+                        cube.start_date,
+                        np.concatenate([previous.top[:start], top]),
+                        np.concatenate([previous.values[:, :start], values], axis=1),
+                        digests)
+
+
+def top_hotspots(table, cube, date, n = 10, adjacency = None):
+    '''Return a frame of the top n hotspots on date, best first, with their
+    names and HOTSPOT_METRICS. O(n), plus one sparse product over every
+    county for the cluster_gi column (the Getis-Ord Gi* z-score of incidence
+    around each county) when a spatial.CountyAdjacency is given.'''
+    offset = table.day_offset(date)
+    columns = ['fips', 'county', 'state'] + HOTSPOT_METRICS
+    if adjacency is not None:
+        columns.append('cluster_gi')
+    if offset is None:
+        return pd.DataFrame(columns=columns)
+    ordinals = table.top[offset, :n]
+    found = ordinals >= 0
+    ordinals = ordinals[found]
+    df = pd.DataFrame({'fips': cube.fips[ordinals],
+                       'county': cube.county_names[ordinals],
+                       'state': cube.state_names[ordinals]})
+    for metric in HOTSPOT_METRICS:
+        df[metric] = table.values[table.metric_index[metric], offset, :n][found]
+    if adjacency is not None:
+        metrics, _ = hotspot_metrics(cube, offset, offset + 1)
+        g = spatial.getis_ord_g(adjacency.aligned(cube.fips),
+                                metrics[HOTSPOT_METRICS.index('incidence'), :, 0])
+        df['cluster_gi'] = g[ordinals]
+    return df
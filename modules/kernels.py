@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+
+
+################################################################################
+# Time Series Kernels
+# Diffs and moving averages for every (group, date) series of a long frame in
+# one vectorized pass. The rows are sorted once by group and date, group
+# boundaries are found from the sorted keys, and moving averages are
+# differences of a cumulative sum between each row and an as-of lookup of the
+# last row at least window days earlier, so gaps in a series are measured in
+# days instead of rows.
+
+def _group_keys(df, keys):
+    # Integer codes per key column, hashed once per column
+    return [pd.factorize(df[key], sort=False)[0] for key in keys]
+
+
+def add_diffs_and_averages(df, keys, diffs = None, averages = None, date = 'date'):
+    '''Add diff and moving average columns to df, computed per group of keys.
+
+    diffs: {new column: value column}, change since the group's previous row
+    averages: {new column: (column, window days)}, mean per day of column over
+        the trailing window, NaN until the series covers a full window or if
+        any value in the window is NaN. Columns added by diffs can be averaged.
+    Rows can be in any order, the new columns are aligned with df.'''
+    diffs = diffs or {}
+    averages = averages or {}
+
+    days = df[date].values.astype('datetime64[D]').astype(np.int64)
+    codes = _group_keys(df, keys)
+    # lexsort sorts by the last key first
+    order = np.lexsort([days] + codes[::-1])
+    days = days[order]
+
+    # Group id of every sorted row, a new group starts where any key changes
+    changed = np.zeros(len(order), dtype=bool)
+    changed[:1] = True
+    for code in codes:
+        code = code[order]
+        changed[1:] |= code[1:] != code[:-1]
+    group = np.cumsum(changed) - 1
+    group_start = np.flatnonzero(changed)[group]
+
+    columns = {}
+    for name, column in diffs.items():
+        values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+        result = np.empty(len(values))
+        result[:1] = np.nan
+        result[1:] = values[1:] - values[:-1]
+        result[changed] = np.nan
+        columns[name] = result
+
+    # Sorted (group, day) as one key for the as-of lookups. Subtracting a
+    # window from a group's earliest days lands in the previous group.
+    position = (group.astype(np.int64) << 32) + days
+    for name, (column, window) in averages.items():
+        if column in columns:
+            values = columns[column]
+        else:
+            values = df[column].to_numpy(dtype=np.float64, na_value=np.nan)[order]
+        missing = np.isnan(values)
+        total = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, values))])
+        n_missing = np.concatenate([[0], np.cumsum(missing)])
+
+        # Rows dated within window days up to each row are after the last
+        # row at least window days earlier, or the start of the group
+        before = np.searchsorted(position, position - window, side='right')
+        before = np.maximum(before, group_start)
+        row = np.arange(1, len(values) + 1)
+        result = (total[row] - total[before]) / window
+        covered = days[group_start] <= days - window + 1
+        result[~covered | (n_missing[row] - n_missing[before] > 0)] = np.nan
+        columns[name] = result
+
+    for name, result in columns.items():
+        aligned = np.empty(len(order))
+        aligned[order] = result
+        df[name] = aligned
+    return df
+
+
+################################################################################
+# Cross-Sectional Quantiles
+# Quantiles over the locations of every (metric, day) of a (metric, location,
+# day) array, e.g. colour scale bounds for every date of a map. Each metric is
+# sorted once along the location axis, NaN sorting last, and the quantiles are
+# interpolated between the ranks of every day at once.
+
+def location_quantiles(values, quantiles):
+    '''Return a (metric, day, quantile) array of the quantiles of values over
+    the location axis, NaN ignored, interpolated linearly like np.nanquantile.
+    Days without any value get NaN.'''
+    quantiles = np.asarray(quantiles, dtype=np.float64)
+    n_metrics, n_locations, n_days = values.shape
+    table = np.full((n_metrics, n_days, len(quantiles)), np.nan, dtype=np.float32)
+    if n_locations == 0:
+        return table
+
+    days = np.arange(n_days)[:, None]
+    for m in range(n_metrics):
+        # day x location, each row sorted with its NaNs at the end
+        ordered = np.sort(values[m].T, axis=1)
+        count = n_locations - np.isnan(ordered).sum(axis=1)
+        rank = quantiles[None, :] * (count[:, None] - 1)
+        lower = np.maximum(np.floor(rank).astype(np.int64), 0)
+        upper = np.minimum(lower + 1, np.maximum(count[:, None] - 1, 0))
+        low = ordered[days, lower].astype(np.float64)
+        high = ordered[days, upper].astype(np.float64)
+        table[m] = low + (high - low) * (rank - lower)
+        table[m, count == 0] = np.nan
+    return table
@@ -0,0 +1,249 @@
+import flask
+
+import hmac
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from modules import plotting
+
+
+################################################################################
+# Metrics
+# Callback latencies and payload sizes, figure cache hit rates and data load
+# stage timings, kept in memory per process and served in the Prometheus text
+# format. Under gunicorn every worker keeps its own metrics, dataset_info
+# carries the pid of the worker that answered the scrape.
+
+# Set METRICS_LOG=0 to stop printing a JSON line per callback and stage
+METRICS_LOG = os.environ.get('METRICS_LOG', '1') == '1'
+
+# Bearer token the metrics endpoint requires, the endpoint is not served
+# without one
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+# Histogram bucket upper bounds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+PAYLOAD_BUCKETS = (1e3, 1e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7)
+
+# Observations kept per series for the p50/p99 summaries
+RECENT_SAMPLES = 1024
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram:
+    '''Cumulative bucket counts plus a window of recent observations.'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+    def quantile(self, q):
+        '''Quantile of the recent observations, NaN if there are none.'''
+        if not self.recent:
+            return float('nan')
+        values = sorted(self.recent)
+        return values[min(int(q * len(values)), len(values) - 1)]
+
+
+_lock = threading.Lock()
+_callback_latency = {}
+_callback_payload = {}
+_callback_errors = {}
+_stage_seconds = {}
+_stage_last = {}
+_stage_failures = {}
+
+
+def log(event, **fields):
+    '''Print one structured log line.'''
+    if METRICS_LOG:
+        print(json.dumps({'ts': round(time.time(), 3), 'event': event, **fields}, default=str))
+
+
+def observe_callback(name, seconds, nbytes = None, status = 200):
+    '''Record one callback request.'''
+    with _lock:
+        _callback_latency.setdefault(name, Histogram(LATENCY_BUCKETS)).observe(seconds)
+        if nbytes is not None:
+            _callback_payload.setdefault(name, Histogram(PAYLOAD_BUCKETS)).observe(nbytes)
+        if status >= 500:
+            _callback_errors[name] = _callback_errors.get(name, 0) + 1
+    log('callback', callback=name, seconds=round(seconds, 4), bytes=nbytes, status=status)
+
+
+@contextmanager
+def timed(stage, **fields):
+    '''Time a data load stage, e.g. `with metrics.timed('load_county'):`.
+    Stages that raise are timed too and counted as failures.'''
+    t0 = time.perf_counter()
+    failed = True
+    try:
+        yield
+        failed = False
+    finally:
+        seconds = time.perf_counter() - t0
+        with _lock:
+            _stage_seconds.setdefault(stage, Histogram(LATENCY_BUCKETS)).observe(seconds)
+            _stage_last[stage] = seconds
+            if failed:
+                _stage_failures[stage] = _stage_failures.get(stage, 0) + 1
+        log('stage', stage=stage, seconds=round(seconds, 4), failed=failed, **fields)
+
+
+def summary():
+    '''Return {callback: {count, p50, p90, p99, bytes_p50}} of the recent requests.'''
+    with _lock:
+        return {name: {'count': histogram.count,
+                       **{f'p{int(q * 100)}': histogram.quantile(q) for q in QUANTILES},
+                       'bytes_p50': _callback_payload[name].quantile(0.5)
+                                    if name in _callback_payload else None}
+                for name, histogram in _callback_latency.items()}
+
+
+################################################################################
+# Prometheus Text Format
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(**labels):
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value == value else 'NaN'
+
+
+def _histogram_lines(metric, series, label):
+    lines = []
+    for key, histogram in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(list(histogram.buckets) + ['+Inf'], histogram.counts):
+            cumulative += count
+            le = bound if bound == '+Inf' else _number(bound)
+            lines.append(f'{metric}_bucket{_labels(**{label: key}, le=le)} {cumulative}')
+        lines.append(f'{metric}_sum{_labels(**{label: key})} {_number(histogram.sum)}')
+        lines.append(f'{metric}_count{_labels(**{label: key})} {histogram.count}')
+    return lines
+
+
+def _summary_lines(metric, series, label):
+    lines = []
+    for key, histogram in sorted(series.items()):
+        for q in QUANTILES:
+            lines.append(f'{metric}{_labels(**{label: key}, quantile=q)} {_number(histogram.quantile(q))}')
+        lines.append(f'{metric}_sum{_labels(**{label: key})} {_number(sum(histogram.recent))}')
+        lines.append(f'{metric}_count{_labels(**{label: key})} {len(histogram.recent)}')
+    return lines
+
+
+def render():
+    '''Return every metric in the Prometheus text exposition format.'''
+    families = []
+
+    def family(metric, kind, help_text, lines):
+        families.append('\n'.join([f'# HELP {metric} {help_text}',
+                                   f'# TYPE {metric} {kind}'] + lines))
+
+    with _lock:
+        family('dash_callback_duration_seconds', 'histogram',
+               'Time to answer a Dash callback request.',
+               _histogram_lines('dash_callback_duration_seconds', _callback_latency, 'callback'))
+        family('dash_callback_recent_duration_seconds', 'summary',
+               f'Quantiles of the last {RECENT_SAMPLES} callback durations.',
+               _summary_lines('dash_callback_recent_duration_seconds', _callback_latency, 'callback'))
+        family('dash_callback_response_bytes', 'histogram',
+               'Uncompressed size of Dash callback responses.',
+               _histogram_lines('dash_callback_response_bytes', _callback_payload, 'callback'))
+        family('dash_callback_errors_total', 'counter',
+               'Dash callback requests that failed with a server error.',
+               [f'dash_callback_errors_total{_labels(callback=name)} {count}'
+                for name, count in sorted(_callback_errors.items())])
+        family('data_load_stage_seconds', 'histogram',
+               'Time taken by each data load stage.',
+               _histogram_lines('data_load_stage_seconds', _stage_seconds, 'stage'))
+        family('data_load_stage_last_seconds', 'gauge',
+               'Time taken by the last run of each data load stage.',
+               [f'data_load_stage_last_seconds{_labels(stage=stage)} {_number(seconds)}'
+                for stage, seconds in sorted(_stage_last.items())])
+        family('data_load_stage_failures_total', 'counter',
+               'Data load stages that raised an exception.',
+               [f'data_load_stage_failures_total{_labels(stage=stage)} {count}'
+                for stage, count in sorted(_stage_failures.items())])
+
+    stats = plotting.figure_cache_stats()
+    for name in ('hits', 'misses', 'evictions'):
+        family(f'figure_cache_{name}_total', 'counter', f'Figure cache {name}.',
+               [f'figure_cache_{name}_total {stats[name]}'])
+    family('figure_cache_hit_ratio', 'gauge', 'Share of figure cache lookups that hit.',
+           [f'figure_cache_hit_ratio {_number(stats["hit_rate"])}'])
+    family('figure_cache_bytes', 'gauge', 'Estimated size of the cached figures.',
+           [f'figure_cache_bytes {stats["bytes"]}'])
+    family('figure_cache_entries', 'gauge', 'Number of cached figures.',
+           [f'figure_cache_entries {stats["entries"]}'])
+    family('dataset_info', 'gauge', 'Dataset version being served by this worker.',
+           [f'dataset_info{_labels(version=stats["version"], pid=os.getpid())} 1'])
+    return '\n'.join(families) + '\n'
+
+
+################################################################################
+# Dash Instrumentation
+
+def _callback_name(app, output):
+    # Name of the user function behind an output id, the id itself for
+    # callbacks Dash does not know about
+    callback = app.callback_map.get(output, {}).get('callback')
+    return getattr(callback, '__name__', output) or output
+
+
+def instrument_app(app, path = '/metrics', token = METRICS_TOKEN):
+    '''Time every callback request of a Dash app and serve the metrics at
+    path to requests bearing token. Without a token the metrics are only
+    logged.'''
+    server = app.server
+
+    @server.before_request
+    def _start_timer():
+        flask.g.metrics_start = time.perf_counter()
+
+    # Registered after Dash's own hooks so it runs before compression, the
+    # recorded size is the uncompressed JSON
+    @server.after_request
+    def _record_callback(response):
+        if flask.request.path.endswith('/_dash-update-component') and 'metrics_start' in flask.g:
+            body = flask.request.get_json(silent=True) or {}
+            observe_callback(_callback_name(app, body.get('output', '')),
+                             time.perf_counter() - flask.g.metrics_start,
+                             response.calculate_content_length(),
+                             response.status_code)
+        return response
+
+    if token:
+        @server.route(path)
+        def _metrics():
+            if not hmac.compare_digest(flask.request.headers.get('Authorization', ''),
+                                       f'Bearer {token}'):
+                return flask.Response('Unauthorized\n', status=401, mimetype='text/plain',
+                                      headers={'WWW-Authenticate': 'Bearer'})
+            return flask.Response(render(), mimetype='text/plain; version=0.0.4')
+
+    return app
@@ -3,24 +3,156 @@
 # Import libraries
 import pandas as pd
 import numpy as np
-import requests
 
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import plotly.express as px
 import plotly.graph_objects as go
 #import geoplot as gplt
 from plotly.subplots import make_subplots
 
-from urllib.request import urlopen
 import json
 
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
-from dash.dependencies import Input, Output
-import time
-import datetime
+import hashlib
+import os
+import inspect
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+from modules import fips as fips_codec
+
+
+################################################################################
+# FIGURE CACHE
+# Figures are cached on their non-data arguments plus the version of the data
+# they are built from, so the same (category, date) requested by different
+# users is built once.
+# Cached figures are shared between callers and must not be mutated.
+
+# Memory budget for cached figures in MB, measured by _figure_nbytes
+FIGURE_CACHE_MB = float(os.environ.get('FIGURE_CACHE_MB', 64))
+
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+_figure_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'bytes': 0}
+_dataset_version = None
+
+# {id(geojson): (geojson, encoded size)} of the last geojson measured, it is
+# shared by every county figure and only measured once
+_geojson_nbytes = {}
+
+def _value_nbytes(value):
+    # Estimated size of a figure property without encoding it: array buffers,
+    # string lengths and 8 bytes per other scalar
+    if isinstance(value, (np.ndarray, pd.Series, pd.Index)):
+        return int(value.nbytes)
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        if value.get('type') == 'FeatureCollection':
+            entry = _geojson_nbytes.get(id(value))
+            if entry is None or entry[0] is not value:
+                # Only the geojson in use is kept
+                _geojson_nbytes.clear()
+                entry = _geojson_nbytes[id(value)] = (value, len(json.dumps(value)))
+            return entry[1]
+        return sum(len(str(key)) + _value_nbytes(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(_value_nbytes(item) for item in value)
+    return 8
+
+def _figure_nbytes(fig):
+    # Figures or plain dicts of values. Figures are read through plotly's own
+    # property dicts, to_plotly_json would deep copy them.
+    if hasattr(fig, '_data') and hasattr(fig, '_layout'):
+        return (_value_nbytes(fig._data) + _value_nbytes(fig._layout)
+                + _value_nbytes([frame._props for frame in fig._frame_objs]))
+    return _value_nbytes(fig)
+
+def _data_version(data):
+    # Data tagged by modules.dataset carries its version, the cube as an
+    # attribute and dataframes in attrs
+    version = getattr(data, 'version', None)
+    if version is None and isinstance(getattr(data, 'attrs', None), dict):
+        version = data.attrs.get('version')
+    return version if version is not None else _dataset_version
+
+def _freeze(value):
+    # Lists (e.g. category tuples) need to be hashable to be part of a key
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+def set_dataset_version(version):
+    '''Set the version of the loaded data, dropping figures built from older data.'''
+    global _dataset_version
+    with _figure_cache_lock:
+        if version != _dataset_version:
+            _dataset_version = version
+            _figure_cache.clear()
+            _figure_cache_stats['bytes'] = 0
+
+def clear_figure_cache():
+    with _figure_cache_lock:
+        _figure_cache.clear()
+        _figure_cache_stats['bytes'] = 0
+
+def figure_cache_stats():
+    '''Return hit/miss/eviction counters and the cache size.'''
+    with _figure_cache_lock:
+        stats = dict(_figure_cache_stats)
+        stats['entries'] = len(_figure_cache)
+        stats['version'] = _dataset_version
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
+
+def cached_figure(data_args=1):
+    '''Decorator caching a plotting function's figure. The first data_args
+    parameters hold the data and are represented in the key by the dataset
+    version instead of their contents.'''
+    def decorator(func):
+        signature = inspect.signature(func)
+        
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            params = list(bound.arguments.items())
+            version = _data_version(params[0][1])
+            params = params[data_args:]
+            key = (func.__name__, version,
+                   tuple((name, _freeze(value)) for name, value in params))
+            
+            with _figure_cache_lock:
+                if key in _figure_cache:
+                    _figure_cache.move_to_end(key)
+                    _figure_cache_stats['hits'] += 1
+                    return _figure_cache[key][0]
+                _figure_cache_stats['misses'] += 1
+            
+            # Build outside the lock so other figures are not blocked
+            fig = func(*args, **kwargs)
+            nbytes = _figure_nbytes(fig)
+            budget = FIGURE_CACHE_MB * 1024 * 1024
+            if nbytes > budget:
+                return fig
+            
+            with _figure_cache_lock:
+                # Figures from data that is no longer current are not kept
+                if key[1] != _dataset_version:
+                    return fig
+                if key not in _figure_cache:
+                    _figure_cache[key] = (fig, nbytes)
+                    _figure_cache_stats['bytes'] += nbytes
+                # Evict least recently used figures until under budget
+                while _figure_cache_stats['bytes'] > budget:
+                    _, (_, evicted) = _figure_cache.popitem(last=False)
+                    _figure_cache_stats['bytes'] -= evicted
+                    _figure_cache_stats['evictions'] += 1
+            return fig
+        return wrapper
+    return decorator
+
 
 
 def plot_national(covid_states_df, category='hospitalizedCurrently'):
@@ -39,30 +171,55 @@ def plot_national(covid_states_df, category='hospitalizedCurrently'):
     )
     print("Finished Plot")
     return figure
+# States drawn as their own band in the national charts, the rest are summed
+# into "Other"
+NATIONAL_TOP_STATES = 8
+
+# NATIONAL bars from the pre-aggregated date x state matrix
+@cached_figure(data_args=1)
+def plot_national_bars(national_matrix, category='hospitalizedCurrently', mode='states',
+                       top_states=NATIONAL_TOP_STATES):
+    '''Stacked bars of the top_states states plus an "Other" band, or a single
+    national series when mode is "national".'''
+    print("Generating National Plot")
+    by_state = national_matrix[category]
+    # Plain date strings are a fraction of the size of encoded timestamps
+    dates = by_state.index.strftime('%Y-%m-%d')
+    
+    if mode == 'national':
+        bands = [('National', by_state.sum(axis=1))]
+    else:
+        # Largest states over the whole history keep their own band
+        ranked = by_state.sum().sort_values(ascending=False).index
+        bands = [(state, by_state[state]) for state in ranked[:top_states]]
+        if len(ranked) > top_states:
+            bands.append(('Other', by_state[ranked[top_states:]].sum(axis=1)))
+    
+    figure = go.Figure([go.Bar(x=dates,
+                               y=values.to_numpy(),
+                               name=str(name),
+                               hovertemplate='%{x}<br>%{y:,.0f}')
+                        for name, values in bands])
+    figure.update_layout(barmode='stack', bargap=0, autosize = True, showlegend=False,
+                         margin={"r":5,"t":0,"l":5,"b":5})
+    print("Finished Plot")
+    return figure
+
 ################################################################################
 # COUNTY
 # SCATTER deaths for COUNTY
-def scatter_deaths_county(df, category, slider_date, fips = '01001'):
+def scatter_deaths_county(cube, category, slider_date, fips = 1001):
     print("Generating County Scatter Plot")
-    # Create a county mask to extract stats across dates.
-    county_mask = (df['fips'] == fips)
-
-    # Create series of stats for one county over time
-    county_series = df[county_mask].groupby(by = 'date')[category].sum()
-    
-    # Grab the last date and create date_mask to return one value for names
-    date = max(df[county_mask]['date'])
-    date_mask = (df['date'] == date)
-    
-    county_name = df[county_mask & date_mask]['county'].to_string(index = False)
-    state_name = df[county_mask & date_mask]['state'].to_string(index = False)
+    # Pull the county's row out of the cube, no scan over other counties
+    dates, values = cube.county_series(fips, category)
+    county_name, state_name = cube.county_name(fips)
     
     # Greate figure
     fig = go.Figure()
     
     fig.add_trace(
-        go.Scatter(x = county_series.index,
-                  y = county_series, 
+        go.Scatter(x = dates,
+                  y = values, 
                 name=category
         )
     )
@@ -84,23 +241,65 @@ def scatter_deaths_county(df, category, slider_date, fips = '01001'):
     print("Finished Plot")
     return fig
 
+################################################################################
+# CHOROPLETH UPDATES
+# Choropleth values carry a key naming their locations and hover text. When
+# only the date moves the locations rarely change, so a client already holding
+# the key is sent just z, zmin/zmax and the title, and merges them into the
+# figure it has (assets/choropleth.js).
+
+def locations_key(data, locations):
+    '''Key for a choropleth's locations, in order, and the data version.'''
+    digest = hashlib.blake2b('\n'.join(map(str, locations)).encode(),
+                             digest_size=8).hexdigest()
+    return f'{_data_version(data)}:{digest}'
+
+def choropleth_patch(values, held_key=None):
+    '''Return the values to send to a client holding the locations of held_key,
+    leaving out the locations and hover text when they are the same.'''
+    if held_key is None or held_key != values['key']:
+        return values
+    return {name: value for name, value in values.items()
+            if name not in ('locations', 'text')}
+
+# VALUES for the COUNTY CHOROPLETH
+@cached_figure(data_args=1)
+def county_choropleth_values(cube, category, date, stable_scale=False):
+    '''Return the per-county values of the county choropleth without the
+    geometry, for clients that already hold the county geojson. With
+    stable_scale the colour scale is the same for every date.'''
+    # Pull the date's column out of the cube, no scan over other dates
+    fips_codes, county_names, values = cube.date_slice(date, category)
+    locations = fips_codec.format_fips(fips_codes) # geojson ids are strings
+    # Colour scale bounds from the cube's precomputed quantiles
+    zmin, zmax = cube.color_bounds(date, category, stable_scale)
+    return {
+        'key': locations_key(cube, locations),
+        'locations': locations,
+        'z': values,
+        'text': county_names,
+        'zmin': round(zmin,-1),
+        'zmax': round(zmax,-1),
+        'category': category,
+        'title': f'Deaths by county on {date}'
+    }
+
 # CHOROPLETH deaths for COUNTY
-def plot_choropleth_county(df, geojson, category, date):
+@cached_figure(data_args=2)
+def plot_choropleth_county(cube, geojson, category, date, stable_scale=False):
     print("Generating County Choropleth Plot")
-    date_mask = (df['date'] == date)
-    colorscale_max = round(df[date_mask][category].quantile(0.975),-1)
-    colorscale_min = round(df[date_mask][category].quantile(0.1),-1)
+    values = county_choropleth_values(cube, category, date, stable_scale)
     
     # Generate Plot
     fig = go.Figure(
         go.Choropleth(
-            z = df[date_mask][category], # Data to be color-coded
-            zmin=colorscale_min,
-            zmax=colorscale_max,
+            z = values['z'], # Data to be color-coded
+            zmin=values['zmin'],
+            zmax=values['zmax'],
             geojson = geojson,
-            locations=df[date_mask]['fips'],
+            locations=values['locations'],
             locationmode = 'geojson-id',
-            hovertext = df[date_mask]['county'],
+            hovertext = values['text'],
             colorscale="Viridis",
             colorbar={
                 'yanchor':'middle',
@@ -116,7 +315,7 @@ def plot_choropleth_county(df, geojson, category, date):
     fig.update_layout(
         #height = 400,
         paper_bgcolor='#D6DBDF',
-        title_text = f'Deaths by county on {date}',
+        title_text = values['title'],
         margin={"r":5,"t":30,"l":5,"b":5}
     )
     print("Finished Generating Plot")
@@ -125,6 +324,7 @@ def plot_choropleth_county(df, geojson, category, date):
 ################################################################################
 # STATES
 # CHOROPLETH for STATES
+@cached_figure(data_args=1)
 def plot_choropleth_state(covid_states_df, date, category='death'):
     print("Generating State Choropleth Plot")
     # Create a mask to filter the df to only a specific date
@@ -166,8 +366,31 @@ def plot_choropleth_state(covid_states_df, date, category='death'):
     print("Finished Plot")
     return fig
 
+# VALUES for the STATE CHOROPLETH
+@cached_figure(data_args=1)
+def state_choropleth_values(covid_states_df, date, category='death'):
+    '''Return the per-state values of the state choropleth, rendered
+    clientside like the county choropleth.'''
+    date_mask = (covid_states_df['date'] == date)
+    states = covid_states_df.loc[date_mask, 'state'].astype(str).to_numpy()
+    return {
+        'key': locations_key(covid_states_df, states),
+        'locations': states,
+        'z': covid_states_df.loc[date_mask, category].astype(float).to_numpy(),
+        'text': states,
+        'category': category,
+        'title': f'{category} by State on {date}'
+    }
+
 # SCATTER for STATE
-def plot_scatter_state(covid_state_df,state,category_tuple=('deathIncrease','death')):
+# NYT rollup metric of each Covid Tracking cumulative series
+NYT_EQUIVALENTS = {'death': 'deaths',
+                   'positive': 'cases'}
+
+@cached_figure(data_args=1)
+def plot_scatter_state(covid_state_df,state,category_tuple=('deathIncrease','death'),rollup=None):
+    '''State daily bars and cumulative line, with the NYT county rollup of the
+    cumulative series beside it when a rollup.RollupCube is given.'''
     print("Generating State Scatter Plot")
     daily, cumulative = category_tuple
     
@@ -200,32 +423,34 @@ def plot_scatter_state(covid_state_df,state,category_tuple=('deathIncrease','dea
             name=cumulative
         ),secondary_y=True
     )
+    # Same count summed from the NYT counties, a row read from the rollup
+    nyt_metric = NYT_EQUIVALENTS.get(cumulative)
+    if rollup is not None and nyt_metric is not None:
+        dates, values = rollup.series('state', state, nyt_metric)
+        fig.add_trace(
+            go.Scatter(x=dates, y=values,
+                name=f"{nyt_metric} (NYT counties)",
+                line=dict(dash='dot')
+            ),secondary_y=True
+        )
     fig.update_yaxes(title_text=f"{daily}", secondary_y=False)
     fig.update_yaxes(title_text=f"{cumulative}", secondary_y=True)
     print("Finished Plot")
     return fig
 
 
-def generate_animation_dates(df):
-    
-    # Hardcode a start date
-    start_date = '2020-07-01'
-    max_date = df['date'].max()
-
-    start_date_int = int(time.mktime(datetime.datetime.strptime(start_date, '%Y-%m-%d').timetuple()))
-    
-    max_date_int = int(time.mktime(datetime.datetime.strptime(df['date'].max(), '%Y-%m-%d').timetuple()))
-
-    # Create a list of dates from max to min, going back 2 weeks each time
-    date_list = range(start_date_int, max_date_int, (14*24*60*60))
-    
-    date_dict = {'date':[time.strftime('%Y-%m-%d',datetime.datetime.strptime(day, '%Y-%m-%d').timetuple()) for day in df['date']]}
-    
-    
-    #date_dict = {day:{'label':time.strftime('%Y-%m-%d',time.localtime(day)),'style':{'writing-mode': 'vertical-rl','text-orientation': 'sideways', 'height':'70px'}}  for day in date_list}
-    return date_dict
+def generate_animation_dates(df, stride=1):
+    '''Return {'date': [dates]} of the animation frames, every stride days
+    back from the latest date, oldest first, for px category_orders.'''
+    # Parse each distinct date once instead of every row
+    dates = pd.to_datetime(pd.Series(df['date'].unique())).sort_values()
+    days_back = (dates.iloc[-1] - dates).dt.days
+    dates = dates[days_back % stride == 0]
+    return {'date': list(dates.dt.strftime('%Y-%m-%d'))}
 
 # Choropleth animation
+# Every frame is built up front, the dashboard streams frames instead
+# (modules/animation.py)
 def plot_animation(df, category='death'):
     fig = px.choropleth(
                 data_frame=df.sort_values(by='date'),
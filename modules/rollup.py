@@ -0,0 +1,223 @@
+import numpy as np
+import pandas as pd
+
+import os
+
+
+################################################################################
+# Rollups
+# County, state and national aggregates of every county cube metric and date,
+# summed from the NYT county series in one grouped pass over the cube. The
+# cube's counties are sorted by fips, so the counties of a state are a
+# contiguous run and each state is one np.add.reduceat segment. The rows
+# without a county fips, kept per state in the cube, are added on top. The state and
+# national arrays are written next to the county cube (shared_store), and
+# every (level, entity, metric) series is a single row lookup.
+
+# Per million metrics are not summed, they are recomputed from the summed
+# counts and the population of the states reporting them (STATES_PATH, the
+# sum of their counties' for states missing from it)
+RATE_METRICS = {'casesPerMillion': 'cases',
+                'deathsPerMillion': 'deaths'}
+
+# Entity of the nation level
+NATION = 'US'
+
+# State abbreviations, names and fips codes
+STATES_PATH = 'data/tbl_states.csv'
+
+# NYT rollup metrics and the Covid Tracking field reporting the same count
+COVID_TRACKING_FIELDS = {'deaths': 'death',
+                         'cases': 'positive',
+                         'deathsPerMillion': 'death_pm',
+                         'casesPerMillion': 'case_pm',
+                         'death_diff': 'deathIncrease',
+                         'case_diff': 'positiveIncrease',
+                         'deaths_14MA': 'deaths_14MA',
+                         'cases_14MA': 'cases_14MA'}
+
+
+class RollupCube:
+    '''The county cube's metrics at the county, state and nation levels.
+
+    state_values has shape (metric, state, day) and nation_values (metric, 1,
+    day), in the county cube's metric and day order, NaN on days no county of
+    the entity reported. The county level is the county cube itself. States
+    are looked up by integer fips code, abbreviation or name.'''
+
+    def __init__(self, cube, state_fips, state_codes, state_names, state_population,
+                 state_values, nation_values):
+        self.cube = cube
+        self.state_fips = state_fips
+        self.state_codes = state_codes
+        self.state_names = state_names
+        self.state_population = state_population
+        self.state_values = state_values
+        self.nation_values = nation_values
+
+        self.metrics = cube.metrics
+        self.metric_index = cube.metric_index
+        self.dates = cube.dates
+
+        state_index = {}
+        for i, (code, abbreviation, name) in enumerate(zip(state_fips, state_codes, state_names)):
+            state_index[int(code)] = i
+            state_index[str(abbreviation)] = i
+            state_index[str(name)] = i
+        self._levels = {'county': (cube.values, cube.fips_index),
+                        'state': (state_values, state_index),
+                        'nation': (nation_values, {NATION: 0})}
+
+    def entity_index(self, level, entity):
+        '''Return the row of an entity in its level, or None if it has no data.'''
+        return self._levels[level][1].get(entity)
+
+    def series(self, level, entity, metric):
+        '''Return (dates, values) of one metric for one county (fips code),
+        state (fips code, abbreviation or name) or the nation (NATION). O(1),
+        values is a view of the stored row.'''
+        values, index = self._levels[level]
+        row = index.get(entity)
+        if row is None:
+            return self.dates[:0], values[0, 0, :0]
+        return self.dates, values[self.metric_index[metric], row]
+
+    def value(self, level, entity, metric, date):
+        '''Return one metric of one entity on date, NaN if there is none. O(1).'''
+        values, index = self._levels[level]
+        row = index.get(entity)
+        offset = self.cube.day_offset(date)
+        if row is None or offset is None:
+            return np.nan
+        return float(values[self.metric_index[metric], row, offset])
+
+
+def _state_table(state_fips, path = STATES_PATH):
+    # (abbreviation, name, population) of each state fips code, the code
+    # itself and NaN for states missing from the table
+    codes = np.array([f'{code:02d}' for code in state_fips], dtype=object)
+    names = codes.copy()
+    population = np.full(len(state_fips), np.nan)
+    if os.path.exists(path):
+        table = pd.read_csv(path).set_index('fips')
+        known = np.isin(state_fips, table.index)
+        codes[known] = table.loc[state_fips[known], 'state'].to_numpy()
+        names[known] = table.loc[state_fips[known], 'state_name'].to_numpy()
+        population[known] = table.loc[state_fips[known], 'Pop'].to_numpy(dtype=np.float64)
+    return codes.astype(str), names.astype(str), population
+
+
+def _unallocated_state_fips(cube, path = STATES_PATH):
+    # State fips code of each of the cube's unallocated states, looked up by
+    # name in the cube's own counties and then the states table, -1 if unknown
+    state_fips = dict(zip(np.asarray(cube.state_names, dtype=str).tolist(),
+                          (np.asarray(cube.fips) // 1000).tolist()))
+    if os.path.exists(path):
+        table = pd.read_csv(path)
+        for name, code in zip(table['state_name'], table['fips']):
+            state_fips.setdefault(str(name), int(code))
+    return np.array([state_fips.get(str(name), -1) for name in cube.unallocated_states],
+                    dtype=np.int64)
+
+
+def build_rollup(cube, states_path = STATES_PATH):
+    '''Build a RollupCube from a county cube. States and the nation sum the
+    counties and the cube's unallocated rows, so they match the totals of
+    every NYT row; unallocated rows of an unknown state only count towards
+    the nation.'''
+    print("Building county, state and national rollups")
+    county_state = np.asarray(cube.fips) // 1000
+    # First county of each state
+    starts = np.flatnonzero(np.diff(county_state, prepend=-1) != 0)
+    unallocated_fips = _unallocated_state_fips(cube, states_path)
+    allocated = unallocated_fips >= 0
+    if (~allocated).any():
+        print(f"Unallocated rows of unknown states {list(cube.unallocated_states[~allocated])} "
+              "only count towards the nation")
+    state_fips = np.union1d(county_state[starts], unallocated_fips[allocated]).astype(np.int64)
+    state_codes, state_names, table_population = _state_table(state_fips, states_path)
+    # State row of each run of counties and of each unallocated state
+    county_rows = np.searchsorted(state_fips, county_state[starts])
+    unallocated_rows = np.searchsorted(state_fips, unallocated_fips[allocated])
+
+    n_metrics, n_days = len(cube.metrics), len(cube.dates)
+    state_values = np.full((n_metrics, len(state_fips), n_days), np.nan)
+    nation_values = np.full((n_metrics, 1, n_days), np.nan)
+    population = np.asarray(cube.population, dtype=np.float64)
+    # The states table's population, the sum of the counties' otherwise
+    state_population = np.zeros(len(state_fips))
+    if len(starts):
+        state_population[county_rows] = np.add.reduceat(np.nan_to_num(population), starts)
+    state_population = np.where(np.isfinite(table_population), table_population, state_population)
+
+    def totals(i):
+        # (state sums, state counts, nation sums, nation counts) of metric i
+        sums = np.zeros((len(state_fips), n_days))
+        counts = np.zeros((len(state_fips), n_days), dtype=np.int64)
+        if len(starts):
+            values = cube.values[i]
+            reported = np.isfinite(values)
+            sums[county_rows] = np.add.reduceat(np.where(reported, values, 0), starts, axis=0,
+                                                dtype=np.float64)
+            counts[county_rows] = np.add.reduceat(reported, starts, axis=0, dtype=np.int64)
+        unallocated = np.asarray(cube.unallocated_values[i], dtype=np.float64)
+        reported = np.isfinite(unallocated)
+        unallocated = np.where(reported, unallocated, 0)
+        np.add.at(sums, unallocated_rows, unallocated[allocated])
+        np.add.at(counts, unallocated_rows, reported[allocated])
+        return (sums, counts,
+                sums.sum(axis=0) + unallocated[~allocated].sum(axis=0),
+                counts.sum(axis=0) + reported[~allocated].sum(axis=0))
+
+    for i, metric in enumerate(cube.metrics):
+        if metric in RATE_METRICS:
+            continue
+        sums, counts, nation_sums, nation_counts = totals(i)
+        state_values[i] = np.where(counts > 0, sums, np.nan)
+        nation_values[i, 0] = np.where(nation_counts > 0, nation_sums, np.nan)
+
+    # Rates over the population of the states reporting the count
+    for metric, count in RATE_METRICS.items():
+        if metric not in cube.metric_index or count not in cube.metric_index:
+            continue
+        sums, counts, _, _ = totals(cube.metric_index[count])
+        people = np.where(counts > 0, state_population[:, None], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            state_values[cube.metric_index[metric]] = np.where(people > 0, sums / people * 1e6, np.nan)
+            nation_values[cube.metric_index[metric], 0] = np.where(
+                people.sum(axis=0) > 0,
+                np.where(people > 0, sums, 0).sum(axis=0) / people.sum(axis=0) * 1e6, np.nan)
+    return RollupCube(cube, state_fips, state_codes, state_names, state_population,
+                      state_values, nation_values)
+
+
+def compare_covid_tracking(rollup, covid_states_df, date = None):
+    '''Return a frame comparing the NYT state rollups with the Covid Tracking
+    series on date (by default the latest date both have), one row per state
+    and COVID_TRACKING_FIELDS metric with both values and their difference
+    relative to Covid Tracking.'''
+    columns = ['state', 'metric', 'nyt', 'covid_tracking', 'relative_difference']
+    if date is None and len(covid_states_df):
+        date = min(rollup.dates[-1], np.datetime64(covid_states_df['date'].max(), 'D'))
+    offset = rollup.cube.day_offset(date) if date is not None else None
+    if offset is None:
+        return pd.DataFrame(columns=columns)
+
+    reported = covid_states_df[covid_states_df['date'] == pd.Timestamp(date)].set_index('state')
+    frames = []
+    for metric, field in COVID_TRACKING_FIELDS.items():
+        if metric not in rollup.metric_index or field not in reported.columns:
+            continue
+        nyt = pd.Series(rollup.state_values[rollup.metric_index[metric], :, offset],
+                        index=rollup.state_codes)
+        covid_tracking = reported[field].astype(float).reindex(nyt.index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            relative = (nyt - covid_tracking) / covid_tracking
+        frames.append(pd.DataFrame({'state': nyt.index,
+                                    'metric': metric,
+                                    'nyt': nyt.to_numpy(),
+                                    'covid_tracking': covid_tracking.to_numpy(),
+                                    'relative_difference': relative.to_numpy()}))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,198 @@
+import numpy as np
+import pandas as pd
+
+import fcntl
+import json
+import os
+import shutil
+
+from modules import county_store
+from modules import hotspots
+from modules import rollup
+
+
+################################################################################
+# Shared Dataset
+# Every gunicorn worker imports main.py. Instead of each worker downloading
+# and holding its own copy of the data, the first worker materializes it into
+# .npy files on local disk and every worker memory-maps them read only, so the
+# pages are shared through the OS page cache.
+
+SHARED_DATA_DIR = os.environ.get('SHARED_DATA_DIR', 'data/shared')
+
+# Versions kept on disk, the newest and the one before it, which workers
+# that have not swapped yet may still be mapping
+KEEP_VERSIONS = 2
+
+# Cube arrays written to disk, all mapped read only when loaded
+CUBE_ARRAYS = ['fips', 'county_names', 'state_names', 'values', 'present', 'quantiles',
+               'population', 'unallocated_states', 'unallocated_values']
+
+# Rollup arrays written next to the cube
+ROLLUP_ARRAYS = ['state_fips', 'state_codes', 'state_names', 'state_population',
+                 'state_values', 'nation_values']
+
+# Hotspot table arrays written next to the cube
+HOTSPOT_ARRAYS = ['fips', 'top', 'values', 'digests']
+
+
+def save_cube(cube, directory):
+    '''Write a CountyCube's arrays to directory as .npy files.'''
+    os.makedirs(directory, exist_ok=True)
+    for name in CUBE_ARRAYS:
+        array = getattr(cube, name)
+        # Object arrays can not be mapped, store names as fixed width strings
+        if array.dtype == object:
+            array = array.astype(str)
+        np.save(os.path.join(directory, f'{name}.npy'), array)
+    with open(os.path.join(directory, 'cube.json'), 'w') as fout:
+        json.dump({'start_date': str(cube.start_date),
+                   'metrics': cube.metrics}, fout)
+
+
+def load_cube(directory):
+    '''Memory-map a CountyCube written by save_cube.'''
+    with open(os.path.join(directory, 'cube.json'), 'r') as fin:
+        meta = json.load(fin)
+    # Directories written before the quantiles, population and unallocated
+    # rows were stored are still mapped, the cube fills them in instead
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+              for name in CUBE_ARRAYS
+              if os.path.exists(os.path.join(directory, f'{name}.npy'))}
+    return county_store.CountyCube(arrays['fips'],
+                                   arrays['county_names'],
+                                   arrays['state_names'],
+                                   meta['start_date'],
+                                   meta['metrics'],
+                                   arrays['values'],
+                                   arrays['present'],
+                                   arrays.get('quantiles'),
+                                   arrays.get('population'),
+                                   arrays.get('unallocated_states'),
+                                   arrays.get('unallocated_values'))
+
+
+def save_rollup(county_rollup, directory):
+    '''Write a RollupCube's state and nation arrays to directory as .npy files.'''
+    os.makedirs(directory, exist_ok=True)
+    for name in ROLLUP_ARRAYS:
+        np.save(os.path.join(directory, f'{name}.npy'), getattr(county_rollup, name))
+
+
+def load_rollup(directory, cube):
+    '''Memory-map the RollupCube of cube written by save_rollup, built from
+    the cube instead for directories written before rollups were stored.'''
+    if not os.path.exists(os.path.join(directory, 'nation_values.npy')):
+        return rollup.build_rollup(cube)
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+              for name in ROLLUP_ARRAYS}
+    return rollup.RollupCube(cube, **arrays)
+
+
+def save_hotspots(table, directory):
+    '''Write a HotspotTable's arrays to directory as .npy files.'''
+    os.makedirs(directory, exist_ok=True)
+    for name in HOTSPOT_ARRAYS:
+        np.save(os.path.join(directory, f'{name}.npy'), getattr(table, name))
+    with open(os.path.join(directory, 'hotspots.json'), 'w') as fout:
+        json.dump({'start_date': str(table.start_date)}, fout)
+
+
+def _map_hotspots(directory):
+    # HotspotTable written by save_hotspots, None if there is none
+    if not os.path.exists(os.path.join(directory, 'hotspots.json')):
+        return None
+    with open(os.path.join(directory, 'hotspots.json'), 'r') as fin:
+        meta = json.load(fin)
+    arrays = {name: np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r')
+              for name in HOTSPOT_ARRAYS}
+    return hotspots.HotspotTable(start_date = meta['start_date'], **arrays)
+
+
+def load_hotspots(directory, cube):
+    '''Memory-map the HotspotTable of cube written by save_hotspots, built
+    from the cube instead for directories written before hotspots were
+    stored.'''
+    table = _map_hotspots(directory)
+    if table is None:
+        return hotspots.build_hotspot_table(cube)
+    return table
+
+
+def _versions(directory):
+    # (version names newest first by the time their manifest was written,
+    # left over directories without a manifest)
+    versions, stale = [], []
+    for name in os.listdir(directory):
+        manifest = os.path.join(directory, name, 'manifest.json')
+        if os.path.exists(manifest):
+            versions.append((os.path.getmtime(manifest), name))
+        elif name != '.lock':
+            stale.append(name)
+    versions.sort(reverse=True)
+    return [name for _, name in versions], stale
+
+
+def _previous_hotspots(directory):
+    # Hotspot table of the newest version on disk, None if it has none
+    versions, _ = _versions(directory)
+    if not versions:
+        return None
+    return _map_hotspots(os.path.join(directory, versions[0], 'hotspots'))
+
+
+def _remove_old_versions(directory, keep = KEEP_VERSIONS):
+    # Left over temporary directories are never mapped, and mapped files stay
+    # valid for workers still using them
+    versions, stale = _versions(directory)
+    for name in stale + versions[keep:]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def materialize(version, build, directory = SHARED_DATA_DIR):
+    '''Return (county cube, states df, rollup, hotspot table) for a data
+    version, shared by workers.
+
+    The first worker to ask for a version calls build(), which returns the
+    county cube and states dataframe, rolls the cube up to states and the
+    nation, ranks its hotspots (reusing the unchanged days of the previous
+    version's table) and writes them under directory. Other workers wait on a file lock
+    and then map the same files. Files are mapped while holding the lock, and
+    only versions older than the last KEEP_VERSIONS are removed once a new
+    one is written, so no worker maps a version as it is being removed.'''
+    os.makedirs(directory, exist_ok=True)
+    version_dir = os.path.join(directory, str(version))
+    manifest = os.path.join(version_dir, 'manifest.json')
+
+    with open(os.path.join(directory, '.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            if not os.path.exists(manifest):
+                print(f"Materializing shared data [{version_dir}]")
+                cube, covid_states_df = build()
+
+                # Write to a temporary directory and rename so a half written
+                # version is never mapped
+                tmp_dir = version_dir + '.tmp'
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                save_cube(cube, os.path.join(tmp_dir, 'county_cube'))
+                save_rollup(rollup.build_rollup(cube), os.path.join(tmp_dir, 'rollup'))
+                save_hotspots(hotspots.update_hotspot_table(_previous_hotspots(directory), cube),
+                              os.path.join(tmp_dir, 'hotspots'))
+                covid_states_df.to_parquet(os.path.join(tmp_dir, 'covid_states.parquet'), index=False)
+                with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as fout:
+                    json.dump({'version': str(version)}, fout)
+                shutil.rmtree(version_dir, ignore_errors=True)
+                os.rename(tmp_dir, version_dir)
+
+                _remove_old_versions(directory)
+            else:
+                print(f"Mapping shared data [{version_dir}]")
+
+            cube = load_cube(os.path.join(version_dir, 'county_cube'))
+            covid_states_df = pd.read_parquet(os.path.join(version_dir, 'covid_states.parquet'))
+            county_rollup = load_rollup(os.path.join(version_dir, 'rollup'), cube)
+            hotspot_table = load_hotspots(os.path.join(version_dir, 'hotspots'), cube)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return cube, covid_states_df, county_rollup, hotspot_table
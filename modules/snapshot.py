@@ -0,0 +1,146 @@
+import json
+
+import pandas as pd
+
+
+################################################################################
+# Snapshot Schemas
+
+# Typed columns for the county snapshot. Anything not listed keeps the dtype
+# it was written with.
+COUNTY_DTYPES = {
+    'date': 'datetime64[ns]',
+    'county': 'category',
+    'state': 'category',
+    'fips': 'int32',
+    'FIPS': 'int32',
+    'cases': 'int32',
+    'deaths': 'int32',
+    'STATE': 'int16',
+    'COUNTY': 'int16',
+    'POPESTIMATE2019': 'int32',
+    'CENSUS2010POP': 'int32'
+}
+
+# Typed columns for the state snapshot.
+STATE_DTYPES = {
+    'date': 'datetime64[ns]',
+    'state': 'category',
+    'fips': 'category',
+    'death': 'int32',
+    'deathIncrease': 'int32',
+    'positive': 'int32',
+    'positiveIncrease': 'int32',
+    'hospitalizedCurrently': 'int32',
+    'hospitalizedCumulative': 'int32',
+    'hospitalizedIncrease': 'int32'
+}
+
+# Compact in-memory dtypes for the frames the web app holds. Names become
+# categoricals (object strings also defeat copy-on-write sharing after a
+# fork), counts int32 (float64 when they have gaps) and rates float32.
+# Columns not listed are dropped.
+COUNTY_COMPACT_DTYPES = {
+    'date': 'datetime64[ns]',
+    'county': 'category',
+    'state': 'category',
+    'fips': 'int32',
+    'cases': 'int32',
+    'deaths': 'int32',
+    'POPESTIMATE2019': 'int32',
+    'casesPerMillion': 'float32',
+    'deathsPerMillion': 'float32',
+    'case_diff': 'float32',
+    'death_diff': 'float32',
+    'cases_14MA': 'float32',
+    'deaths_14MA': 'float32'
+}
+
+STATE_COMPACT_DTYPES = {
+    'date': 'datetime64[ns]',
+    'state': 'category',
+    'death': 'int32',
+    'deathIncrease': 'int32',
+    'positive': 'int32',
+    'positiveIncrease': 'int32',
+    'hospitalizedCurrently': 'int32',
+    'hospitalizedCumulative': 'int32',
+    'hospitalizedIncrease': 'int32',
+    'case_pm': 'float32',
+    'death_pm': 'float32',
+    'cases_14MA': 'float32',
+    'deaths_14MA': 'float32'
+}
+
+# Columns the dashboard plots, used to project snapshot reads.
+COUNTY_COLUMNS = list(COUNTY_COMPACT_DTYPES)
+STATE_COLUMNS = list(STATE_COMPACT_DTYPES)
+
+
+################################################################################
+# Reading and Writing
+
+def coerce_snapshot_dtypes(df, dtypes):
+    '''Cast the columns of df listed in dtypes.
+
+    Integer columns holding missing values are stored as float64 instead,
+    since numpy integers have no NaN. float32 would round counts above 2**24
+    and the national totals summed from them.'''
+    df = df.copy()
+    for column, dtype in dtypes.items():
+        if column not in df.columns:
+            continue
+        if dtype.startswith('int') and df[column].isna().any():
+            dtype = 'float64'
+        # Missing values stay missing, categories included
+        df[column] = df[column].astype(dtype)
+    return df
+
+
+def write_snapshot(df, path, dtypes):
+    '''Write df as a typed parquet snapshot to a path, gs:// uri or buffer.'''
+    df = coerce_snapshot_dtypes(df, dtypes)
+    df.to_parquet(path, engine='pyarrow', index=False)
+
+
+def read_snapshot(path, columns=None):
+    '''Read a parquet snapshot, only loading the requested columns.'''
+    return pd.read_parquet(path, engine='pyarrow', columns=columns)
+
+
+def read_snapshot_parts(paths, columns=None):
+    '''Read the parquet parts of a snapshot as one frame.'''
+    return pd.concat([read_snapshot(path, columns=columns) for path in paths],
+                     ignore_index=True)
+
+
+def compact_frame(df, dtypes, name):
+    '''Keep only the columns in dtypes, cast them to their compact dtypes and
+    print the memory used before and after, naming the frame by name.'''
+    before = df.memory_usage(deep=True).sum()
+    df = coerce_snapshot_dtypes(df[[column for column in dtypes if column in df.columns]], dtypes)
+    after = df.memory_usage(deep=True).sum()
+    print(f"Compacted {name} frame: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB")
+    return df
+
+
+################################################################################
+# County Snapshot Parts
+# The county snapshot is published as parquet parts under COUNTY_PARTS_PREFIX:
+# one holding the whole history, written by each full rebuild, and one per
+# incremental update holding only its new dates. The manifest lists the parts
+# of the current snapshot and the tail the next update chains onto. It is
+# written after them, so readers never see a half published update.
+
+COUNTY_MANIFEST = 'covid_counties.manifest'
+COUNTY_PARTS_PREFIX = 'covid_counties/'
+
+
+def parse_manifest(text):
+    '''Return {'parts': [blob names], 'tail': blob name} of a manifest.'''
+    return json.loads(text)
+
+
+def format_manifest(parts, tail):
+    '''Return the text of a manifest listing parts and tail.'''
+    return json.dumps({'parts': list(parts), 'tail': tail})
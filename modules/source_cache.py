@@ -0,0 +1,103 @@
+import hashlib
+import json
+import os
+import time
+
+import fsspec
+
+
+################################################################################
+# Source Cache
+# Content-addressed cache of upstream response bodies. Bodies are stored once
+# under their sha256 with an index mapping each url to its body, ETag and
+# Last-Modified, so downloads can be conditional and a 304 reuses the stored
+# body. The root can be a local directory or any fsspec url, e.g. a gs://
+# prefix for the cloud function, which has no persistent disk.
+
+SOURCE_CACHE_DIR = os.environ.get('SOURCE_CACHE_DIR', 'data/source_cache')
+
+# Bodies are evicted least recently used first above this size
+SOURCE_CACHE_MB = float(os.environ.get('SOURCE_CACHE_MB', 512))
+
+
+class SourceCache:
+    def __init__(self, root = SOURCE_CACHE_DIR, max_mb = SOURCE_CACHE_MB):
+        self.fs, _, (self.root,) = fsspec.core.get_fs_token_paths(root)
+        self.max_bytes = max_mb * 1024 * 1024
+        self.index = self._read_index()
+
+    def _index_path(self):
+        return f"{self.root}/index.json"
+
+    def _object_path(self, sha):
+        return f"{self.root}/objects/{sha}"
+
+    def _read_index(self):
+        if not self.fs.exists(self._index_path()):
+            return {}
+        with self.fs.open(self._index_path(), 'r') as fin:
+            return json.load(fin)
+
+    def save(self):
+        '''Write the index back to the cache root.'''
+        with self.fs.open(self._index_path(), 'w') as fout:
+            json.dump(self.index, fout)
+
+    def contains(self, url):
+        '''Return whether the cache holds a body for url.'''
+        entry = self.index.get(url)
+        return entry is not None and self.fs.exists(self._object_path(entry['sha256']))
+
+    def validators(self, url):
+        '''Return conditional request headers for a cached url.'''
+        if not self.contains(url):
+            return {}
+        entry = self.index[url]
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def get(self, url):
+        '''Return the cached body of url and mark it as used.'''
+        entry = self.index[url]
+        entry['used'] = time.time()
+        with self.fs.open(self._object_path(entry['sha256']), 'rb') as fin:
+            return fin.read()
+
+    def put(self, url, body, etag = None, last_modified = None):
+        '''Store a new body for url, identical bodies are only stored once.'''
+        sha = hashlib.sha256(body).hexdigest()
+        self.fs.makedirs(f"{self.root}/objects", exist_ok=True)
+        if not self.fs.exists(self._object_path(sha)):
+            with self.fs.open(self._object_path(sha), 'wb') as fout:
+                fout.write(body)
+        previous = self.index.get(url)
+        self.index[url] = {'sha256': sha,
+                           'etag': etag,
+                           'last_modified': last_modified,
+                           'size': len(body),
+                           'used': time.time()}
+        if previous is not None:
+            self._release(previous['sha256'])
+        self.evict()
+
+    def _release(self, sha):
+        # Only remove a body once no url points at it
+        if all(entry['sha256'] != sha for entry in self.index.values()):
+            self.fs.rm(self._object_path(sha))
+            return True
+        return False
+
+    def evict(self):
+        '''Drop least recently used urls until the bodies fit in max_bytes.'''
+        sizes = {entry['sha256']: entry['size'] for entry in self.index.values()}
+        total = sum(sizes.values())
+        for url, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            del self.index[url]
+            if self._release(entry['sha256']):
+                total -= sizes[entry['sha256']]
@@ -0,0 +1,198 @@
+import numpy as np
+import scipy.sparse as sparse
+
+import fcntl
+import hashlib
+import json
+import os
+
+
+################################################################################
+# County Adjacency
+# Counties sharing at least one polygon vertex in the county geojson are
+# neighbours (queen contiguity). The adjacency is built with one sparse
+# product of the county x vertex incidence matrix with its transpose, and
+# cached to disk since the geometry does not change between deploys.
+
+ADJACENCY_PATH = 'data/county_adjacency.npz'
+
+# Vertices are matched after rounding, about 10 m
+COORDINATE_DECIMALS = 4
+
+
+class CountyAdjacency:
+    '''Sparse symmetric 0/1 county adjacency, rows and columns in the order
+    of fips (integer codes).'''
+
+    def __init__(self, fips, matrix):
+        self.fips = np.asarray(fips)
+        self.matrix = sparse.csr_matrix(matrix)
+        self._aligned = (None, None)
+
+    def aligned(self, fips):
+        '''Return the adjacency restricted and ordered to fips, e.g. the county
+        cube's counties. Counties missing from the geojson have no neighbours.
+        The last alignment is kept, cubes keep the same fips array.'''
+        cached_fips, cached = self._aligned
+        if cached_fips is fips:
+            return cached
+        fips = np.asarray(fips)
+        position = np.searchsorted(self.fips, fips)
+        position = np.minimum(position, len(self.fips) - 1)
+        known = self.fips[position] == fips
+        # Selection matrix from the geojson's counties to fips
+        select = sparse.csr_matrix((np.ones(known.sum()), (np.flatnonzero(known), position[known])),
+                                   shape=(len(fips), len(self.fips)))
+        matrix = (select @ self.matrix @ select.T).tocsr()
+        self._aligned = (fips, matrix)
+        return matrix
+
+
+def _polygon_rings(geometry):
+    # Rings of a Polygon or MultiPolygon
+    if geometry is None:
+        return []
+    if geometry['type'] == 'Polygon':
+        return geometry['coordinates']
+    if geometry['type'] == 'MultiPolygon':
+        return [ring for polygon in geometry['coordinates'] for ring in polygon]
+    return []
+
+
+def build_county_adjacency(geojson, decimals = COORDINATE_DECIMALS):
+    '''Build a CountyAdjacency from a county geojson with fips feature ids.'''
+    print("Building county adjacency")
+    features = [feature for feature in geojson['features'] if str(feature.get('id', '')).isdigit()]
+    fips = np.array([int(feature['id']) for feature in features])
+    order = np.argsort(fips, kind='stable')
+    fips = fips[order]
+
+    # Every vertex of every county, as (county, x, y)
+    counties, points = [], []
+    for county, i in enumerate(order):
+        for ring in _polygon_rings(features[i].get('geometry')):
+            ring = np.asarray(ring, dtype=np.float64)[:, :2]
+            points.append(ring)
+            counties.append(np.full(len(ring), county))
+    if not points:
+        return CountyAdjacency(fips, sparse.csr_matrix((len(fips), len(fips))))
+    counties = np.concatenate(counties)
+    # One integer per rounded (lon, lat), offset to stay positive
+    points = np.round((np.concatenate(points) + 360) * 10 ** decimals).astype(np.int64)
+    keys = points[:, 0] * (1 << 32) + points[:, 1]
+
+    # County x vertex incidence, counties sharing a vertex share a column
+    _, vertex = np.unique(keys, return_inverse=True)
+    incidence = sparse.csr_matrix((np.ones(len(counties)), (counties, vertex.ravel())),
+                                  shape=(len(fips), vertex.max() + 1))
+    shared = (incidence @ incidence.T).tocsr()
+    shared.setdiag(0)
+    shared.eliminate_zeros()
+    shared.data[:] = 1
+    return CountyAdjacency(fips, shared)
+
+
+def save_county_adjacency(adjacency, path = ADJACENCY_PATH, source = ''):
+    '''Write a CountyAdjacency to an .npz file, with the digest of the
+    geojson it was built from. Written to a temporary file and renamed, so a
+    reader never loads a half written file.'''
+    matrix = adjacency.matrix.tocsr()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fout:
+        np.savez_compressed(fout, fips=adjacency.fips, indices=matrix.indices,
+                            indptr=matrix.indptr, shape=np.array(matrix.shape),
+                            source=np.array(source))
+    os.replace(tmp_path, path)
+
+
+def _file_digest(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _read_county_adjacency(path, source):
+    # The cached adjacency if it was built from the geojson with digest
+    # source, otherwise None
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as cached:
+        if 'source' not in cached.files or str(cached['source']) != source:
+            return None
+        matrix = sparse.csr_matrix((np.ones(len(cached['indices'])), cached['indices'],
+                                    cached['indptr']), shape=tuple(cached['shape']))
+        return CountyAdjacency(cached['fips'], matrix)
+
+
+def load_county_adjacency(geojson_path, path = ADJACENCY_PATH):
+    '''Return the CountyAdjacency of the county geojson file at
+    geojson_path, from the cache at path when it was built from the same
+    file, otherwise built and cached. Workers starting together wait on a
+    file lock, the first one parses the geojson and builds the adjacency and
+    the others read its file.'''
+    source = _file_digest(geojson_path)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            adjacency = _read_county_adjacency(path, source)
+            if adjacency is not None:
+                print("Loading county adjacency from file.")
+                return adjacency
+            with open(geojson_path, 'r') as fin:
+                adjacency = build_county_adjacency(json.load(fin))
+            save_county_adjacency(adjacency, path, source)
+            return adjacency
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+################################################################################
+# Spatial Statistics
+# Local statistics of a metric for every county as sparse matrix products
+# with the adjacency. values are (county,) for one date or (county, day) for
+# many, NaN for counties without a value, which are left out of every sum.
+
+def _valid(values):
+    values = np.asarray(values, dtype=np.float64)
+    valid = np.isfinite(values)
+    return np.where(valid, values, 0.0), valid.astype(np.float64)
+
+
+def local_morans_i(matrix, values):
+    '''Return (I, z, lag) of local Moran's I with row standardised weights:
+    z the standardised values, lag the mean z of each county's neighbours and
+    I = z * lag. High I with high z marks a cluster of high values.'''
+    x, valid = _valid(values)
+    n = valid.sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = x.sum(axis=0) / n
+        std = np.sqrt((x ** 2).sum(axis=0) / n - mean ** 2)
+        z = np.where(valid > 0, (x - mean) / std, 0.0)
+        # Neighbours without a value are left out of the average
+        lag = (matrix @ z) / (matrix @ valid)
+        result = z * lag
+    missing = valid == 0
+    z[missing] = np.nan
+    result[missing] = np.nan
+    return result, z, lag
+
+
+def getis_ord_g(matrix, values):
+    '''Return the Getis-Ord Gi* z-score of every county, the county and its
+    neighbours against the mean of all counties. Above 1.96 is a hot spot at
+    the 5% level, below -1.96 a cold spot.'''
+    x, valid = _valid(values)
+    n = valid.sum(axis=0)
+    # Binary weights including the county itself
+    weights = matrix + sparse.identity(matrix.shape[0], format='csr')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = x.sum(axis=0) / n
+        s = np.sqrt((x ** 2).sum(axis=0) / n - mean ** 2)
+        local_sum = weights @ x
+        k = weights @ valid
+        g = (local_sum - mean * k) / (s * np.sqrt((n * k - k ** 2) / (n - 1)))
+    g[valid == 0] = np.nan
+    return g